@@ -9,20 +9,6 @@ from strategies.manual_strategy import ManualStrategy
 
 DEBUG = True
 
-stage = Stages.get_by_id(26)
-stage_config = StageConfig(stage)
-idol_config = IdolConfig(
-    params=[1009, 1422, 1474, 47],
-    support_bonus=0.023,
-    p_item_ids=[47, 75, 71],
-    skill_card_id_groups=[[223, 45, 122, 125, 136, 181], [223, 45, 291, 96, 297, 179]],
-    stage=stage,
-    fallback_plan="logic",
-    fallback_idol_id=3,
-)
-
-print(idol_config.type_multipliers)
-
 
 def simulate(stage_config, idol_config):
     logger = Logger(DEBUG)
@@ -32,4 +18,27 @@ def simulate(stage_config, idol_config):
     print(result["score"])
 
 
-simulate(stage_config, idol_config)
+# Plays a manual game of a sample loadout
+def main():
+    stage = Stages.get_by_id(26)
+    stage_config = StageConfig(stage)
+    idol_config = IdolConfig(
+        params=[1009, 1422, 1474, 47],
+        support_bonus=0.023,
+        p_item_ids=[47, 75, 71],
+        skill_card_id_groups=[
+            [223, 45, 122, 125, 136, 181],
+            [223, 45, 291, 96, 297, 179],
+        ],
+        stage=stage,
+        fallback_plan="logic",
+        fallback_idol_id=3,
+    )
+
+    print(idol_config.type_multipliers)
+
+    simulate(stage_config, idol_config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,984 @@
+import functools
+import random
+
+import numpy as np
+
+from compiler import compile_action
+from compiler import compile_condition
+from compiler import get_condition_variables
+from constants import COST_FIELDS
+from constants import DEBUFF_FIELDS
+from constants import WHOLE_FIELDS
+from constants import INCREASE_TRIGGER_FIELDS
+from constants import DECREASE_TRIGGER_FIELDS
+from constants import EOT_DECREMENT_FIELDS
+from engine import DEFAULT_EFFECTS
+from engine import Engine
+from game_data.p_items import PItems
+from game_data.skill_cards import SkillCards
+from logger import Logger
+
+
+SCALAR_FIELDS = (
+    "turnsElapsed",
+    "turnsRemaining",
+    "cardUsesRemaining",
+    "maxStamina",
+    "fixedStamina",
+    "intermediateStamina",
+    "stamina",
+    "fixedGenki",
+    "intermediateGenki",
+    "genki",
+    "cost",
+    "intermediateScore",
+    "score",
+    "clearRatio",
+    "cardsUsed",
+    "turnCardsUsed",
+    "goodConditionTurns",
+    "perfectConditionTurns",
+    "concentration",
+    "goodImpressionTurns",
+    "motivation",
+    "halfCostTurns",
+    "doubleCostTurns",
+    "costReduction",
+    "costIncrease",
+    "doubleCardEffectCards",
+    "nullifyGenkiTurns",
+    "nullifyDebuff",
+    "usedCardId",
+    "concentrationMultiplier",
+    "motivationMultiplier",
+)
+
+SCALAR_FIELD_SET = frozenset(SCALAR_FIELDS)
+
+TRIGGER_DIFF_FIELDS = list(
+    dict.fromkeys(
+        [
+            *INCREASE_TRIGGER_FIELDS,
+            *DECREASE_TRIGGER_FIELDS,
+            *EOT_DECREMENT_FIELDS,
+        ]
+    )
+)
+
+TURN_TYPES = ["vocal", "dance", "visual"]
+
+# Score buffs with no turn limit are stored with this turn count
+PERMANENT = -1
+
+
+# Largest skill card id, and whether each card id can be upgraded and is
+# forced into the initial hand. Built on first use rather than at import,
+# which would load the skill cards.
+@functools.cache
+def get_card_tables():
+    skill_cards = SkillCards.get_all()
+    max_card_id = max(skill_cards)
+    card_upgradable = np.zeros(max_card_id + 1, dtype=bool)
+    card_force_initial_hand = np.zeros(max_card_id + 1, dtype=bool)
+    for skill_card in skill_cards.values():
+        card_upgradable[skill_card["id"]] = (
+            not skill_card["upgraded"] and skill_card["type"] != "trouble"
+        )
+        card_force_initial_hand[skill_card["id"]] = bool(skill_card["forceInitialHand"])
+    return max_card_id, card_upgradable, card_force_initial_hand
+
+
+class Pile:
+    # Skill card ids of one pile for every game, in the same order as the
+    # engine's lists, padded on the right
+    def __init__(self, num_games, width):
+        self.ids = np.zeros((num_games, width), dtype=np.int64)
+        self.sizes = np.zeros(num_games, dtype=np.int64)
+
+    def _reserve(self, width):
+        if width > self.ids.shape[1]:
+            ids = np.zeros(
+                (self.ids.shape[0], max(width, 2 * self.ids.shape[1])), dtype=np.int64
+            )
+            ids[:, : self.ids.shape[1]] = self.ids
+            self.ids = ids
+
+    def get(self, game):
+        return self.ids[game, : self.sizes[game]].tolist()
+
+    def set(self, game, card_ids):
+        self._reserve(len(card_ids))
+        self.ids[game, : len(card_ids)] = card_ids
+        self.sizes[game] = len(card_ids)
+
+    def push(self, games, card_ids):
+        if not len(games):
+            return
+        self._reserve(self.sizes[games].max() + 1)
+        self.ids[games, self.sizes[games]] = card_ids
+        self.sizes[games] += 1
+
+    def pop(self, games):
+        self.sizes[games] -= 1
+        return self.ids[games, self.sizes[games]]
+
+    def peek(self, games):
+        return self.ids[games, self.sizes[games] - 1]
+
+    def remove_at(self, games, positions):
+        columns = np.arange(self.ids.shape[1] - 1)
+        rows = self.ids[games]
+        rows[:, :-1] = np.where(
+            columns >= positions[:, None], rows[:, 1:], rows[:, :-1]
+        )
+        self.ids[games] = rows
+        self.sizes[games] -= 1
+
+    def move_all_to(self, games, pile):
+        for i in range(0, self.sizes[games].max(initial=0)):
+            moving = games[self.sizes[games] > i]
+            pile.push(moving, self.ids[moving, i])
+        self.sizes[games] = 0
+
+    def counts(self):
+        num_games, width = self.ids.shape
+        in_pile = np.arange(width) < self.sizes[:, None]
+        rows = np.repeat(np.arange(num_games), width)[in_pile.ravel()]
+        max_card_id, _, _ = get_card_tables()
+        counts = np.zeros((num_games, max_card_id + 1), dtype=np.int64)
+        np.add.at(counts, (rows, self.ids[in_pile]), 1)
+        return counts
+
+
+class PhaseEffects:
+    # Per game, indices into the game's effect instances for one phase,
+    # sorted by (order, index) like Engine's effectsByPhase
+    def __init__(self, num_games):
+        self.entries = np.full((num_games, 4), -1, dtype=np.int64)
+        self.sizes = np.zeros(num_games, dtype=np.int64)
+
+
+class BatchState:
+    # N games in lockstep, stored as struct-of-arrays. Scalar fields are
+    # float64 vectors with one entry per game, piles are Pile matrices, and
+    # effects are instance tables with per-phase indices. Compiled
+    # expressions read these arrays the same way they read a GameState.
+    def __init__(self, num_games, width):
+        self.num_games = num_games
+        for field in SCALAR_FIELDS:
+            setattr(self, field, np.zeros(num_games))
+        self.usedCardId[:] = np.nan
+        self.concentrationMultiplier[:] = 1
+        self.motivationMultiplier[:] = 1
+
+        self.rngs = [None] * num_games
+        self.started = False
+        self.phase = None
+        self.turnTypes = None
+        self.turnType = np.full(num_games, "", dtype="<U6")
+        self.cardEffects = []
+
+        # Skill card piles
+        self.deckCardIds = Pile(num_games, width)
+        self.handCardIds = Pile(num_games, width)
+        self.discardedCardIds = Pile(num_games, width)
+        self.removedCardIds = Pile(num_games, width)
+
+        # Effect instances; limit and ttl are NaN when the effect has none
+        self.effect_templates = np.full((num_games, 8), -1, dtype=np.int64)
+        self.effect_limits = np.full((num_games, 8), np.nan)
+        self.effect_ttls = np.full((num_games, 8), np.nan)
+        self.effect_counts = np.zeros(num_games, dtype=np.int64)
+        self.phase_effects = {}
+
+        # Score buffs, in the order the engine keeps them. Expired buffs
+        # leave inactive zero-amount slots until the next compaction.
+        self.score_buff_amounts = np.zeros((num_games, 4))
+        self.score_buff_turns = np.zeros((num_games, 4))
+        self.score_buff_fresh = np.zeros((num_games, 4), dtype=bool)
+        self.score_buff_active = np.zeros((num_games, 4), dtype=bool)
+        self.score_buff_counts = np.zeros(num_games, dtype=np.int64)
+
+        self.fresh_buffs = {}
+
+        # Fields set by actions that are not part of the engine's state
+        self.extras = {}
+
+    def __getitem__(self, key):
+        return self.extras[key]
+
+    def get_field(self, key):
+        if key in SCALAR_FIELD_SET:
+            return getattr(self, key)
+        return self.extras[key]
+
+    def get_hand(self, game):
+        return self.handCardIds.get(game)
+
+    def get_pile_counts(self, pile):
+        return getattr(self, pile).counts()
+
+    def copy_scalars(self):
+        preview = _Snapshot()
+        for field in SCALAR_FIELDS:
+            setattr(preview, field, getattr(self, field).copy())
+        preview.extras = {key: value.copy() for key, value in self.extras.items()}
+        preview.turnType = self.turnType
+        preview.cardEffects = self.cardEffects
+        preview.phase = self.phase
+        return preview
+
+    def snapshot(self, variables):
+        snapshot = _Snapshot()
+        snapshot.extras = {}
+        for variable in variables:
+            if variable in SCALAR_FIELD_SET:
+                setattr(snapshot, variable, getattr(self, variable).copy())
+            elif variable in self.extras:
+                snapshot.extras[variable] = self.extras[variable].copy()
+            elif hasattr(self, variable):
+                value = getattr(self, variable)
+                if isinstance(value, np.ndarray):
+                    value = value.copy()
+                setattr(snapshot, variable, value)
+        return snapshot
+
+    def _reserve_effects(self, width):
+        if width <= self.effect_templates.shape[1]:
+            return
+        width = max(width, 2 * self.effect_templates.shape[1])
+        for name, fill in (
+            ("effect_templates", -1),
+            ("effect_limits", np.nan),
+            ("effect_ttls", np.nan),
+        ):
+            values = getattr(self, name)
+            grown = np.full((self.num_games, width), fill, dtype=values.dtype)
+            grown[:, : values.shape[1]] = values
+            setattr(self, name, grown)
+
+    def _reserve_score_buffs(self, width):
+        if width <= self.score_buff_amounts.shape[1]:
+            return
+        width = max(width, 2 * self.score_buff_amounts.shape[1])
+        for name in (
+            "score_buff_amounts",
+            "score_buff_turns",
+            "score_buff_fresh",
+            "score_buff_active",
+        ):
+            values = getattr(self, name)
+            grown = np.zeros((self.num_games, width), dtype=values.dtype)
+            grown[:, : values.shape[1]] = values
+            setattr(self, name, grown)
+
+
+class _Snapshot:
+    def __getitem__(self, key):
+        return self.extras[key]
+
+    def get_field(self, key):
+        if key in SCALAR_FIELD_SET:
+            return getattr(self, key)
+        return self.extras[key]
+
+
+class BatchEngine:
+    # Runs many games of one loadout in lockstep. Each call applies an
+    # action to a mask of games, running the same compiled conditions and
+    # actions as Engine over NumPy vectors. Piles, random cards and
+    # shuffles are handled per game with a random.Random per game, so a
+    # game seeded with s plays out exactly like Engine after random.seed(s)
+    # with a fresh IdolConfig.
+    #
+    # Unlike Engine, the batch state is updated in place and nothing is
+    # logged.
+    def __init__(self, stage_config, idol_config):
+        self.stage_config = stage_config
+        self.idol_config = idol_config
+        self.engine = Engine(stage_config, idol_config, Logger(False), False)
+        _, self.card_upgradable, self.card_force_initial_hand = get_card_tables()
+        self.type_multipliers = np.array(
+            [idol_config.type_multipliers[t] for t in TURN_TYPES]
+        )
+
+        self.templates = []
+        self.template_ids = {}
+        self.template_orders = np.zeros(0)
+
+    def get_initial_state(self, seeds):
+        seeds = list(seeds)
+        num_games = len(seeds)
+        skill_card_ids = list(self.idol_config.skill_card_ids)
+        batch = BatchState(num_games, len(skill_card_ids) + 8)
+
+        turn_types = []
+        for game, seed in enumerate(seeds):
+            rng = random.Random(seed)
+            batch.rngs[game] = rng
+
+            deck_card_ids = list(skill_card_ids)
+            rng.shuffle(deck_card_ids)
+            deck_card_ids = sorted(
+                deck_card_ids,
+                key=lambda id: (
+                    1 if SkillCards.get_by_id(id)["forceInitialHand"] else 0
+                ),
+            )
+            batch.deckCardIds.set(game, deck_card_ids)
+
+            self.engine.random = rng
+            turn_types.append(self.engine._generate_turn_types())
+        self.engine.random = random
+
+        batch.turnTypes = np.array(turn_types, dtype="<U6")
+        batch.turnsRemaining[:] = self.stage_config.turn_count
+        batch.maxStamina[:] = self.idol_config.params["stamina"]
+        batch.stamina[:] = self.idol_config.params["stamina"]
+
+        return batch
+
+    @np.errstate(all="ignore")
+    def start_stage(self, batch):
+        if batch.started:
+            raise Exception("Stage already started!")
+        batch.started = True
+
+        games = np.ones(batch.num_games, dtype=bool)
+
+        self._set_effects(batch, games, "default", "好印象", DEFAULT_EFFECTS)
+        self._set_effects(batch, games, "stage", None, self.stage_config.effects)
+        for id in self.idol_config.p_item_ids:
+            p_item = PItems.get_by_id(id)
+            self._set_effects(batch, games, "pItem", id, p_item["effects"])
+
+        self._trigger_effects_for_phase("startOfStage", batch, games)
+
+        self._start_turn(batch, games)
+
+        return batch
+
+    @np.errstate(all="ignore")
+    def is_card_usable(self, batch, card_id):
+        card = SkillCards.get_by_id(card_id)
+        usable = np.ones(batch.num_games, dtype=bool)
+
+        # Check conditions
+        for condition in card["conditions"]:
+            usable &= self._evaluate_condition(condition, batch)
+
+        # Check cost
+        preview = batch.copy_scalars()
+        for cost in card["cost"]:
+            self._execute_action(cost, preview, usable.copy())
+        for field in COST_FIELDS:
+            usable &= getattr(preview, field) >= 0
+
+        return usable
+
+    # Uses card_ids[i] in game i, or ends the turn where it is 0. Games
+    # that have finished are left alone.
+    def step(self, batch, card_ids):
+        card_ids = np.asarray(card_ids)
+        active = batch.turnsRemaining > 0
+
+        ending = active & (card_ids == 0)
+        if ending.any():
+            self.end_turn(batch, ending)
+
+        for card_id in np.unique(card_ids[active & (card_ids != 0)]):
+            self.use_card(batch, active & (card_ids == card_id), int(card_id))
+
+        return batch
+
+    @np.errstate(all="ignore")
+    def use_card(self, batch, games, card_id):
+        card = SkillCards.get_by_id(card_id)
+        indices = np.flatnonzero(games)
+        hand_indices = np.argmax(batch.handCardIds.ids[indices] == card_id, axis=1)
+
+        # Set usedCard variables
+        batch.usedCardId[games] = card["id"] - 1 if card["upgraded"] else card["id"]
+        batch.cardEffects = self.engine._get_card_effects(card)
+
+        # Apply card cost
+        self._execute_actions(card["cost"], batch, games)
+
+        # Remove card from hand
+        batch.handCardIds.remove_at(indices, hand_indices)
+        batch.cardUsesRemaining[games] -= 1
+
+        # Trigger events on card used
+        self._trigger_effects_for_phase("cardUsed", batch, games)
+        if card["type"] == "active":
+            self._trigger_effects_for_phase("activeCardUsed", batch, games)
+        elif card["type"] == "mental":
+            self._trigger_effects_for_phase("mentalCardUsed", batch, games)
+
+        # Apply card effects
+        doubled = games & (batch.doubleCardEffectCards != 0)
+        if doubled.any():
+            batch.doubleCardEffectCards[doubled] -= 1
+            self._trigger_card_effects(card, batch, doubled)
+        self._trigger_card_effects(card, batch, games)
+
+        batch.cardsUsed[games] += 1
+        batch.turnCardsUsed[games] += 1
+
+        # Trigger events after card used
+        self._trigger_effects_for_phase("afterCardUsed", batch, games)
+        if card["type"] == "active":
+            self._trigger_effects_for_phase("afterActiveCardUsed", batch, games)
+        elif card["type"] == "mental":
+            self._trigger_effects_for_phase("afterMentalCardUsed", batch, games)
+
+        # Reset usedCard variables
+        batch.usedCardId[games] = np.nan
+        batch.cardEffects = []
+
+        # Send card to discards or remove
+        card_ids = np.full(len(indices), card["id"])
+        if card["limit"]:
+            batch.removedCardIds.push(indices, card_ids)
+        else:
+            batch.discardedCardIds.push(indices, card_ids)
+
+        # End turn if no card uses left
+        ending = games & (batch.cardUsesRemaining < 1)
+        if ending.any():
+            self.end_turn(batch, ending)
+
+        return batch
+
+    @np.errstate(all="ignore")
+    def end_turn(self, batch, games):
+        # Recover stamina if turn ended by player
+        recovering = games & (batch.cardUsesRemaining > 0)
+        batch.stamina[recovering] = np.minimum(
+            batch.stamina[recovering] + 2, self.idol_config.params["stamina"]
+        )
+
+        self._trigger_effects_for_phase("endOfTurn", batch, games)
+
+        # Reduce buff turns
+        for key in EOT_DECREMENT_FIELDS:
+            decrementing = games
+            if key in batch.fresh_buffs:
+                fresh = batch.fresh_buffs[key] & games
+                batch.fresh_buffs[key][fresh] = False
+                decrementing = games & ~fresh
+            values = getattr(batch, key)
+            values[decrementing] = np.maximum(values[decrementing] - 1, 0)
+
+        self._reduce_score_buff_turns(batch, games)
+
+        # Reset one turn buffs
+        batch.cardUsesRemaining[games] = 0
+        batch.turnCardsUsed[games] = 0
+
+        # Decrement effect ttl and expire
+        ttls = batch.effect_ttls[games]
+        batch.effect_ttls[games] = np.maximum(ttls - 1, -1)
+
+        # Discard hand
+        indices = np.flatnonzero(games)
+        batch.handCardIds.move_all_to(indices, batch.discardedCardIds)
+
+        batch.turnsElapsed[games] += 1
+        batch.turnsRemaining[games] -= 1
+
+        # Start next turn
+        continuing = games & (batch.turnsRemaining > 0)
+        if continuing.any():
+            self._start_turn(batch, continuing)
+
+        return batch
+
+    def _start_turn(self, batch, games):
+        indices = np.flatnonzero(games)
+        turn_indices = np.minimum(
+            batch.turnsElapsed[indices], self.stage_config.turn_count - 1
+        ).astype(np.int64)
+        batch.turnType[indices] = batch.turnTypes[indices, turn_indices]
+
+        # Draw cards
+        for i in range(0, 3):
+            self._draw_card(batch, indices)
+
+        # Draw more cards if turn 1 and >3 forceInitialHand
+        first_turn = indices[batch.turnsElapsed[indices] == 0]
+        for i in range(0, 2):
+            if len(first_turn) and batch.deckCardIds.sizes[first_turn].min() < 1:
+                raise IndexError(
+                    "Deck is empty while drawing forced initial hand cards"
+                )
+            forced = self.card_force_initial_hand[batch.deckCardIds.peek(first_turn)]
+            self._draw_card(batch, first_turn[forced])
+
+        batch.cardUsesRemaining[games] = 1
+        self._trigger_effects_for_phase("startOfTurn", batch, games)
+
+    def _draw_card(self, batch, indices):
+        indices = indices[batch.handCardIds.sizes[indices] < 5]
+        empty = batch.deckCardIds.sizes[indices] == 0
+        if empty.any():
+            no_discards = batch.discardedCardIds.sizes[indices] == 0
+            self._recycle_discards(batch, indices[empty & ~no_discards])
+            indices = indices[~(empty & no_discards)]
+        batch.handCardIds.push(indices, batch.deckCardIds.pop(indices))
+
+    def _recycle_discards(self, batch, indices):
+        for game in indices:
+            deck_card_ids = batch.discardedCardIds.get(game)
+            batch.rngs[game].shuffle(deck_card_ids)
+            batch.deckCardIds.set(game, deck_card_ids)
+            batch.discardedCardIds.sizes[game] = 0
+
+    def _upgrade_hand(self, batch, indices):
+        hand = batch.handCardIds.ids[indices]
+        in_hand = np.arange(hand.shape[1]) < batch.handCardIds.sizes[indices, None]
+        batch.handCardIds.ids[indices] = hand + (in_hand & self.card_upgradable[hand])
+
+    def _exchange_hand(self, batch, indices):
+        num_cards = batch.handCardIds.sizes[indices].copy()
+        batch.handCardIds.move_all_to(indices, batch.discardedCardIds)
+        for i in range(0, num_cards.max(initial=0)):
+            self._draw_card(batch, indices[num_cards > i])
+
+    def _add_random_upgraded_card_to_hand(self, batch, indices):
+        valid_base_cards = self.engine._get_random_upgraded_card_pool()
+        card_ids = [batch.rngs[game].choice(valid_base_cards)["id"] for game in indices]
+        batch.handCardIds.push(indices, np.array(card_ids, dtype=np.int64))
+
+    def _set_score_buff(self, batch, games, amount, turns=None):
+        turns = PERMANENT if turns is None else turns
+        matching = batch.score_buff_active & (batch.score_buff_turns == turns)
+        existing = games & matching.any(axis=1)
+        if existing.any():
+            indices = np.flatnonzero(existing)
+            slots = np.argmax(matching[indices], axis=1)
+            batch.score_buff_amounts[indices, slots] += amount
+
+        adding = np.flatnonzero(games & ~existing)
+        if len(adding):
+            slots = batch.score_buff_counts[adding]
+            batch._reserve_score_buffs(slots.max() + 1)
+            batch.score_buff_amounts[adding, slots] = amount
+            batch.score_buff_turns[adding, slots] = turns
+            batch.score_buff_fresh[adding, slots] = batch.phase != "startOfTurn"
+            batch.score_buff_active[adding, slots] = True
+            batch.score_buff_counts[adding] += 1
+
+    def _reduce_score_buff_turns(self, batch, games):
+        rows = games[:, None] & batch.score_buff_active
+        fresh = rows & batch.score_buff_fresh
+        decrementing = rows & ~batch.score_buff_fresh & (batch.score_buff_turns > 0)
+        batch.score_buff_fresh[fresh] = False
+        batch.score_buff_turns[decrementing] -= 1
+
+        expired = rows & (batch.score_buff_turns == 0)
+        if not expired.any():
+            return
+        batch.score_buff_active[expired] = False
+        batch.score_buff_amounts[expired] = 0
+
+        # Compact active buffs to the front, keeping their order
+        order = np.argsort(~batch.score_buff_active, axis=1, kind="stable")
+        for name in (
+            "score_buff_amounts",
+            "score_buff_turns",
+            "score_buff_fresh",
+            "score_buff_active",
+        ):
+            setattr(batch, name, np.take_along_axis(getattr(batch, name), order, 1))
+        batch.score_buff_counts = batch.score_buff_active.sum(axis=1)
+
+    def _get_template_id(self, effect):
+        key = repr(effect)
+        template_id = self.template_ids.get(key)
+        if template_id is None:
+            template_id = len(self.templates)
+            variables = set()
+            for condition in effect.get("conditions", []):
+                variables |= get_condition_variables(condition)
+            self.templates.append({**effect, "variables": variables})
+            self.template_ids[key] = template_id
+            self.template_orders = np.append(
+                self.template_orders, effect.get("order", 0)
+            )
+        return template_id
+
+    def _set_effects(self, batch, games, source_type, source_id, effects):
+        for i in range(0, len(effects)):
+            effect = effects[i].copy()
+            if not effect["actions"] and i < len(effects) - 1:
+                i += 1
+                effect["effects"] = [effects[i]]
+            self._register_effect(
+                batch,
+                games,
+                {**effect, "sourceType": source_type, "sourceId": source_id},
+            )
+
+    def _register_effect(self, batch, games, effect):
+        template_id = self._get_template_id(effect)
+        indices = np.flatnonzero(games)
+        if not len(indices):
+            return
+
+        instances = batch.effect_counts[indices]
+        batch._reserve_effects(instances.max() + 1)
+        batch.effect_templates[indices, instances] = template_id
+        batch.effect_limits[indices, instances] = effect.get("limit", np.nan)
+        batch.effect_ttls[indices, instances] = effect.get("ttl", np.nan)
+        batch.effect_counts[indices] += 1
+
+        phase = effect["phase"]
+        if phase not in batch.phase_effects:
+            batch.phase_effects[phase] = PhaseEffects(batch.num_games)
+        phase_effects = batch.phase_effects[phase]
+
+        sizes = phase_effects.sizes[indices]
+        width = phase_effects.entries.shape[1]
+        if sizes.max() + 1 > width:
+            entries = np.full((batch.num_games, 2 * width), -1, dtype=np.int64)
+            entries[:, :width] = phase_effects.entries
+            phase_effects.entries = entries
+            width *= 2
+
+        # Insert after entries with the same or lower order
+        rows = phase_effects.entries[indices]
+        columns = np.arange(width)
+        filled = columns < sizes[:, None]
+        row_templates = np.take_along_axis(
+            batch.effect_templates[indices], np.maximum(rows, 0), 1
+        )
+        orders = np.where(filled, self.template_orders[row_templates], np.inf)
+        positions = (orders <= effect.get("order", 0)).sum(axis=1)
+
+        shifted = np.where(columns > positions[:, None], np.roll(rows, 1, axis=1), rows)
+        shifted[np.arange(len(indices)), positions] = instances
+        phase_effects.entries[indices] = shifted
+        phase_effects.sizes[indices] += 1
+
+    def _trigger_effects_for_phase(self, phase, batch, games):
+        phase_effects = batch.phase_effects.get(phase)
+        if phase_effects is None:
+            return
+        games = games & (phase_effects.sizes > 0)
+        if not games.any():
+            return
+
+        parent_phase = batch.phase
+        batch.phase = phase
+
+        # Snapshot the phase's effects as they are before any of them run
+        entries = phase_effects.entries.copy()
+        num_entries = phase_effects.sizes[games].max()
+        instances = np.maximum(entries[:, :num_entries], 0)
+        rows = np.arange(batch.num_games)[:, None]
+        templates = batch.effect_templates[rows, instances]
+        limits = batch.effect_limits[rows, instances]
+        ttls = batch.effect_ttls[rows, instances]
+
+        columns = []
+        for i in range(0, num_entries):
+            in_column = games & (phase_effects.sizes > i)
+            column = []
+            for template_id in np.unique(templates[in_column, i]):
+                column.append(
+                    (
+                        self.templates[template_id],
+                        in_column & (templates[:, i] == template_id),
+                    )
+                )
+            columns.append(column)
+
+        triggered = self._trigger_effects(
+            columns, batch, games, limits=limits, ttls=ttls
+        )
+
+        batch.phase = parent_phase
+
+        for i in range(0, num_entries):
+            decrementing = np.flatnonzero(triggered[:, i])
+            if not len(decrementing):
+                continue
+            instance = instances[decrementing, i]
+            limit = batch.effect_limits[decrementing, instance]
+            has_limit = ~np.isnan(limit) & (limit != 0)
+            batch.effect_limits[decrementing[has_limit], instance[has_limit]] -= 1
+
+    def _trigger_card_effects(self, card, batch, games):
+        columns = [[(effect, games)] for effect in card["effects"]]
+        self._trigger_effects(columns, batch, games, source_id=card["id"])
+
+    # columns[i] lists (effect, games) pairs for the i-th effect each game
+    # runs. For registered effects, limits and ttls hold each game's
+    # snapshot of the i-th effect's limit and ttl.
+    def _trigger_effects(
+        self, columns, batch, games, limits=None, ttls=None, source_id=None
+    ):
+        registered = limits is not None
+
+        variables = set()
+        for column in columns:
+            for effect, _ in column:
+                if registered:
+                    variables |= effect["variables"]
+                else:
+                    for condition in effect.get("conditions", []):
+                        variables |= get_condition_variables(condition)
+        prev_state = batch.snapshot(variables)
+
+        triggered = np.zeros((batch.num_games, len(columns)), dtype=bool)
+        skip_next_effect = np.zeros(batch.num_games, dtype=bool)
+
+        for i, column in enumerate(columns):
+            # Skip effect if condition is not satisfied
+            skipped = skip_next_effect.copy()
+            skip_next_effect[:] = False
+
+            for effect, effect_games in column:
+                effect_games = effect_games & ~skipped
+                if not effect_games.any():
+                    continue
+
+                if not registered and effect.get("phase"):
+                    self._register_effect(
+                        batch,
+                        effect_games,
+                        {
+                            **effect,
+                            "sourceType": "skillCardEffect",
+                            "sourceId": source_id,
+                        },
+                    )
+                    continue
+
+                # Check limit and ttl
+                if registered:
+                    effect_games = effect_games & ~(limits[:, i] < 1)
+                    effect_games = effect_games & ~(ttls[:, i] < 0)
+                else:
+                    if "limit" in effect and effect["limit"] < 1:
+                        continue
+                    if "ttl" in effect and effect["ttl"] < 0:
+                        continue
+
+                # Check conditions
+                if "conditions" in effect:
+                    satisfied = effect_games.copy()
+                    for condition in effect["conditions"]:
+                        satisfied &= self._evaluate_condition(condition, prev_state)
+                    unsatisfied = effect_games & ~satisfied
+                    if unsatisfied.any() and not effect["actions"]:
+                        skip_next_effect |= unsatisfied
+                    effect_games = satisfied
+
+                if not effect_games.any():
+                    continue
+
+                # Execute actions
+                if "actions" in effect:
+                    self._execute_actions(effect["actions"], batch, effect_games)
+
+                    # Reset modifiers
+                    batch.concentrationMultiplier[effect_games] = 1
+                    batch.motivationMultiplier[effect_games] = 1
+
+                # Set effects
+                if "effects" in effect:
+                    self._set_effects(
+                        batch,
+                        effect_games,
+                        effect["sourceType"],
+                        effect["sourceId"],
+                        effect["effects"],
+                    )
+
+                triggered[:, i] |= effect_games
+
+        return triggered
+
+    def _evaluate_condition(self, condition, state):
+        result = compile_condition(condition)(state)
+        if result is None:
+            return False
+        if isinstance(result, np.ndarray):
+            return result.astype(bool)
+        return bool(result)
+
+    def _execute_actions(self, actions, batch, games):
+        prev = {key: getattr(batch, key).copy() for key in TRIGGER_DIFF_FIELDS}
+
+        for action in actions:
+            self._execute_action(action, batch, games)
+            batch.stamina[games & (batch.stamina < 0)] = 0
+
+        # Protect fresh states from decrement. This mirrors the key that
+        # Engine._execute_actions marks in freshBuffs.
+        if batch.phase not in ["startOfStage", "startOfTurn"]:
+            for key in EOT_DECREMENT_FIELDS:
+                fresh = games & (getattr(batch, key) > 0) & (prev[key] == 0)
+                if fresh.any():
+                    if "key" not in batch.fresh_buffs:
+                        batch.fresh_buffs["key"] = np.zeros(batch.num_games, bool)
+                    batch.fresh_buffs["key"] |= fresh
+
+        # Trigger increase effects
+        for key in INCREASE_TRIGGER_FIELDS:
+            if batch.phase == f"{key}Increased":
+                continue
+            increased = games & (getattr(batch, key) > prev[key])
+            if increased.any():
+                self._trigger_effects_for_phase(f"{key}Increased", batch, increased)
+
+        # Trigger decrease effects
+        for key in DECREASE_TRIGGER_FIELDS:
+            if batch.phase == f"{key}Decreased":
+                continue
+            decreased = games & (getattr(batch, key) > prev[key])
+            if decreased.any():
+                self._trigger_effects_for_phase(f"{key}Decreased", batch, decreased)
+
+    def _execute_action(self, action, batch, games):
+        compiled = compile_action(action)
+
+        # Non-assignment actions
+        if compiled.kind == "call":
+            indices = np.flatnonzero(games)
+            if compiled.target == "drawCard":
+                self._draw_card(batch, indices)
+            elif compiled.target.startswith("setScoreBuff"):
+                self._set_score_buff(batch, games, *compiled.args)
+            elif compiled.target == "upgradeHand":
+                self._upgrade_hand(batch, indices)
+            elif compiled.target == "exchangeHand":
+                self._exchange_hand(batch, indices)
+            elif compiled.target == "addRandomUpgradedCardToHand":
+                self._add_random_upgraded_card_to_hand(batch, indices)
+            return
+
+        if compiled.kind != "assign":
+            print("Invalid action", action)
+            return
+
+        lhs = compiled.target
+        op = compiled.op
+        rhs = compiled.expression(batch)
+
+        if lhs in DEBUFF_FIELDS:
+            nullified = games & (batch.nullifyDebuff != 0)
+            batch.nullifyDebuff[nullified] -= 1
+            games = games & ~nullified
+
+        if lhs == "score" and op == "+=":
+            lhs = "intermediateScore"
+        elif lhs == "genki" and op == "+=":
+            lhs = "intermediateGenki"
+        elif lhs == "stamina" and op == "-=":
+            lhs = "intermediateStamina"
+
+        if op == "=" and lhs not in SCALAR_FIELD_SET and lhs not in batch.extras:
+            batch.extras[lhs] = np.full(batch.num_games, np.nan)
+        values = batch.get_field(lhs)
+
+        if op == "=":
+            result = rhs
+        elif op == "+=":
+            result = values + rhs
+        elif op == "-=":
+            result = values - rhs
+        elif op == "*=":
+            result = values * rhs
+        elif op == "/=":
+            result = values / rhs
+        elif op == "%=":
+            result = values % rhs
+        else:
+            print("Unrecognized assignment operator", op)
+            result = values
+        np.copyto(values, result, where=games)
+
+        if lhs == "cost":
+            cost = batch.cost.copy()
+            cost = np.where(batch.halfCostTurns != 0, cost * 0.5, cost)
+            cost = np.where(batch.doubleCostTurns != 0, cost * 2, cost)
+            cost = np.ceil(cost)
+            cost += batch.costReduction
+            cost -= batch.costIncrease
+            cost = np.minimum(cost, 0)
+
+            batch.genki[games] += cost[games]
+            batch.cost[games] = 0
+            overflow = games & (batch.genki < 0)
+            batch.stamina[overflow] += batch.genki[overflow]
+            batch.genki[overflow] = 0
+        elif lhs == "intermediateStamina":
+            stamina = batch.intermediateStamina.copy()
+            stamina = np.where(batch.halfCostTurns != 0, stamina * 0.5, stamina)
+            stamina = np.where(batch.doubleCostTurns != 0, stamina * 2, stamina)
+            stamina = np.ceil(stamina)
+            stamina = np.where(
+                stamina <= 0,
+                np.minimum(stamina + batch.costReduction - batch.costIncrease, 0),
+                stamina,
+            )
+            batch.stamina[games] += stamina[games]
+            batch.intermediateStamina[games] = 0
+        elif lhs == "intermediateScore":
+            score = batch.intermediateScore.copy()
+            scoring = score > 0
+
+            # Apply concentration
+            score = np.where(
+                scoring,
+                score + batch.concentration * batch.concentrationMultiplier,
+                score,
+            )
+
+            # Apply good and perfect condition
+            condition_multiplier = 1.5 + np.where(
+                batch.perfectConditionTurns != 0, batch.goodConditionTurns * 0.1, 0
+            )
+            score = np.where(
+                scoring & (batch.goodConditionTurns != 0),
+                score * condition_multiplier,
+                score,
+            )
+
+            # Score buff effects, summed in buff order
+            buff_amount = np.zeros(batch.num_games)
+            for i in range(0, batch.score_buff_amounts.shape[1]):
+                buff_amount = buff_amount + batch.score_buff_amounts[:, i]
+            score = np.where(scoring, np.ceil(score * (1 + buff_amount)), score)
+
+            # Turn type multiplier
+            type_multiplier = np.select(
+                [batch.turnType == t for t in TURN_TYPES], self.type_multipliers, 1
+            )
+            score = np.where(scoring, np.ceil(score * type_multiplier), score)
+
+            batch.score[games] += score[games]
+            batch.intermediateScore[games] = 0
+        elif lhs == "intermediateGenki":
+            genki = batch.intermediateGenki.copy()
+
+            # Apply motivation
+            genki += batch.motivation * batch.motivationMultiplier
+
+            genki = np.where(batch.nullifyGenkiTurns != 0, 0, genki)
+
+            batch.genki[games] += genki[games]
+            batch.intermediateGenki[games] = 0
+        elif lhs == "fixedGenki":
+            batch.genki[games] += batch.fixedGenki[games]
+            batch.fixedGenki[games] = 0
+        elif lhs == "fixedStamina":
+            batch.stamina[games] += batch.fixedStamina[games]
+            batch.fixedStamina[games] = 0
+
+        for key in WHOLE_FIELDS:
+            values = getattr(batch, key)
+            np.ceil(values, out=values, where=games)
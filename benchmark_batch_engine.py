@@ -0,0 +1,83 @@
+import random
+import time
+
+import numpy as np
+
+from batch_engine import BatchEngine
+from engine import Engine
+from game_data.stages import Stages
+from idol_config import IdolConfig
+from logger import NullLogger
+from stage_config import StageConfig
+
+
+NUM_SCALAR_GAMES = 200
+NUM_BATCH_GAMES = 4096
+
+
+def play_scalar(stage_config, idol_config, seed):
+    engine = Engine(stage_config, idol_config, NullLogger(), False, random.Random(seed))
+    state = engine.start_stage(engine.get_initial_state())
+    while state.turnsRemaining > 0:
+        usable = engine.usable_mask(state)
+        card_ids = [c for c, u in zip(state.handCardIds, usable) if u]
+        if card_ids:
+            state = engine.use_card(state, card_ids[0])
+        else:
+            state = engine.end_turn(state)
+    return state.score
+
+
+def play_batch(stage_config, idol_config, seeds):
+    engine = BatchEngine(stage_config, idol_config)
+    batch = engine.start_stage(engine.get_initial_state(seeds))
+    hand = batch.handCardIds
+    while (batch.turnsRemaining > 0).any():
+        # Uses the first usable card in hand, as in play_scalar
+        choices = np.zeros(batch.num_games, dtype=np.int64)
+        live = batch.turnsRemaining > 0
+        for slot in range(hand.ids.shape[1] - 1, -1, -1):
+            card_ids = np.where(hand.sizes > slot, hand.ids[:, slot], 0)
+            for card_id in np.unique(card_ids[live & (card_ids != 0)]):
+                usable = (card_ids == card_id) & engine.is_card_usable(
+                    batch, int(card_id)
+                )
+                choices[usable] = card_id
+        engine.step(batch, choices)
+    return batch.score
+
+
+# Compares games/sec of Engine and BatchEngine on a sample loadout, with a
+# policy that uses the first usable card
+def main():
+    stage = Stages.get_by_id(26)
+    stage_config = StageConfig(stage)
+    idol_config = IdolConfig(
+        params=[1009, 1422, 1474, 47],
+        support_bonus=0.023,
+        p_item_ids=[47, 75, 71],
+        skill_card_id_groups=[
+            [223, 45, 122, 125, 136, 181],
+            [223, 45, 291, 96, 297, 179],
+        ],
+        stage=stage,
+        fallback_plan="logic",
+        fallback_idol_id=3,
+    )
+
+    start = time.perf_counter()
+    for seed in range(NUM_SCALAR_GAMES):
+        play_scalar(stage_config, idol_config, seed)
+    scalar_rate = NUM_SCALAR_GAMES / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    play_batch(stage_config, idol_config, range(NUM_BATCH_GAMES))
+    batch_rate = NUM_BATCH_GAMES / (time.perf_counter() - start)
+
+    print("Engine: {:.0f} games/sec".format(scalar_rate))
+    print("BatchEngine: {:.0f} games/sec".format(batch_rate))
+    print("Speedup: {:.1f}x".format(batch_rate / scalar_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import math
+import operator
+import re
+from collections import namedtuple
+
+from game_state import FIELD_SET
+
+
+CONDITION_TOKEN_PATTERN = r"([=!]?=|[<>]=?|[+\-*/%]|&)"
+ACTION_TOKEN_PATTERN = r"([=!]?=|[<>]=?|[+\-*/%]=?|&)"
+
+NUMBER_PATTERN = re.compile(r"^-?[\d]+(\.\d+)?$")
+COMPARATOR_PATTERN = re.compile(r"[=!]=|[<>]=?")
+ADD_SUBTRACT_PATTERN = re.compile(r"[+\-]")
+MULTIPLY_DIVIDE_PATTERN = re.compile(r"[*/%]")
+ASSIGNMENT_PATTERN = re.compile(r"[+\-*/%]?=")
+
+COMPARATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+ADD_SUBTRACT_OPERATORS = {
+    "+": operator.add,
+    "-": operator.sub,
+}
+
+MULTIPLY_DIVIDE_OPERATORS = {
+    "*": operator.mul,
+    "/": operator.truediv,
+    "%": operator.mod,
+}
+
+TURN_TYPE_VARIABLES = {
+    "isVocalTurn": "vocal",
+    "isDanceTurn": "dance",
+    "isVisualTurn": "visual",
+}
+
+# kind is one of "call" (e.g. drawCard), "assign" (e.g. score+=5) or "invalid".
+# target is the first token of the action, which is also what cardEffects
+# records for the card that performed it.
+Action = namedtuple("Action", ["kind", "target", "op", "expression", "args"])
+
+compiled_conditions = {}
+compiled_actions = {}
+
+
+def compile_condition(condition):
+    compiled = compiled_conditions.get(condition)
+    if compiled is None:
+        compiled = compile_expression(re.split(CONDITION_TOKEN_PATTERN, condition))
+        compiled_conditions[condition] = compiled
+    return compiled
+
+
+# Names of the state fields a condition reads, used to snapshot only those
+# fields before effects run
+def get_condition_variables(condition):
+    tokens = re.split(CONDITION_TOKEN_PATTERN, condition)
+    operands = [tokens[0]] if "&" in tokens else tokens[0::2]
+
+    variables = set()
+    for operand in operands:
+        if NUMBER_PATTERN.search(operand):
+            continue
+        if operand in TURN_TYPE_VARIABLES:
+            variables.add("turnType")
+        else:
+            variables.add(operand)
+    return variables
+
+
+def compile_action(action):
+    compiled = compiled_actions.get(action)
+    if compiled is None:
+        compiled = _compile_action(action)
+        compiled_actions[action] = compiled
+    return compiled
+
+
+def _compile_action(action):
+    tokens = re.split(ACTION_TOKEN_PATTERN, action)
+
+    # Non-assignment actions
+    if len(tokens) == 1:
+        args = ()
+        if tokens[0].startswith("setScoreBuff"):
+            args = tuple(float(m) for m in re.findall(r"[\d\.]+", tokens[0]))
+        return Action("call", tokens[0], None, None, args)
+
+    # Assignments
+    assign_index = next(
+        (i for i, t in enumerate(tokens) if ASSIGNMENT_PATTERN.search(t)), -1
+    )
+    if assign_index == 1:
+        return Action(
+            "assign", tokens[0], tokens[1], compile_expression(tokens[2:]), ()
+        )
+
+    return Action("invalid", tokens[0], None, None, ())
+
+
+# Amounts that cost actions of the form field-=number subtract from each of
+# fields, with NaN for fields they do not touch. Returns None if there is
+# any other kind of action, or more than one per field.
+def compile_cost_vector(actions, fields):
+    vector = [math.nan] * len(fields)
+    for action in actions:
+        tokens = re.split(ACTION_TOKEN_PATTERN, action)
+        if (
+            len(tokens) != 3
+            or tokens[1] != "-="
+            or tokens[0] not in fields
+            or not NUMBER_PATTERN.search(tokens[2])
+        ):
+            return None
+        index = fields.index(tokens[0])
+        if not math.isnan(vector[index]):
+            return None
+        vector[index] = float(tokens[2])
+    return tuple(vector)
+
+
+def compile_variable(name):
+    if name in TURN_TYPE_VARIABLES:
+        turn_type = TURN_TYPE_VARIABLES[name]
+        return lambda state: state.turnType == turn_type
+    if name in FIELD_SET:
+        return operator.attrgetter(name)
+    return operator.itemgetter(name)
+
+
+# Compiles a token list into a function of the state. Operator precedence
+# and associativity follow the original recursive evaluator: comparators
+# first, then add/subtract, then multiply/divide, each split on the first
+# occurrence of the operator.
+def compile_expression(tokens):
+    if len(tokens) == 1:
+        # Numeric constants
+        if NUMBER_PATTERN.search(tokens[0]):
+            value = float(tokens[0])
+            return lambda state: value
+
+        # Variables
+        return compile_variable(tokens[0])
+
+    # Set contains
+    if "&" in tokens:
+        if len(tokens) != 3:
+            print("Invalid set contains")
+        get_set = compile_variable(tokens[0])
+        member = tokens[2]
+        return lambda state: member in get_set(state)
+
+    for pattern, operators in (
+        (COMPARATOR_PATTERN, COMPARATORS),
+        (ADD_SUBTRACT_PATTERN, ADD_SUBTRACT_OPERATORS),
+        (MULTIPLY_DIVIDE_PATTERN, MULTIPLY_DIVIDE_OPERATORS),
+    ):
+        index = next((i for i, t in enumerate(tokens) if pattern.search(t)), -1)
+        if index == -1:
+            continue
+        op = operators.get(tokens[index])
+        if op is None:
+            print("Unrecognized operator", tokens[index])
+            continue
+        return _compile_binary(
+            op,
+            compile_expression(tokens[:index]),
+            compile_expression(tokens[index + 1 :]),
+        )
+
+    return lambda state: None
+
+
+def _compile_binary(op, lhs, rhs):
+    return lambda state: op(lhs(state), rhs(state))
@@ -12,6 +12,10 @@ COST_FIELDS = [
     "motivation",
 ]
 
+# Fields of skill card cost vectors. Amounts for "cost" are paid from genki,
+# then stamina.
+COST_VECTOR_FIELDS = ["cost", *COST_FIELDS]
+
 EOT_DECREMENT_FIELDS = [
     "goodConditionTurns",
     "perfectConditionTurns",
@@ -24,39 +24,53 @@
 
 
 import random
-from collections import deque
+import time
 
 import gymnasium as gym
-import matplotlib.pyplot as plt
 import numpy as np
-import tensorflow as tf
 from gymnasium.envs.registration import register
-from tensorflow import keras
 
-from game_data.skill_cards import SkillCards
+from replay_buffer import ReplayBuffer
+from vector_env import GakumasVectorEnv
 
 
-register(
-    id="Gakumas-v0",
-    entry_point="gakumas_env:GakumasEnv",
-    max_episode_steps=300,
-)
+ENV_ID = "Gakumas-v0"
 
-env = gym.make("Gakumas-v0")
+# Hand slots keep the network's outputs to the few cards that can be in hand
+ACTION_MODE = "hand_slot"
 
 RANDOM_SEED = 69
-random.seed(RANDOM_SEED)
-tf.random.set_seed(RANDOM_SEED)
-np.random.seed(RANDOM_SEED)
 
-print("Action Space: {}".format(env.action_space))
-print("State space: {}".format(env.observation_space))
+# Environments stepped in parallel, with actions for all picked in one batch
+NUM_ENVS = 4
+
+# Samples transitions with large TD errors more often
+PRIORITIZED_REPLAY = False
 
 train_episodes = 1200
 test_episodes = 100
 
 
+def make_env():
+    if ENV_ID not in gym.envs.registry:
+        register(
+            id=ENV_ID,
+            entry_point="gakumas_env:GakumasEnv",
+            max_episode_steps=300,
+        )
+    return gym.make(ENV_ID, action_mode=ACTION_MODE)
+
+
+# Steps num_envs environments in worker processes
+def make_vector_env(num_envs):
+    return GakumasVectorEnv([make_env] * num_envs)
+
+
 def agent(state_shape, action_shape):
+    # TensorFlow takes seconds to import, so it is only imported for training
+    import tensorflow as tf
+    from tensorflow import keras
+
     learning_rate = 3e-4
     init = tf.keras.initializers.HeUniform()
     model = keras.Sequential()
@@ -77,11 +91,49 @@ def agent(state_shape, action_shape):
     return model
 
 
-def get_qs(model, state, step):
-    return model.predict(state.reshape([1, state.shape[0]]))[0]
+# Compiles the model's forward pass, which avoids the per-call overhead of
+# model.predict on the small batches used for acting and training. Returns
+# a function from a batch of observations to a NumPy array of Q-values.
+def compile_forward(model):
+    import tensorflow as tf
+
+    @tf.function(
+        input_signature=[tf.TensorSpec([None, *model.input_shape[1:]], tf.float32)]
+    )
+    def forward(x):
+        return model(x, training=False)
+
+    return lambda x: forward(tf.convert_to_tensor(x, dtype=tf.float32)).numpy()
 
 
-def train(env, replay_memory, model, target_model, done):
+def get_qs(forward, state, step):
+    return forward(state.reshape([1, state.shape[0]]))[0]
+
+
+# Picks an action for each environment. Ending the turn (action 0) is only
+# picked when no card is usable. Otherwise a random usable card is picked
+# with probability epsilon, or else the usable card with the highest
+# Q-value, with Q-values of all environments predicted in one batch.
+def select_actions(forward, observations, action_masks, epsilon):
+    card_masks = action_masks.copy()
+    card_masks[:, 0] = False
+    has_cards = card_masks.any(axis=1)
+    explore = np.random.rand(len(observations)) <= epsilon
+
+    actions = np.zeros(len(observations), dtype=np.int64)
+    for i in np.flatnonzero(explore & has_cards):
+        actions[i] = random.choice(np.flatnonzero(card_masks[i]))
+
+    greedy = ~explore & has_cards
+    if greedy.any():
+        predicted = forward(observations[greedy])
+        actions[greedy] = np.where(card_masks[greedy], predicted, -np.inf).argmax(
+            axis=1
+        )
+    return actions
+
+
+def train(replay_memory, model, forward, target_forward):
     learning_rate = 0.7
     discount_factor = 0.618
 
@@ -90,110 +142,119 @@ def train(env, replay_memory, model, target_model, done):
         return
 
     batch_size = 64 * 2
-    mini_batch = random.sample(replay_memory, batch_size)
-    current_states = np.array([transition[0] for transition in mini_batch])
-    current_qs_list = model.predict(current_states)
-    new_current_states = np.array([transition[3] for transition in mini_batch])
-    future_qs_list = target_model.predict(new_current_states)
-
-    X = []
-    Y = []
-    for index, (observation, action, reward, new_observation, done) in enumerate(
-        mini_batch
-    ):
-        if not done:
-            max_future_q = reward + discount_factor * np.max(future_qs_list[index])
-        else:
-            max_future_q = reward
-
-        current_qs = current_qs_list[index]
-        current_qs[action] = (1 - learning_rate) * current_qs[
-            action
-        ] + learning_rate * max_future_q
-
-        X.append(observation)
-        Y.append(current_qs)
-    model.fit(np.array(X), np.array(Y), batch_size=batch_size, verbose=0, shuffle=True)
+    (
+        current_states,
+        actions,
+        rewards,
+        new_current_states,
+        dones,
+        indices,
+        weights,
+    ) = replay_memory.sample(batch_size)
+
+    current_qs = forward(current_states)
+    future_qs = target_forward(new_current_states)
+    max_future_qs = rewards + discount_factor * future_qs.max(axis=1) * ~dones
+
+    rows = np.arange(batch_size)
+    replay_memory.update_priorities(indices, max_future_qs - current_qs[rows, actions])
+    current_qs[rows, actions] = (1 - learning_rate) * current_qs[
+        rows, actions
+    ] + learning_rate * max_future_qs
+
+    model.fit(
+        current_states,
+        current_qs,
+        sample_weight=weights,
+        batch_size=batch_size,
+        verbose=0,
+        shuffle=True,
+    )
 
 
 def main():
+    import matplotlib.pyplot as plt
+    import tensorflow as tf
+
+    envs = make_vector_env(NUM_ENVS)
+
+    random.seed(RANDOM_SEED)
+    tf.random.set_seed(RANDOM_SEED)
+    np.random.seed(RANDOM_SEED)
+
+    print("Action Space: {}".format(envs.single_action_space))
+    print("State space: {}".format(envs.single_observation_space))
+
     epsilon = 1
     max_epsilon = 1
     min_epsilon = 0.01
     decay = 0.01
 
-    model = agent(env.observation_space.shape, env.action_space.n)
-    target_model = agent(env.observation_space.shape, env.action_space.n)
+    model = agent(envs.single_observation_space.shape, envs.single_action_space.n)
+    target_model = agent(
+        envs.single_observation_space.shape, envs.single_action_space.n
+    )
     target_model.set_weights(model.get_weights())
-
-    replay_memory = deque(maxlen=50_000)
+    # set_weights assigns to the same variables, so the compiled target
+    # forward pass sees updated weights
+    forward = compile_forward(model)
+    target_forward = compile_forward(target_model)
+
+    replay_memory = ReplayBuffer(
+        50_000,
+        envs.single_observation_space.shape,
+        NUM_ENVS,
+        prioritized=PRIORITIZED_REPLAY,
+        seed=RANDOM_SEED,
+    )
 
     rewards = []
 
     steps_to_update_target_model = 0
+    total_training_rewards = np.zeros(NUM_ENVS)
+    episode = 0
+    num_steps = 0
+    start_time = time.perf_counter()
+
+    observations, infos = envs.reset(seed=RANDOM_SEED)
+    while episode < train_episodes:
+        steps_to_update_target_model += 1
+
+        actions = select_actions(forward, observations, infos["action_mask"], epsilon)
+        new_observations, step_rewards, terminated, truncated, infos = envs.step(
+            actions
+        )
+        dones = terminated | truncated
+        num_steps += NUM_ENVS
 
-    for episode in range(train_episodes):
-        total_training_rewards = 0
-        observation = env.reset(seed=RANDOM_SEED)[0]
-        done = False
-
-        while not done:
-            steps_to_update_target_model += 1
-            if True:
-                env.render()
-
-            random_number = np.random.rand()
-
-            legal_actions = list(
-                c
-                for c in env.game_state["handCardIds"]
-                if env.engine.is_card_usable(env.game_state, c)
-            )
-
-            if len(legal_actions) == 0:
-                action = None
-            elif random_number <= epsilon:
-                action = random.choice(legal_actions)
-            else:
-                encoded = observation
-                encoded_reshaped = np.reshape(
-                    encoded, [1, env.observation_space.shape[0]]
-                )
-                predicted = model.predict(encoded_reshaped).flatten()
-
-                legal_action_mask = np.zeros(len(SkillCards.get_all()))
-                legal_action_mask[legal_actions] = 1
-
-                masked_action = predicted * legal_action_mask
-                action = masked_action.argmax()
-
-            new_observation, reward, terminated, truncated, info = env.step(action)
-            done = terminated or truncated
-            replay_memory.append([observation, action, reward, new_observation, done])
+        replay_memory.add(observations, actions, step_rewards, dones)
 
-            if steps_to_update_target_model % 4 == 0 or done:
-                train(env, replay_memory, model, target_model, done)
+        if steps_to_update_target_model % 4 == 0 or dones.any():
+            train(replay_memory, model, forward, target_forward)
 
-            observation = new_observation
-            total_training_rewards += reward
+        observations = new_observations
+        total_training_rewards += step_rewards
 
-            if done:
-                print(
-                    "Total training rewards: {} after n steps = {} with final reward = {}".format(
-                        total_training_rewards, episode, reward
-                    )
+        for i in np.flatnonzero(dones):
+            print(
+                "Total training rewards: {} after n steps = {} with final reward = {}".format(
+                    total_training_rewards[i], episode, step_rewards[i]
                 )
-                rewards.append(total_training_rewards)
-                total_training_rewards += 1
+            )
+            rewards.append(total_training_rewards[i])
+            total_training_rewards[i] = 0
+            episode += 1
+            epsilon = min_epsilon + (max_epsilon - min_epsilon) * np.exp(
+                -decay * episode
+            )
 
-                if steps_to_update_target_model >= 100:
-                    print("Copying main network weights to the target network weights")
-                    target_model.set_weights(model.get_weights())
-                    steps_to_update_target_model = 0
-                break
+        if dones.any() and steps_to_update_target_model >= 100:
+            print("Copying main network weights to the target network weights")
+            target_model.set_weights(model.get_weights())
+            steps_to_update_target_model = 0
 
-        epsilon = min_epsilon + (max_epsilon - min_epsilon) * np.exp(-decay * episode)
-    env.close()
+    print("Steps/sec: {:.1f}".format(num_steps / (time.perf_counter() - start_time)))
+    envs.close()
 
     plt.figure(figsize=(10, 6))
     plt.plot(rewards, label="Q-learning Train")
@@ -1,5 +1,8 @@
 import re
 
+from compiler import compile_action
+from compiler import compile_condition
+
 
 def deserialize_effect(effect_string):
     if not len(effect_string):
@@ -15,10 +18,12 @@ def deserialize_effect(effect_string):
             if not "conditions" in effect:
                 effect["conditions"] = []
             effect["conditions"].append(value)
+            compile_condition(value)
         elif key == "do":
             if not "actions" in effect:
                 effect["actions"] = []
             effect["actions"].append(value)
+            compile_action(value)
         elif key == "order":
             effect["order"] = int(value)
         elif key == "limit":
@@ -1,8 +1,12 @@
-import copy
+import bisect
 import math
+import operator
 import random
-import re
 
+import numpy as np
+
+from compiler import compile_action
+from compiler import compile_condition
 from constants import COST_FIELDS
 from constants import DEBUFF_FIELDS
 from constants import WHOLE_FIELDS
@@ -12,6 +16,7 @@ from constants import DECREASE_TRIGGER_FIELDS
 from constants import EOT_DECREMENT_FIELDS
 from game_data.p_items import PItems
 from game_data.skill_cards import SkillCards
+from game_state import GameState
 
 
 KEYS_TO_DIFF = list(
@@ -25,82 +30,149 @@ KEYS_TO_DIFF = list(
     )
 )
 
+get_keys_to_diff = operator.attrgetter(*KEYS_TO_DIFF)
+
+# Fields that trigger effects when changed, diffed when logging is disabled
+TRIGGER_KEYS_TO_DIFF = list(
+    set(
+        [
+            *INCREASE_TRIGGER_FIELDS,
+            *DECREASE_TRIGGER_FIELDS,
+            *EOT_DECREMENT_FIELDS,
+        ]
+    )
+)
+
+get_trigger_keys_to_diff = operator.attrgetter(*TRIGGER_KEYS_TO_DIFF)
+
+DEFAULT_EFFECTS = [
+    {
+        "phase": "endOfTurn",
+        "conditions": ["goodImpressionTurns>=1"],
+        "actions": ["score+=goodImpressionTurns"],
+        "order": 100,
+    }
+]
+
+
+# Changes made to a state by Engine.apply: the previous values of the fields
+# it replaced, the previous extra keys and the random state before it ran
+class UndoRecord:
+    __slots__ = ("fields", "extra", "owned", "random_state")
+
+    def __init__(self, fields, extra, owned, random_state):
+        self.fields = fields
+        self.extra = extra
+        self.owned = owned
+        self.random_state = random_state
+
+
+# Stands in for the engine's random generator during Engine.apply, saving
+# the generator's state the first time it is used. Saving it costs more
+# than most actions, and only some actions draw random numbers.
+class _RandomRecorder:
+    __slots__ = ("random", "state")
+
+    def __init__(self, rng):
+        self.random = rng
+        self.state = None
+
+    def __getattr__(self, name):
+        if self.state is None:
+            self.state = self.random.getstate()
+        return getattr(self.random, name)
+
 
 class Engine:
-    def __init__(self, stage_config, idol_config, logger, debug):
+    def __init__(self, stage_config, idol_config, logger, debug, rng=None):
         self.stage_config = stage_config
         self.idol_config = idol_config
         self.logger = logger
         self.debug = debug
+        # Source of randomness for shuffles, turn types and random cards.
+        # Pass a random.Random to make games reproducible; defaults to the
+        # shared stream of the random module.
+        self.random = rng or random
+        self.random_upgraded_card_pool = None
 
     def get_initial_state(self):
-        deck_card_ids = self.idol_config.skill_card_ids
-        random.shuffle(deck_card_ids)
-        deck_card_ids = sorted(
+        deck_card_ids = self._shuffle_initial_deck()
+
+        return GameState(
+            {
+                "started": False,
+                "turnTypes": self._generate_turn_types(),
+                # General
+                "turnsElapsed": 0,
+                "turnsRemaining": self.stage_config.turn_count,
+                "cardUsesRemaining": 0,
+                "maxStamina": self.idol_config.params["stamina"],
+                "fixedStamina": 0,
+                "intermediateStamina": 0,
+                "stamina": self.idol_config.params["stamina"],
+                "fixedGenki": 0,
+                "intermediateGenki": 0,
+                "genki": 0,
+                "cost": 0,
+                "intermediateScore": 0,
+                "score": 0,
+                "clearRatio": 0,
+                # Skill card piles
+                "deckCardIds": deck_card_ids,
+                "handCardIds": [],
+                "discardedCardIds": [],
+                "removedCardIds": [],
+                "cardsUsed": 0,
+                "turnCardsUsed": 0,
+                # Phase effects
+                "phase": None,
+                "effects": [],
+                # Effect indices by phase, sorted by (order, index)
+                "effectsByPhase": {},
+                # Number of effects in effects that can no longer trigger
+                "expiredEffects": 0,
+                # Buffs and debuffs
+                "goodConditionTurns": 0,
+                "perfectConditionTurns": 0,
+                "concentration": 0,
+                "goodImpressionTurns": 0,
+                "motivation": 0,
+                "halfCostTurns": 0,
+                "doubleCostTurns": 0,
+                "costReduction": 0,
+                "costIncrease": 0,
+                "doubleCardEffectCards": 0,
+                "nullifyGenkiTurns": 0,
+                "nullifyDebuff": 0,
+                # Score buffs
+                "scoreBuffs": [],
+                # Used card
+                "usedCardId": None,
+                "cardEffects": [],
+                # Buffs/debuffs protected from decrement when fresh
+                "freshBuffs": {},
+                # Effect modifiers
+                "concentrationMultiplier": 1,
+                "motivationMultiplier": 1,
+            }
+        )
+
+    # Cards that are forced into the initial hand go last, to be drawn first
+    def _shuffle_initial_deck(self):
+        deck_card_ids = list(self.idol_config.skill_card_ids)
+        self.random.shuffle(deck_card_ids)
+        return sorted(
             deck_card_ids,
             key=lambda id: 1 if SkillCards.get_by_id(id)["forceInitialHand"] else 0,
         )
 
-        return {
-            "started": False,
-            "turnTypes": self._generate_turn_types(),
-            # General
-            "turnsElapsed": 0,
-            "turnsRemaining": self.stage_config.turn_count,
-            "cardUsesRemaining": 0,
-            "maxStamina": self.idol_config.params["stamina"],
-            "fixedStamina": 0,
-            "intermediateStamina": 0,
-            "stamina": self.idol_config.params["stamina"],
-            "fixedGenki": 0,
-            "intermediateGenki": 0,
-            "genki": 0,
-            "cost": 0,
-            "intermediateScore": 0,
-            "score": 0,
-            "clearRatio": 0,
-            # Skill card piles
-            "deckCardIds": deck_card_ids,
-            "handCardIds": [],
-            "discardedCardIds": [],
-            "removedCardIds": [],
-            "cardsUsed": 0,
-            "turnCardsUsed": 0,
-            # Phase effects
-            "phase": None,
-            "effects": [],
-            # Buffs and debuffs
-            "goodConditionTurns": 0,
-            "perfectConditionTurns": 0,
-            "concentration": 0,
-            "goodImpressionTurns": 0,
-            "motivation": 0,
-            "halfCostTurns": 0,
-            "doubleCostTurns": 0,
-            "costReduction": 0,
-            "costIncrease": 0,
-            "doubleCardEffectCards": 0,
-            "nullifyGenkiTurns": 0,
-            "nullifyDebuff": 0,
-            # Score buffs
-            "scoreBuffs": [],
-            # Used card
-            "usedCardId": None,
-            "cardEffects": [],
-            # Buffs/debuffs protected from decrement when fresh
-            "freshBuffs": {},
-            # Effect modifiers
-            "concentrationMultiplier": 1,
-            "motivationMultiplier": 1,
-        }
-
     def _generate_turn_types(self):
         turn_counts = self.stage_config.turn_counts
         first_turns = self.stage_config.first_turns
         criteria = self.stage_config.criteria
         remaining_turns = turn_counts.copy()
 
-        rand = random.random()
+        rand = self.random.random()
         first_turn = "vocal"
         if rand > first_turns["vocal"]:
             first_turn = "dance"
@@ -120,7 +192,7 @@ class Engine:
 
         random_turns = []
         while len(turn_pool):
-            index = math.floor(random.random() * len(turn_pool))
+            index = math.floor(self.random.random() * len(turn_pool))
             turn = turn_pool[index]
             turn_pool = turn_pool[:index] + turn_pool[index + 1 :]
             random_turns.append(turn)
@@ -128,31 +200,41 @@ class Engine:
         return [first_turn] + random_turns + last_three_turns
 
     def start_stage(self, state):
-        if self.debug and state["started"]:
+        if self.debug and state.started:
             raise Exception("Stage already started!")
 
         self.logger.clear()
 
-        next_state = copy.deepcopy(state)
-        next_state["started"] = True
+        next_state = self._set_stage_effects(state)
+        return self._begin_stage(next_state)
+
+    # State at the start of a stage, before its deck is shuffled and its turn
+    # types are drawn, for start_stage_from_template. Setting effects does
+    # not depend on either, so it only needs to be done once per loadout.
+    def get_stage_template(self):
+        return self._set_stage_effects(self.get_initial_state())
+
+    # Same as start_stage(get_initial_state()), drawing the same random
+    # numbers, but starts from a template from get_stage_template
+    def start_stage_from_template(self, template):
+        state = template.copy()
+        state.deckCardIds = self._shuffle_initial_deck()
+        state.turnTypes = self._generate_turn_types()
+
+        self.logger.clear()
+
+        return self._begin_stage(state)
+
+    def _set_stage_effects(self, state):
+        next_state = state.copy()
+        next_state.started = True
 
         # Set default effects
-        next_state = self._set_effects(
-            next_state,
-            "default",
-            "好印象",
-            [
-                {
-                    "phase": "endOfTurn",
-                    "conditions": ["goodImpressionTurns>=1"],
-                    "actions": ["score+=goodImpressionTurns"],
-                    "order": 100,
-                }
-            ],
-        )
+        next_state = self._set_effects(next_state, "default", "好印象", DEFAULT_EFFECTS)
 
         # Set stage effects
-        self.logger.debug("Setting stage effects", self.stage_config.effects)
+        if self.logger.debug_enabled:
+            self.logger.debug("Setting stage effects", self.stage_config.effects)
         next_state = self._set_effects(
             next_state,
             "stage",
@@ -163,11 +245,15 @@ class Engine:
         # Set p-item effects
         for id in self.idol_config.p_item_ids:
             p_item = PItems.get_by_id(id)
-            self.logger.debug(
-                "Setting p-item effects", p_item["name"], p_item["effects"]
-            )
+            if self.logger.debug_enabled:
+                self.logger.debug(
+                    "Setting p-item effects", p_item["name"], p_item["effects"]
+                )
             next_state = self._set_effects(next_state, "pItem", id, p_item["effects"])
 
+        return next_state
+
+    def _begin_stage(self, next_state):
         next_state = self._trigger_effects_for_phase("startOfStage", next_state)
 
         self.logger.push_graph_data(next_state)
@@ -185,51 +271,168 @@ class Engine:
                 return False
 
         # Check cost
+        if card["costVector"] is not None:
+            return self._can_pay_cost(state, card["costVector"])
+
         preview_state = state.copy()
         for cost in card["cost"]:
             preview_state = self._execute_action(cost, preview_state)
         for field in COST_FIELDS:
-            if preview_state[field] < 0:
+            if getattr(preview_state, field) < 0:
+                return False
+
+        return True
+
+    # Same as applying the cost actions to a copy of the state and checking
+    # COST_FIELDS, but from the card's precomputed cost vector. Columns are
+    # "cost" followed by COST_FIELDS, starting with stamina. Cost fields are
+    # whole fields, so they are already whole unless changed by the cost.
+    def _can_pay_cost(self, state, cost_vector):
+        cost, stamina_cost, *field_costs = cost_vector
+        stamina = state.stamina
+
+        # Pay cost from genki, then stamina
+        if not math.isnan(cost):
+            cost = -cost
+            if state.halfCostTurns:
+                cost *= 0.5
+            if state.doubleCostTurns:
+                cost *= 2
+            cost = min(math.ceil(cost) + state.costReduction - state.costIncrease, 0)
+            genki = state.genki + cost
+            if genki < 0:
+                stamina = math.ceil(stamina + genki)
+
+        # Pay stamina cost
+        if not math.isnan(stamina_cost):
+            stamina_cost = -stamina_cost
+            if state.halfCostTurns:
+                stamina_cost *= 0.5
+            if state.doubleCostTurns:
+                stamina_cost *= 2
+            stamina_cost = math.ceil(stamina_cost)
+            if stamina_cost <= 0:
+                stamina_cost += state.costReduction
+                stamina_cost -= state.costIncrease
+                stamina_cost = min(stamina_cost, 0)
+            stamina = math.ceil(stamina + stamina_cost)
+
+        if stamina < 0:
+            return False
+        for field, amount in zip(COST_FIELDS[1:], field_costs):
+            if math.isnan(amount):
+                if getattr(state, field) < 0:
+                    return False
+            elif math.ceil(getattr(state, field) - amount) < 0:
                 return False
 
         return True
 
+    # Checks whether each of card_ids, by default the cards in hand, can be
+    # used. Costs are checked for all cards at once from their precomputed
+    # cost vectors, and falls back to is_card_usable for cards without one.
+    def usable_mask(self, state, card_ids=None):
+        if card_ids is None:
+            card_ids = state.handCardIds
+
+        # Checking one card at a time is faster for hand-sized inputs
+        if len(card_ids) <= 8:
+            return np.array(
+                [self.is_card_usable(state, card_id) for card_id in card_ids],
+                dtype=bool,
+            )
+
+        card_ids = np.asarray(card_ids, dtype=np.int64)
+        cost_vectors, has_cost_vector = SkillCards.get_cost_vectors()
+        # Columns are "cost" followed by COST_FIELDS, starting with stamina
+        costs = cost_vectors[card_ids]
+
+        # Pay cost from genki, then stamina
+        cost = -costs[:, 0]
+        if state.halfCostTurns:
+            cost = cost * 0.5
+        if state.doubleCostTurns:
+            cost = cost * 2
+        cost = np.minimum(np.ceil(cost) + state.costReduction - state.costIncrease, 0)
+        genki = state.genki + cost
+        stamina = state.stamina + np.where(genki < 0, genki, 0)
+
+        # Pay stamina cost
+        stamina_cost = -costs[:, 1]
+        if state.halfCostTurns:
+            stamina_cost = stamina_cost * 0.5
+        if state.doubleCostTurns:
+            stamina_cost = stamina_cost * 2
+        stamina_cost = np.ceil(stamina_cost)
+        stamina_cost = np.where(
+            stamina_cost <= 0,
+            np.minimum(stamina_cost + state.costReduction - state.costIncrease, 0),
+            stamina_cost,
+        )
+        stamina = np.ceil(stamina + np.nan_to_num(stamina_cost))
+
+        # Cost fields are whole fields, so they are already whole unless
+        # changed by the cost
+        usable = stamina >= 0
+        for i, field in enumerate(COST_FIELDS):
+            if field == "stamina":
+                continue
+            remaining = getattr(state, field) - np.nan_to_num(costs[:, i + 1])
+            usable &= np.ceil(remaining) >= 0
+
+        # Check conditions
+        for i, card_id in enumerate(card_ids.tolist()):
+            if not has_cost_vector[card_id]:
+                usable[i] = self.is_card_usable(state, card_id)
+                continue
+            if not usable[i]:
+                continue
+            for condition in SkillCards.get_by_id(card_id)["compiledConditions"]:
+                if not condition(state):
+                    usable[i] = False
+                    break
+
+        return usable
+
     def use_card(self, state, card_id):
         if self.debug:
-            if not state["started"]:
+            if not state.started:
                 raise Exception("Stage not started!")
-            if state["cardUsesRemaining"] < 1:
+            if state.cardUsesRemaining < 1:
                 raise Exception("No card uses remaining!")
-            if state["turnsRemaining"] < 1:
+            if state.turnsRemaining < 1:
                 raise Exception("No turns remaining!")
-            if card_id not in state["handCardIds"]:
+            if card_id not in state.handCardIds:
                 raise Exception("Card is not in hand!")
             if not self.is_card_usable(state, card_id):
                 raise Exception("Card is not usable!")
 
-        hand_index = state["handCardIds"].index(card_id)
+        hand_index = state.handCardIds.index(card_id)
         card = SkillCards.get_by_id(card_id)
 
-        next_state = copy.deepcopy(state)
+        next_state = state.copy()
 
-        self.logger.debug("Using card", card_id, card["name"])
-        self.logger.log("entityStart", {"type": "skillCard", "id": card_id})
+        if self.logger.debug_enabled:
+            self.logger.debug("Using card", card_id, card["name"])
+        if self.logger.log_enabled:
+            self.logger.log("entityStart", {"type": "skillCard", "id": card_id})
 
         # Set usedCard variables
-        next_state["_usedCardId"] = card["id"]
-        next_state["usedCardId"] = card["id"] - 1 if card["upgraded"] else card["id"]
-        next_state["cardEffects"] = self._get_card_effects(card)
+        next_state._usedCardId = card["id"]
+        next_state.usedCardId = card["id"] - 1 if card["upgraded"] else card["id"]
+        next_state.cardEffects = self._get_card_effects(card)
 
         # Apply card cost
-        self.logger.debug("Applying cost", card["cost"])
+        if self.logger.debug_enabled:
+            self.logger.debug("Applying cost", card["cost"])
         next_state = self._execute_actions(card["cost"], next_state)
 
         # Remove card from hand
-        next_state["handCardIds"] = (
-            next_state["handCardIds"][:hand_index]
-            + next_state["handCardIds"][hand_index + 1 :]
+        next_state.handCardIds = (
+            next_state.handCardIds[:hand_index]
+            + next_state.handCardIds[hand_index + 1 :]
         )
-        next_state["cardUsesRemaining"] -= 1
+        next_state.cardUsesRemaining -= 1
 
         # Trigger events on card used
         next_state = self._trigger_effects_for_phase("cardUsed", next_state)
@@ -239,13 +442,13 @@ class Engine:
             next_state = self._trigger_effects_for_phase("mentalCardUsed", next_state)
 
         # Apply card effects
-        if next_state["doubleCardEffectCards"]:
-            next_state["doubleCardEffectCards"] -= 1
+        if next_state.doubleCardEffectCards:
+            next_state.doubleCardEffectCards -= 1
             next_state = self._trigger_effects(card["effects"], next_state)
         next_state = self._trigger_effects(card["effects"], next_state)
 
-        next_state["cardsUsed"] += 1
-        next_state["turnCardsUsed"] += 1
+        next_state.cardsUsed += 1
+        next_state.turnCardsUsed += 1
 
         # Trigger events after card used
         next_state = self._trigger_effects_for_phase("afterCardUsed", next_state)
@@ -259,191 +462,258 @@ class Engine:
             )
 
         # Reset usedCard variables
-        next_state["_usedCardId"] = None
-        next_state["usedCardId"] = None
-        next_state["cardEffects"] = []
+        next_state._usedCardId = None
+        next_state.usedCardId = None
+        next_state.cardEffects = []
 
-        self.logger.log("entityEnd", {"type": "skillCard", "id": card_id})
+        if self.logger.log_enabled:
+            self.logger.log("entityEnd", {"type": "skillCard", "id": card_id})
 
         # Send card to discards or remove
         if card["limit"]:
-            next_state["removedCardIds"].append(card["id"])
+            next_state.writable("removedCardIds").append(card["id"])
         else:
-            next_state["discardedCardIds"].append(card["id"])
+            next_state.writable("discardedCardIds").append(card["id"])
 
         # End turn if no card uses left
-        if next_state["cardUsesRemaining"] < 1:
+        if next_state.cardUsesRemaining < 1:
             next_state = self.end_turn(next_state)
 
         return next_state
 
     def end_turn(self, state):
         if self.debug:
-            if not state["started"]:
+            if not state.started:
                 raise Exception("Stage not started!")
-            if state["turnsRemaining"] < 1:
+            if state.turnsRemaining < 1:
                 raise Exception("No turns remaining!")
 
         # Recover stamina if turn ended by player
-        if state["cardUsesRemaining"] > 0:
-            state["stamina"] = min(
-                state["stamina"] + 2, self.idol_config.params["stamina"]
-            )
+        if state.cardUsesRemaining > 0:
+            state.stamina = min(state.stamina + 2, self.idol_config.params["stamina"])
 
         state = self._trigger_effects_for_phase("endOfTurn", state)
 
         # Reduce buff turns
         for key in EOT_DECREMENT_FIELDS:
-            if key in state["freshBuffs"]:
-                del state["freshBuffs"][key]
+            if key in state.freshBuffs:
+                del state.writable("freshBuffs")[key]
             else:
-                state[key] = max(state[key] - 1, 0)
+                setattr(state, key, max(getattr(state, key) - 1, 0))
 
         # Reduce score buff turns
-        for i in range(0, len(state["scoreBuffs"])):
-            if state["scoreBuffs"][i]["fresh"]:
-                state["scoreBuffs"][i]["fresh"] = False
-            elif state["scoreBuffs"][i]["turns"]:
-                state["scoreBuffs"][i]["turns"] -= 1
-        state["scoreBuffs"] = [b for b in state["scoreBuffs"] if b["turns"] != 0]
+        score_buffs = []
+        for buff in state.scoreBuffs:
+            if buff["fresh"]:
+                buff = {**buff, "fresh": False}
+            elif buff["turns"]:
+                buff = {**buff, "turns": buff["turns"] - 1}
+            if buff["turns"] != 0:
+                score_buffs.append(buff)
+        state.scoreBuffs = score_buffs
 
         # Reset one turn buffs
-        state["cardUsesRemaining"] = 0
-        state["turnCardsUsed"] = 0
+        state.cardUsesRemaining = 0
+        state.turnCardsUsed = 0
 
         # Decrement effect ttl and expire
-        for i in range(0, len(state["effects"])):
-            if state["effects"][i].get("ttl") == None:
+        for i in range(0, len(state.effects)):
+            effect = state.effects[i]
+            if effect.get("ttl") == None:
                 continue
-            state["effects"][i]["ttl"] = max(state["effects"][i]["ttl"] - 1, -1)
+            state = self._update_effect(
+                state, i, {**effect, "ttl": max(effect["ttl"] - 1, -1)}
+            )
+        state = self._remove_expired_effects(state)
 
         # Discard hand
-        state["discardedCardIds"] += state["handCardIds"]
-        state["handCardIds"] = []
+        state.writable("discardedCardIds").extend(state.handCardIds)
+        state.handCardIds = []
 
-        state["turnsElapsed"] += 1
-        state["turnsRemaining"] -= 1
+        state.turnsElapsed += 1
+        state.turnsRemaining -= 1
 
         self.logger.push_graph_data(state)
 
         # Start next turn
-        if state["turnsRemaining"] > 0:
+        if state.turnsRemaining > 0:
             state = self._start_turn(state)
 
         return state
 
+    # Uses a card, or ends the turn if card_id is None, updating state in
+    # place instead of returning a new state. Returns an UndoRecord that
+    # undo() uses to restore the state, so a search can walk the game tree
+    # with one state and a stack of records instead of a state per node.
+    #
+    # Containers are never modified in place once replaced, so the record
+    # only needs references to the previous ones.
+    def apply(self, state, card_id):
+        rng = self.random
+        self.random = recorder = _RandomRecorder(rng)
+        try:
+            if card_id is None:
+                next_state = self.end_turn(state.copy())
+            else:
+                next_state = self.use_card(state, card_id)
+        finally:
+            self.random = rng
+
+        record = UndoRecord(
+            state.assign(next_state), state._extra, state._owned, recorder.state
+        )
+        state._extra = next_state._extra
+        state._owned = None
+        return record
+
+    # Reverts the changes in an UndoRecord from apply. Records must be undone
+    # in the reverse order they were applied.
+    def undo(self, state, record):
+        for field, value in record.fields:
+            setattr(state, field, value)
+        state._extra = record.extra
+        state._owned = record.owned
+        if record.random_state is not None:
+            self.random.setstate(record.random_state)
+
+    def get_effect_counts(self, state):
+        return {
+            "live": len(state.effects) - state.expiredEffects,
+            "expired": state.expiredEffects,
+        }
+
     def _start_turn(self, state):
-        self.logger.debug("Starting turn", state["turnsElapsed"] + 1)
+        if self.logger.debug_enabled:
+            self.logger.debug("Starting turn", state.turnsElapsed + 1)
 
-        state["turnType"] = state["turnTypes"][
-            min(state["turnsElapsed"], self.stage_config.turn_count - 1)
+        state.turnType = state.turnTypes[
+            min(state.turnsElapsed, self.stage_config.turn_count - 1)
         ]
 
-        self.logger.log(
-            "startTurn",
-            {
-                "num": state["turnsElapsed"] + 1,
-                "type": state["turnType"],
-                "multiplier": self.idol_config.type_multipliers[state["turnType"]],
-            },
-        )
+        if self.logger.log_enabled:
+            self.logger.log(
+                "startTurn",
+                {
+                    "num": state.turnsElapsed + 1,
+                    "type": state.turnType,
+                    "multiplier": self.idol_config.type_multipliers[state.turnType],
+                },
+            )
 
         # Draw cards
         for i in range(0, 3):
             state = self._draw_card(state)
 
         # Draw more cards if turn 1 and >3 forceInitialHand
-        if state["turnsElapsed"] == 0:
+        if state.turnsElapsed == 0:
             for i in range(0, 2):
                 if SkillCards.get_by_id(self._peek_deck(state))["forceInitialHand"]:
                     state = self._draw_card(state)
 
-        state["cardUsesRemaining"] = 1
+        state.cardUsesRemaining = 1
         state = self._trigger_effects_for_phase("startOfTurn", state)
 
         return state
 
     def _peek_deck(self, state):
-        return state["deckCardIds"][-1]
+        return state.deckCardIds[-1]
 
     def _draw_card(self, state):
-        if len(state["handCardIds"]) >= 5:
+        if len(state.handCardIds) >= 5:
             return state
-        if not len(state["deckCardIds"]):
-            if not len(state["discardedCardIds"]):
+        if not len(state.deckCardIds):
+            if not len(state.discardedCardIds):
                 return state
             state = self._recycle_discards(state)
-        card_id = state["deckCardIds"].pop()
-        state["handCardIds"].append(card_id)
-        self.logger.debug("Drew card", SkillCards.get_by_id(card_id)["name"])
-        self.logger.log("drawCard", {"type": "skillCard", "id": card_id})
+        card_id = state.writable("deckCardIds").pop()
+        state.writable("handCardIds").append(card_id)
+        if self.logger.debug_enabled:
+            self.logger.debug("Drew card", SkillCards.get_by_id(card_id)["name"])
+        if self.logger.log_enabled:
+            self.logger.log("drawCard", {"type": "skillCard", "id": card_id})
         return state
 
     def _recycle_discards(self, state):
-        state["deckCardIds"] = state["discardedCardIds"]
-        random.shuffle(state["deckCardIds"])
-        state["discardedCardIds"] = []
-        self.logger.debug("Recycled discard pile")
+        state.deckCardIds = state.discardedCardIds
+        self.random.shuffle(state.writable("deckCardIds"))
+        state.discardedCardIds = []
+        if self.logger.debug_enabled:
+            self.logger.debug("Recycled discard pile")
         return state
 
     def _upgrade_hand(self, state):
-        for i in range(0, len(state["handCardIds"])):
-            card = SkillCards.get_by_id(state["handCardIds"][i])
+        hand_card_ids = state.writable("handCardIds")
+        for i in range(0, len(hand_card_ids)):
+            card = SkillCards.get_by_id(hand_card_ids[i])
             if not card["upgraded"] and card["type"] != "trouble":
-                state["handCardIds"][i] += 1
-        self.logger.log("upgradeHand")
+                hand_card_ids[i] += 1
+        if self.logger.log_enabled:
+            self.logger.log("upgradeHand")
         return state
 
     def _exchange_hand(self, state):
-        num_cards = len(state["handCardIds"])
-        state["discardedCardIds"] += state["handCardIds"]
-        state["handCardIds"] = []
+        num_cards = len(state.handCardIds)
+        state.writable("discardedCardIds").extend(state.handCardIds)
+        state.handCardIds = []
         for i in range(0, num_cards):
             state = self._draw_card(state)
         return state
 
+    # Upgraded produce cards of the idol's plan or free, found on first use
+    def _get_random_upgraded_card_pool(self):
+        if self.random_upgraded_card_pool is None:
+            self.random_upgraded_card_pool = [
+                s
+                for s in SkillCards.get_filtered(
+                    rarities=["R", "SR", "SSR"],
+                    plans=[self.idol_config.plan, "free"],
+                    source_types=["produce"],
+                )
+                if s["upgraded"]
+            ]
+        return self.random_upgraded_card_pool
+
     def _add_random_upgraded_card_to_hand(self, state):
-        valid_base_cards = [
-            s
-            for s in SkillCards.get_filtered(
-                rarities=["R", "SR", "SSR"],
-                plans=[self.idol_config.plan, "free"],
-                source_types=["produce"],
+        valid_base_cards = self._get_random_upgraded_card_pool()
+        random_card = self.random.choice(valid_base_cards)
+        state.writable("handCardIds").append(random_card["id"])
+        if self.logger.log_enabled:
+            self.logger.log(
+                "addRandomUpgradedCardToHand",
+                {
+                    "type": "skillCard",
+                    "id": random_card["id"],
+                },
             )
-            if s["upgraded"]
-        ]
-        random_card = random.choice(valid_base_cards)
-        state["handCardIds"].append(random_card["id"])
-        self.logger.log(
-            "addRandomUpgradedCardToHand",
-            {
-                "type": "skillCard",
-                "id": random_card["id"],
-            },
-        )
         return state
 
     def _set_score_buff(self, state, amount, turns=None):
         existing_buff_index = next(
-            (i for i, b in enumerate(state["scoreBuffs"]) if b["turns"] == turns), -1
+            (i for i, b in enumerate(state.scoreBuffs) if b["turns"] == turns), -1
         )
         if existing_buff_index != -1:
-            state["scoreBuffs"][existing_buff_index]["amount"] += amount
+            score_buffs = state.writable("scoreBuffs")
+            existing_buff = score_buffs[existing_buff_index]
+            score_buffs[existing_buff_index] = {
+                **existing_buff,
+                "amount": existing_buff["amount"] + amount,
+            }
         else:
-            state["scoreBuffs"].append(
+            state.writable("scoreBuffs").append(
                 {
                     "amount": amount,
                     "turns": turns,
-                    "fresh": state["phase"] != "startOfTurn",
+                    "fresh": state.phase != "startOfTurn",
                 }
             )
-        self.logger.log(
-            "setScoreBuff",
-            {
-                "amount": amount,
-                "turns": turns,
-            },
-        )
+        if self.logger.log_enabled:
+            self.logger.log(
+                "setScoreBuff",
+                {
+                    "amount": amount,
+                    "turns": turns,
+                },
+            )
         return state
 
     def _get_card_effects(self, card):
@@ -452,10 +722,10 @@ class Engine:
             if "phase" in effect or "actions" not in effect:
                 continue
             for action in effect["actions"]:
-                tokens = re.split(r"([=!]?=|[<>]=?|[+\-*/%]=?|&)", action)
-                if not len(tokens) or not len(tokens[0]):
+                target = compile_action(action).target
+                if not len(target):
                     continue
-                card_effects.append(tokens[0])
+                card_effects.append(target)
         return card_effects
 
     def _set_effects(self, state, source_type, source_id, effects):
@@ -464,46 +734,110 @@ class Engine:
             if not effect["actions"] and i < len(effects) - 1:
                 i += 1
                 effect["effects"] = [effects[i]]
-            state["effects"].append(
-                {**effect, "sourceType": source_type, "sourceId": source_id}
+            state = self._register_effect(
+                state, {**effect, "sourceType": source_type, "sourceId": source_id}
             )
         return state
 
-    def _trigger_effects_for_phase(self, phase, state):
-        parent_phase = state["phase"]
-        state["phase"] = phase
+    def _register_effect(self, state, effect):
+        effects = state.writable("effects")
+        effects.append(effect)
+        if self._is_effect_expired(effect):
+            state.expiredEffects += 1
+
+        # Keep the phase's effects in trigger order so that triggering a
+        # phase does not need to scan or sort all effects
+        effects_by_phase = state.writable("effectsByPhase")
+        phase_entries = list(effects_by_phase.get(effect["phase"], ()))
+        bisect.insort(phase_entries, (effect.get("order", 0), len(effects) - 1))
+        effects_by_phase[effect["phase"]] = tuple(phase_entries)
+
+        return state
+
+    def _update_effect(self, state, index, effect):
+        if self._is_effect_expired(effect) and not self._is_effect_expired(
+            state.effects[index]
+        ):
+            state.expiredEffects += 1
+        state.writable("effects")[index] = effect
+        return state
+
+    def _is_effect_expired(self, effect):
+        if "limit" in effect and effect["limit"] < 1:
+            return True
+        if "ttl" in effect and effect["ttl"] < 0:
+            return True
+        return False
+
+    # Expired effects never trigger again, so drop them to keep later turns
+    # from scanning and copying them
+    def _remove_expired_effects(self, state):
+        if not state.expiredEffects:
+            return state
 
-        phase_effects = []
-        for i in range(0, len(state["effects"])):
-            effect = state["effects"][i]
-            if effect["phase"] != phase:
+        effects = []
+        new_indices = {}
+        for i in range(0, len(state.effects)):
+            effect = state.effects[i]
+            if self._is_effect_expired(effect):
                 continue
-            phase_effects.append(
-                {
-                    **effect,
-                    "phase": None,
-                    "index": i,
-                }
+            new_indices[i] = len(effects)
+            effects.append(effect)
+
+        effects_by_phase = {}
+        for phase, phase_entries in state.effectsByPhase.items():
+            phase_entries = tuple(
+                (order, new_indices[index])
+                for order, index in phase_entries
+                if index in new_indices
             )
-        phase_effects = sorted(phase_effects, key=lambda e: e.get("order", 0))
+            if phase_entries:
+                effects_by_phase[phase] = phase_entries
+
+        state.effects = effects
+        state.effectsByPhase = effects_by_phase
+        state.expiredEffects = 0
+
+        return state
+
+    def _trigger_effects_for_phase(self, phase, state):
+        phase_entries = state.effectsByPhase.get(phase)
+        if not phase_entries:
+            return state
 
-        self.logger.debug(phase, phase_effects)
+        parent_phase = state.phase
+        state.phase = phase
 
-        state = self._trigger_effects(phase_effects, state)
+        phase_effects = [state.effects[index] for _, index in phase_entries]
 
-        state["phase"] = parent_phase
+        if self.logger.debug_enabled:
+            self.logger.debug(phase, phase_effects)
 
-        for idx in state["triggeredEffects"]:
-            effect_index = phase_effects[idx]["index"]
-            if state["effects"][effect_index].get("limit"):
-                state["effects"][effect_index]["limit"] -= 1
+        state = self._trigger_effects(phase_effects, state, registered=True)
 
-        state["triggeredEffects"] = []
+        state.phase = parent_phase
+
+        for idx in state.triggeredEffects:
+            effect_index = phase_entries[idx][1]
+            effect = state.effects[effect_index]
+            if effect.get("limit"):
+                state = self._update_effect(
+                    state, effect_index, {**effect, "limit": effect["limit"] - 1}
+                )
+
+        state.triggeredEffects = []
 
         return state
 
-    def _trigger_effects(self, effects, state):
-        prevState = state.copy()
+    # Registered effects are triggered for the current phase. Otherwise,
+    # effects with a phase are set rather than triggered.
+    def _trigger_effects(self, effects, state, registered=False):
+        # Conditions are checked against the state before any effect ran.
+        # Copying makes the state copy its containers again on the next
+        # write, so it is only done when there are conditions to check.
+        prevState = None
+        if any("conditions" in effect for effect in effects):
+            prevState = state.copy()
         triggered_effects = []
         skip_next_effect = False
 
@@ -515,8 +849,9 @@ class Engine:
                 skip_next_effect = False
                 continue
 
-            if effect.get("phase"):
-                self.logger.log("setEffect")
+            if not registered and effect.get("phase"):
+                if self.logger.log_enabled:
+                    self.logger.log("setEffect")
 
                 state = self._set_effects(
                     state,
@@ -546,7 +881,7 @@ class Engine:
                         skip_next_effect = True
                     continue
 
-            if "sourceType" in effect:
+            if self.logger.log_enabled and "sourceType" in effect:
                 self.logger.log(
                     "entityStart",
                     {
@@ -557,25 +892,28 @@ class Engine:
 
             # Execute actions
             if "actions" in effect:
-                self.logger.debug("Executing actions", effect["actions"])
+                if self.logger.debug_enabled:
+                    self.logger.debug("Executing actions", effect["actions"])
 
                 state = self._execute_actions(effect["actions"], state)
 
                 # Reset modifiers
-                state["concentrationMultiplier"] = 1
-                state["motivationMultiplier"] = 1
+                state.concentrationMultiplier = 1
+                state.motivationMultiplier = 1
 
             # Set effects
             if "effects" in effect:
-                self.logger.debug("Setting effects", effect["effects"])
+                if self.logger.debug_enabled:
+                    self.logger.debug("Setting effects", effect["effects"])
 
-                self.logger.log("setEffect")
+                if self.logger.log_enabled:
+                    self.logger.log("setEffect")
 
                 state = self._set_effects(
                     state, effect["sourceType"], effect["sourceId"], effect["effects"]
                 )
 
-            if "sourceType" in effect:
+            if self.logger.log_enabled and "sourceType" in effect:
                 self.logger.log(
                     "entityEnd",
                     {"type": effect["sourceType"], "id": effect["sourceId"]},
@@ -583,168 +921,88 @@ class Engine:
 
             triggered_effects.append(i)
 
-        state["triggeredEffects"] = triggered_effects
+        state.triggeredEffects = triggered_effects
 
         return state
 
     def _evaluate_condition(self, condition, state):
-        result = self._evaluate_expression(
-            re.split(r"([=!]?=|[<>]=?|[+\-*/%]|&)", condition), state
-        )
-        self.logger.debug("Condition", condition, result)
+        result = compile_condition(condition)(state)
+        if self.logger.debug_enabled:
+            self.logger.debug("Condition", condition, result)
         return result
 
-    def _evaluate_expression(self, tokens, state):
-        variables = {
-            **state,
-            "isVocalTurn": state["turnType"] == "vocal",
-            "isDanceTurn": state["turnType"] == "dance",
-            "isVisualTurn": state["turnType"] == "visual",
-        }
-
-        def evaluate(tokens):
-            if len(tokens) == 1:
-                # Numeric constants
-                if re.search(r"^-?[\d]+(\.\d+)?$", tokens[0]):
-                    return float(tokens[0])
-
-                # Variables
-                return variables[tokens[0]]
-
-            # Set contains
-            if "&" in tokens:
-                if len(tokens) != 3:
-                    print("Invalid set contains")
-                return tokens[2] in variables[tokens[0]]
-
-            # Comparators (boolean operators)
-            cmp_index = next(
-                (i for i, t in enumerate(tokens) if re.search(r"[=!]=|[<>]=?", t)), -1
-            )
-            if cmp_index != -1:
-                lhs = evaluate(tokens[:cmp_index])
-                cmp = tokens[cmp_index]
-                rhs = evaluate(tokens[cmp_index + 1 :])
-
-                if cmp == "==":
-                    return lhs == rhs
-                elif cmp == "!=":
-                    return lhs != rhs
-                elif cmp == "<":
-                    return lhs < rhs
-                elif cmp == "<=":
-                    return lhs <= rhs
-                elif cmp == ">":
-                    return lhs > rhs
-                elif cmp == ">=":
-                    return lhs >= rhs
-                print("Unrecognized comparator", cmp)
-
-            # Add, subtract
-            as_index = next(
-                (i for i, t in enumerate(tokens) if re.search(r"[+\-]", t)), -1
-            )
-            if as_index != -1:
-                lhs = evaluate(tokens[:as_index])
-                op = tokens[as_index]
-                rhs = evaluate(tokens[as_index + 1 :])
-
-                if op == "+":
-                    return lhs + rhs
-                elif op == "-":
-                    return lhs - rhs
-                print("Unrecognized operator", op)
-
-            # Multiply, divide, modulo
-            md_index = next(
-                (i for i, t in enumerate(tokens) if re.search(r"[*/%]", t)), -1
-            )
-            if md_index != -1:
-                lhs = evaluate(tokens[:md_index])
-                op = tokens[md_index]
-                rhs = evaluate(tokens[md_index + 1 :])
-
-                if op == "*":
-                    return lhs * rhs
-                elif op == "/":
-                    return lhs / rhs
-                elif op == "%":
-                    return lhs % rhs
-                print("Unrecognized operator", op)
-
-        return evaluate(tokens)
-
     def _execute_actions(self, actions, state):
-        prev = {key: state[key] for key in KEYS_TO_DIFF}
+        log_enabled = self.logger.log_enabled
+        if log_enabled:
+            prev = dict(zip(KEYS_TO_DIFF, get_keys_to_diff(state)))
+        else:
+            prev = dict(zip(TRIGGER_KEYS_TO_DIFF, get_trigger_keys_to_diff(state)))
 
         for action in actions:
             state = self._execute_action(action, state)
-            if state["stamina"] < 0:
-                state["stamina"] = 0
+            if state.stamina < 0:
+                state.stamina = 0
 
         # Log changed fields
-        for key in LOGGED_FIELDS:
-            if state[key] != prev[key]:
-                self.logger.log(
-                    "diff",
-                    {
-                        "field": key,
-                        "prev": round(prev[key], 2),
-                        "next": round(state[key], 2),
-                    },
-                )
+        if log_enabled:
+            for key in LOGGED_FIELDS:
+                if getattr(state, key) != prev[key]:
+                    self.logger.log(
+                        "diff",
+                        {
+                            "field": key,
+                            "prev": round(prev[key], 2),
+                            "next": round(getattr(state, key), 2),
+                        },
+                    )
 
         # Protect fresh states from decrement
-        if state["phase"] not in ["startOfStage", "startOfTurn"]:
+        if state.phase not in ["startOfStage", "startOfTurn"]:
             for key in EOT_DECREMENT_FIELDS:
-                if state[key] > 0 and prev[key] == 0:
-                    state["freshBuffs"]["key"] = True
+                if getattr(state, key) > 0 and prev[key] == 0:
+                    state.writable("freshBuffs")["key"] = True
 
         # Trigger increase effects
         for key in INCREASE_TRIGGER_FIELDS:
-            if state["phase"] == f"{key}Increased":
+            if state.phase == f"{key}Increased":
                 continue
-            if state[key] > prev[key]:
+            if getattr(state, key) > prev[key]:
                 state = self._trigger_effects_for_phase(f"{key}Increased", state)
 
         # Trigger decrease effects
         for key in DECREASE_TRIGGER_FIELDS:
-            if state["phase"] == f"{key}Decreased":
+            if state.phase == f"{key}Decreased":
                 continue
-            if state[key] > prev[key]:
+            if getattr(state, key) > prev[key]:
                 state = self._trigger_effects_for_phase(f"{key}Decreased", state)
 
         return state
 
     def _execute_action(self, action, state):
-        tokens = re.split(r"([=!]?=|[<>]=?|[+\-*/%]=?|&)", action)
+        compiled = compile_action(action)
 
         # Non-assignment actions
-        if len(tokens) == 1:
-            if tokens[0] == "drawCard":
+        if compiled.kind == "call":
+            if compiled.target == "drawCard":
                 state = self._draw_card(state)
-            elif tokens[0].startswith("setScoreBuff"):
-                args = [float(m) for m in re.findall(r"[\d\.]+", tokens[0])]
-                state = self._set_score_buff(state, *args)
-            elif tokens[0] == "upgradeHand":
+            elif compiled.target.startswith("setScoreBuff"):
+                state = self._set_score_buff(state, *compiled.args)
+            elif compiled.target == "upgradeHand":
                 state = self._upgrade_hand(state)
-            elif tokens[0] == "exchangeHand":
+            elif compiled.target == "exchangeHand":
                 state = self._exchange_hand(state)
-            elif tokens[0] == "addRandomUpgradedCardToHand":
+            elif compiled.target == "addRandomUpgradedCardToHand":
                 state = self._add_random_upgraded_card_to_hand(state)
             return state
 
         # Assignments
-        assign_index = next(
-            (i for i, t in enumerate(tokens) if re.search(r"[+\-*/%]?=", t)), -1
-        )
-        if assign_index == 1:
-            lhs = tokens[0]
-            op = tokens[1]
-            rhs = self._evaluate_expression(tokens[2:], state)
+        if compiled.kind == "assign":
+            lhs = compiled.target
+            op = compiled.op
+            rhs = compiled.expression(state)
 
-            if state["nullifyDebuff"] and lhs in DEBUFF_FIELDS:
-                state["nullifyDebuff"] -= 1
+            if state.nullifyDebuff and lhs in DEBUFF_FIELDS:
+                state.nullifyDebuff -= 1
                 return state
 
             if lhs == "score" and op == "+=":
@@ -770,77 +1028,77 @@ class Engine:
                 print("Unrecognized assignment operator", op)
 
             if lhs == "cost":
-                cost = state["cost"]
-                if state["halfCostTurns"]:
+                cost = state.cost
+                if state.halfCostTurns:
                     cost *= 0.5
-                if state["doubleCostTurns"]:
+                if state.doubleCostTurns:
                     cost *= 2
                 cost = math.ceil(cost)
-                cost += state["costReduction"]
-                cost -= state["costIncrease"]
+                cost += state.costReduction
+                cost -= state.costIncrease
                 cost = min(cost, 0)
 
-                state["genki"] += cost
-                state["cost"] = 0
-                if state["genki"] < 0:
-                    state["stamina"] += state["genki"]
-                    state["genki"] = 0
+                state.genki += cost
+                state.cost = 0
+                if state.genki < 0:
+                    state.stamina += state.genki
+                    state.genki = 0
             elif lhs == "intermediateStamina":
-                stamina = state["intermediateStamina"]
-                if state["halfCostTurns"]:
+                stamina = state.intermediateStamina
+                if state.halfCostTurns:
                     stamina *= 0.5
-                if state["doubleCostTurns"]:
+                if state.doubleCostTurns:
                     stamina *= 2
                 stamina = math.ceil(stamina)
                 if stamina <= 0:
-                    stamina += state["costReduction"]
-                    stamina -= state["costIncrease"]
+                    stamina += state.costReduction
+                    stamina -= state.costIncrease
                     stamina = min(stamina, 0)
-                state["stamina"] += stamina
-                state["intermediateStamina"] = 0
+                state.stamina += stamina
+                state.intermediateStamina = 0
             elif lhs == "intermediateScore":
-                score = state["intermediateScore"]
+                score = state.intermediateScore
                 if score > 0:
                     # Apply concentration
-                    score += state["concentration"] * state["concentrationMultiplier"]
+                    score += state.concentration * state.concentrationMultiplier
 
                     # Apply good and perfect condition
-                    if state["goodConditionTurns"]:
+                    if state.goodConditionTurns:
                         score *= 1.5 + (
-                            (state["goodConditionTurns"] * 0.1)
-                            if state["perfectConditionTurns"]
+                            (state.goodConditionTurns * 0.1)
+                            if state.perfectConditionTurns
                             else 0
                         )
 
                     # Score buff effects
-                    score *= 1 + sum(b["amount"] for b in state["scoreBuffs"])
+                    score *= 1 + sum(b["amount"] for b in state.scoreBuffs)
                     score = math.ceil(score)
 
                     # Turn type multiplier
-                    score *= self.idol_config.type_multipliers[state["turnType"]]
+                    score *= self.idol_config.type_multipliers[state.turnType]
                     score = math.ceil(score)
-                state["score"] += score
-                state["intermediateScore"] = 0
+                state.score += score
+                state.intermediateScore = 0
             elif lhs == "intermediateGenki":
-                genki = state["intermediateGenki"]
+                genki = state.intermediateGenki
 
                 # Apply motivation
-                genki += state["motivation"] * state["motivationMultiplier"]
+                genki += state.motivation * state.motivationMultiplier
 
-                if state["nullifyGenkiTurns"]:
+                if state.nullifyGenkiTurns:
                     genki = 0
 
-                state["genki"] += genki
-                state["intermediateGenki"] = 0
+                state.genki += genki
+                state.intermediateGenki = 0
             elif lhs == "fixedGenki":
-                state["genki"] += state["fixedGenki"]
-                state["fixedGenki"] = 0
+                state.genki += state.fixedGenki
+                state.fixedGenki = 0
             elif lhs == "fixedStamina":
-                state["stamina"] += state["fixedStamina"]
-                state["fixedStamina"] = 0
+                state.stamina += state.fixedStamina
+                state.fixedStamina = 0
 
             for key in WHOLE_FIELDS:
-                state[key] = math.ceil(state[key])
+                setattr(state, key, math.ceil(getattr(state, key)))
         else:
             print("Invalid action", action)
 
@@ -1,8 +1,10 @@
+import random
+
 import numpy as np
 
 import gymnasium as gym
 from gymnasium.spaces import Box, Dict, Discrete, Sequence
-from gymnasium.spaces.utils import flatten_space, flatten
+from gymnasium.spaces.utils import flatdim, flatten_space
 
 from engine import Engine
 from game_data.skill_cards import SkillCards
@@ -38,157 +40,262 @@ PHASE_MAPPING = {
     "staminaDecreased": 13,
 }
 
-total_num_cards = len(SkillCards.get_all())
+
+# Scalar fields, observed as min(value, cap) / cap
+SCALAR_OBSERVATION_CAPS = {
+    "turnsElapsed": 16,
+    "turnsRemaining": 16,
+    "cardUsesRemaining": 8,
+    "maxStamina": 100,
+    "stamina": 100,
+    "genki": 400,
+    "score": 100000,
+    "cardsUsed": 400,
+    "turnCardsUsed": 64,
+    "goodConditionTurns": 400,
+    "perfectConditionTurns": 100,
+    "concentration": 400,
+    "goodImpressionTurns": 400,
+    "motivation": 400,
+    "halfCostTurns": 16,
+    "doubleCostTurns": 16,
+    "costReduction": 16,
+    "costIncrease": 16,
+    "doubleCardEffectCards": 16,
+    "nullifyGenkiTurns": 16,
+    "nullifyDebuff": 16,
+}
+
+PILE_FIELDS = ["deckCardIds", "handCardIds", "discardedCardIds", "removedCardIds"]
+
+ACTION_MODES = ["card", "hand_slot"]
+
+# Hands are drawn up to 5 cards, but effects can add a card to a full hand
+NUM_HAND_SLOTS = 6
 
 
 class GakumasEnv(gym.Env):
-    def __init__(self):
-        self._observation_space = Dict(
-            {
-                "turnTypes": Box(0, 16, shape=(3,)),
-                "turnsElapsed": Box(0, 1),
-                "turnsRemaining": Box(0, 1),
-                "cardUsesRemaining": Box(0, 1),
-                "maxStamina": Box(0, 1),
-                "stamina": Box(0, 1),
-                "genki": Box(0, 1),
-                "score": Box(0, 1),
-                "deckCardIds": Box(
-                    0,
-                    2,
-                    shape=(total_num_cards,),
-                ),
-                "handCardIds": Box(
-                    0,
-                    2,
-                    shape=(total_num_cards,),
-                ),
-                "discardedCardIds": Box(
-                    0,
-                    2,
-                    shape=(total_num_cards,),
-                ),
-                "removedCardIds": Box(
-                    0,
-                    2,
-                    shape=(total_num_cards,),
-                ),
-                "cardsUsed": Box(0, 1),
-                "turnCardsUsed": Box(0, 1),
-                "effects": Box(0, 1, shape=(16,)),
-                "goodConditionTurns": Box(0, 1),
-                "perfectConditionTurns": Box(0, 1),
-                "concentration": Box(0, 1),
-                "goodImpressionTurns": Box(0, 1),
-                "motivation": Box(0, 1),
-                "halfCostTurns": Box(0, 1),
-                "doubleCostTurns": Box(0, 1),
-                "costReduction": Box(0, 1),
-                "costIncrease": Box(0, 1),
-                "doubleCardEffectCards": Box(0, 1),
-                "nullifyGenkiTurns": Box(0, 1),
-                "nullifyDebuff": Box(0, 1),
-                "scoreBuffs": Box(0, 1, shape=(16,)),
-            }
+    # The stage and loadout are set up once, and each reset starts the stage
+    # from a template state with a newly shuffled deck and turn types.
+    #
+    # In the "card" action mode, actions are skill card ids. In the
+    # "hand_slot" mode, they are positions in the hand, offset by one, and
+    # the observation also holds the card id in each slot. In both modes,
+    # action 0 ends the turn, and infos hold the legal actions under
+    # "action_mask".
+    def __init__(
+        self,
+        stage_id=26,
+        params=[1009, 1422, 1474, 47],
+        support_bonus=0.023,
+        p_item_ids=[47, 75, 71],
+        skill_card_id_groups=[
+            [223, 45, 122, 125, 136, 181],
+            [223, 45, 291, 96, 297, 179],
+        ],
+        fallback_plan="logic",
+        fallback_idol_id=3,
+        action_mode="card",
+    ):
+        if action_mode not in ACTION_MODES:
+            raise ValueError(f"Unknown action mode {action_mode}")
+        self.action_mode = action_mode
+
+        stage = Stages.get_by_id(stage_id)
+        stage_config = StageConfig(stage)
+        idol_config = IdolConfig(
+            params=params,
+            support_bonus=support_bonus,
+            p_item_ids=p_item_ids,
+            skill_card_id_groups=skill_card_id_groups,
+            stage=stage,
+            fallback_plan=fallback_plan,
+            fallback_idol_id=fallback_idol_id,
         )
+        logger = Logger(DEBUG)
+        self.engine = Engine(stage_config, idol_config, logger, DEBUG)
+        self.stage_template = self.engine.get_stage_template()
+
+        # Counted here rather than at import, which would load the skill cards
+        self.total_num_cards = total_num_cards = len(SkillCards.get_all())
+        observation_spaces = {
+            "turnTypes": Box(0, 16, shape=(3,)),
+            "turnsElapsed": Box(0, 1),
+            "turnsRemaining": Box(0, 1),
+            "cardUsesRemaining": Box(0, 1),
+            "maxStamina": Box(0, 1),
+            "stamina": Box(0, 1),
+            "genki": Box(0, 1),
+            "score": Box(0, 1),
+            "deckCardIds": Box(
+                0,
+                2,
+                shape=(total_num_cards,),
+            ),
+            "handCardIds": Box(
+                0,
+                2,
+                shape=(total_num_cards,),
+            ),
+            "discardedCardIds": Box(
+                0,
+                2,
+                shape=(total_num_cards,),
+            ),
+            "removedCardIds": Box(
+                0,
+                2,
+                shape=(total_num_cards,),
+            ),
+            "cardsUsed": Box(0, 1),
+            "turnCardsUsed": Box(0, 1),
+            "effects": Box(0, 1, shape=(16,)),
+            "goodConditionTurns": Box(0, 1),
+            "perfectConditionTurns": Box(0, 1),
+            "concentration": Box(0, 1),
+            "goodImpressionTurns": Box(0, 1),
+            "motivation": Box(0, 1),
+            "halfCostTurns": Box(0, 1),
+            "doubleCostTurns": Box(0, 1),
+            "costReduction": Box(0, 1),
+            "costIncrease": Box(0, 1),
+            "doubleCardEffectCards": Box(0, 1),
+            "nullifyGenkiTurns": Box(0, 1),
+            "nullifyDebuff": Box(0, 1),
+            "scoreBuffs": Box(0, 1, shape=(16,)),
+        }
+        if action_mode == "hand_slot":
+            # Card id in each hand slot over the number of cards, or 0 if empty
+            observation_spaces["handSlots"] = Box(0, 1, shape=(NUM_HAND_SLOTS,))
+            self.action_space = Discrete(NUM_HAND_SLOTS + 1)
+        else:
+            self.action_space = Discrete(total_num_cards)
+        self._observation_space = Dict(observation_spaces)
         self.observation_space = flatten_space(self._observation_space)
-        self.action_space = Discrete(total_num_cards)
 
+        # Dict spaces sort their keys, and flatten concatenates in that order
+        self.observation_offsets = {}
+        offset = 0
+        for key, space in self._observation_space.spaces.items():
+            self.observation_offsets[key] = offset
+            offset += flatdim(space)
+        self.observation = np.zeros(offset, dtype=self.observation_space.dtype)
+        self.scalar_observation_indices = [
+            self.observation_offsets[field] for field in SCALAR_OBSERVATION_CAPS
+        ]
+        # Containers the observation was last encoded from, and a copy of
+        # the state they came from
+        self.encoded_containers = {}
+        self.encoded_state = None
+
+    # Writes the observation into a preallocated buffer laid out like
+    # flatten(self._observation_space, ...), with the Dict's sorted keys at
+    # fixed offsets. Sections for piles, turn types, effects and score buffs
+    # are only encoded again when the container differs from the one last
+    # encoded.
     def _get_obs(self):
         state = self.game_state
+        observation = self.observation
+        offsets = self.observation_offsets
+        encoded = self.encoded_containers
 
-        deck_cards = np.zeros(total_num_cards)
-        for card in state["deckCardIds"]:
-            deck_cards[card] += 1
-
-        hand_cards = np.zeros(total_num_cards)
-        for card in state["handCardIds"]:
-            hand_cards[card] += 1
-
-        discarded_cards = np.zeros(total_num_cards)
-        for card in state["discardedCardIds"]:
-            discarded_cards[card] += 1
-
-        removed_cards = np.zeros(total_num_cards)
-        for card in state["removedCardIds"]:
-            removed_cards[card] += 1
-
-        effects = np.zeros(16)
-        for effect in state["effects"]:
-            phase = PHASE_MAPPING[effect["phase"]]
-            effects[phase] += min(effect.get("limit", 16), 0) / 16
-
-        score_buffs = np.zeros(16)
-        for score_buff in state["scoreBuffs"]:
-            turns = int(min(score_buff.get("turns"), 16))
-            score_buffs[turns] += min(score_buff["amount"], 16)
-
-        return flatten(
-            self._observation_space,
-            {
-                "turnTypes": np.array(
-                    [
-                        state["turnTypes"].count("vocal"),
-                        state["turnTypes"].count("dance"),
-                        state["turnTypes"].count("visual"),
-                    ]
-                ),
-                "turnsElapsed": min(state["turnsElapsed"], 16) / 16,
-                "turnsRemaining": min(state["turnsRemaining"], 16) / 16,
-                "cardUsesRemaining": min(state["cardUsesRemaining"], 8) / 8,
-                "maxStamina": min(state["maxStamina"], 100) / 100,
-                "stamina": min(state["stamina"], 100) / 100,
-                "genki": min(state["genki"], 400) / 400,
-                "score": min(state["score"], 100000) / 100000,
-                "deckCardIds": deck_cards,
-                "handCardIds": hand_cards,
-                "discardedCardIds": discarded_cards,
-                "removedCardIds": removed_cards,
-                "cardsUsed": min(state["cardsUsed"], 400) / 400,
-                "turnCardsUsed": min(state["turnCardsUsed"], 64) / 64,
-                "effects": effects,
-                "goodConditionTurns": min(state["goodConditionTurns"], 400) / 400,
-                "perfectConditionTurns": min(state["perfectConditionTurns"], 100) / 100,
-                "concentration": min(state["concentration"], 400) / 400,
-                "goodImpressionTurns": min(state["goodImpressionTurns"], 400) / 400,
-                "motivation": min(state["motivation"], 400) / 400,
-                "halfCostTurns": min(state["halfCostTurns"], 16) / 16,
-                "doubleCostTurns": min(state["doubleCostTurns"], 16) / 16,
-                "costReduction": min(state["costReduction"], 16) / 16,
-                "costIncrease": min(state["costIncrease"], 16) / 16,
-                "doubleCardEffectCards": min(state["doubleCardEffectCards"], 16) / 16,
-                "nullifyGenkiTurns": min(state["nullifyGenkiTurns"], 16) / 16,
-                "nullifyDebuff": min(state["nullifyDebuff"], 16) / 16,
-                "scoreBuffs": score_buffs,
-            },
-        )
+        observation[self.scalar_observation_indices] = [
+            min(getattr(state, field), cap) / cap
+            for field, cap in SCALAR_OBSERVATION_CAPS.items()
+        ]
+
+        for field in PILE_FIELDS:
+            pile = getattr(state, field)
+            if encoded.get(field) is pile:
+                continue
+            encoded[field] = pile
+            offset = offsets[field]
+            observation[offset : offset + self.total_num_cards] = np.bincount(
+                pile, minlength=self.total_num_cards
+            )
+
+        turn_types = state.turnTypes
+        if encoded.get("turnTypes") is not turn_types:
+            encoded["turnTypes"] = turn_types
+            offset = offsets["turnTypes"]
+            observation[offset : offset + 3] = [
+                turn_types.count("vocal"),
+                turn_types.count("dance"),
+                turn_types.count("visual"),
+            ]
+
+        hand_card_ids = state.handCardIds
+        if (
+            self.action_mode == "hand_slot"
+            and encoded.get("handSlots") is not hand_card_ids
+        ):
+            encoded["handSlots"] = hand_card_ids
+            hand_slots = [0.0] * NUM_HAND_SLOTS
+            for i, card_id in enumerate(hand_card_ids[:NUM_HAND_SLOTS]):
+                hand_slots[i] = card_id / self.total_num_cards
+            offset = offsets["handSlots"]
+            observation[offset : offset + NUM_HAND_SLOTS] = hand_slots
+
+        state_effects = state.effects
+        if encoded.get("effects") is not state_effects:
+            encoded["effects"] = state_effects
+            effects = [0.0] * 16
+            for effect in state_effects:
+                phase = PHASE_MAPPING[effect["phase"]]
+                effects[phase] += min(effect.get("limit", 16), 0) / 16
+            offset = offsets["effects"]
+            observation[offset : offset + 16] = effects
+
+        state_score_buffs = state.scoreBuffs
+        if encoded.get("scoreBuffs") is not state_score_buffs:
+            encoded["scoreBuffs"] = state_score_buffs
+            score_buffs = [0.0] * 16
+            for score_buff in state_score_buffs:
+                turns = int(min(score_buff.get("turns"), 16))
+                score_buffs[turns] += min(score_buff["amount"], 16)
+            offset = offsets["scoreBuffs"]
+            observation[offset : offset + 16] = score_buffs
+
+        # Holding a copy of the state keeps the engine from writing to the
+        # encoded containers in place, e.g. in end_turn
+        self.encoded_state = state.copy()
+
+        # Copied, since callers such as replay memories keep observations
+        return observation.copy()
+
+    # Legal actions: ending the turn (0) and the usable cards in hand. Cards
+    # outside the action space, i.e. with ids past the number of cards in
+    # "card" mode or past the last slot in "hand_slot" mode, have no action.
+    # Writes into out, if given.
+    def action_mask(self, out=None):
+        if out is None:
+            out = np.zeros(self.action_space.n, dtype=bool)
+        else:
+            out[:] = False
+        out[0] = True
+        state = self.game_state
+        hand_card_ids = state.handCardIds
+        usable = self.engine.usable_mask(state, hand_card_ids)
+        if self.action_mode == "hand_slot":
+            out[1 : len(usable) + 1] = usable[: len(out) - 1]
+        else:
+            for card_id, card_usable in zip(hand_card_ids, usable):
+                if card_usable and card_id < len(out):
+                    out[card_id] = True
+        return out
 
     def _get_info(self):
-        return {"score": self.game_state["score"]}
+        return {"score": self.game_state["score"], "action_mask": self.action_mask()}
 
     def reset(self, seed=None, options=None):
         # We need the following line to seed self.np_random
         super().reset(seed=seed)
 
-        stage = Stages.get_by_id(26)
-        stage_config = StageConfig(stage)
-        idol_config = IdolConfig(
-            params=[1009, 1422, 1474, 47],
-            support_bonus=0.023,
-            p_item_ids=[47, 75, 71],
-            skill_card_id_groups=[
-                [223, 45, 122, 125, 136, 181],
-                [223, 45, 291, 96, 297, 179],
-            ],
-            stage=stage,
-            fallback_plan="logic",
-            fallback_idol_id=3,
-        )
-        logger = Logger(DEBUG)
-        self.engine = Engine(stage_config, idol_config, logger, DEBUG)
-
-        self.game_state = self.engine.get_initial_state()
-        self.game_state = self.engine.start_stage(self.game_state)
+        # Draw the engine's randomness from np_random so seeded resets are
+        # reproducible
+        self.engine.random = random.Random(int(self.np_random.integers(2**63)))
+        self.game_state = self.engine.start_stage_from_template(self.stage_template)
+        self.encoded_containers = {}
 
         observation = self._get_obs()
         info = self._get_info()
@@ -196,7 +303,10 @@ class GakumasEnv(gym.Env):
         return observation, info
 
     def step(self, action):
-        if action:
+        if action and self.action_mode == "hand_slot":
+            card_id = self.game_state.handCardIds[action - 1]
+            self.game_state = self.engine.use_card(self.game_state, card_id)
+        elif action:
             self.game_state = self.engine.use_card(self.game_state, action)
         else:
             self.game_state = self.engine.end_turn(self.game_state)
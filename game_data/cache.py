@@ -0,0 +1,66 @@
+import hashlib
+import json
+import marshal
+import os
+import sys
+
+
+# Bump when the parsing of any game data table changes
+CACHE_VERSION = 1
+
+JSON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "json")
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+
+# Loads a game data table from game_data/json/<name>.json, parsed by parse.
+# Parsed tables are cached in game_data/cache, keyed by a hash of the JSON
+# file, so the JSON is only parsed again when it changes. The cache is
+# written with marshal, which is fast to load but only supports builtin
+# types, so parse must not return functions or other objects.
+def load_table(name, parse, rebuild=False):
+    with open(os.path.join(JSON_DIR, f"{name}.json"), "rb") as f:
+        source = f.read()
+    key = [
+        CACHE_VERSION,
+        sys.implementation.cache_tag,
+        marshal.version,
+        hashlib.blake2b(source, digest_size=16).hexdigest(),
+    ]
+    cache_path = os.path.join(CACHE_DIR, f"{name}.marshal")
+
+    if not rebuild:
+        try:
+            with open(cache_path, "rb") as f:
+                cached_key, table = marshal.loads(f.read())
+            if cached_key == key:
+                return table
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    table = parse(json.loads(source))
+
+    # Write to a temporary file first, so that processes loading at the same
+    # time never read a partial cache. Read-only installs skip the cache.
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}"
+        with open(temp_path, "wb") as f:
+            f.write(marshal.dumps([key, table]))
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
+
+    return table
+
+
+if __name__ == "__main__":
+    # Rebuilds the caches of all tables
+    from game_data import p_idols, p_items, skill_cards, stages
+
+    for name, module in [
+        ("p_idols", p_idols),
+        ("p_items", p_items),
+        ("skill_cards", skill_cards),
+        ("stages", stages),
+    ]:
+        load_table(name, module.parse, rebuild=True)
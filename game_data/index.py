@@ -0,0 +1,44 @@
+MAX_CACHED_QUERIES = 1024
+
+
+class Index:
+    # Secondary indexes over a list of game data entries, mapping each value
+    # of each indexed field to the positions of the entries that have it.
+    # Queries intersect the positions for each filter, and results are
+    # cached by filter values. Entries are returned in list order, so
+    # random choices over query results stay reproducible.
+    def __init__(self, entries, fields):
+        self.entries = entries
+        self.fields = fields
+        self.positions = {field: {} for field in fields}
+        for i, entry in enumerate(entries):
+            for field in fields:
+                self.positions[field].setdefault(entry.get(field), set()).add(i)
+        self.results = {}
+
+    # Returns the entries whose value of each field is one of the given
+    # values. Fields without values are not filtered on.
+    def query(self, **filters):
+        key = tuple(
+            tuple(filters[field]) if filters.get(field) else None
+            for field in self.fields
+        )
+        result = self.results.get(key)
+        if result is None:
+            result = self._query(key)
+            if len(self.results) >= MAX_CACHED_QUERIES:
+                self.results.clear()
+            self.results[key] = result
+        return result
+
+    def _query(self, key):
+        matches = None
+        for field, values in zip(self.fields, key):
+            if values is None:
+                continue
+            field_positions = self.positions[field]
+            positions = set().union(*(field_positions.get(v, ()) for v in values))
+            matches = positions if matches is None else matches & positions
+        if matches is None:
+            return tuple(self.entries)
+        return tuple(self.entries[i] for i in sorted(matches))
@@ -1,35 +1,49 @@
-import json
+from game_data.cache import load_table
+from game_data.index import Index
 
 
-with open("game_data/json/p_idols.json", "r", encoding="utf-8") as f:
-    p_idols = json.load(f)
+def parse(p_idols):
+    return p_idols
 
-p_idols_by_id = {p_idol["id"]: p_idol for p_idol in p_idols}
+
+# Set by load() on first access
+p_idols = None
+p_idols_by_id = None
+p_idols_index = None
+
+
+def load():
+    global p_idols, p_idols_by_id, p_idols_index
+
+    idols = load_table("p_idols", parse)
+    p_idols = idols
+    p_idols_index = Index(idols, ["idolId", "rarity", "plan", "recommendedEffect"])
+    # Set last, since it marks the table as loaded
+    p_idols_by_id = {p_idol["id"]: p_idol for p_idol in idols}
 
 
 class PIdols:
     @staticmethod
     def get_all():
+        if p_idols_by_id is None:
+            load()
         return p_idols_by_id
 
     @staticmethod
     def get_by_id(id):
+        if p_idols_by_id is None:
+            load()
         return p_idols_by_id[id]
 
     @staticmethod
-    def get_filtered(idol_ids, rarities, plans, recommended_effects):
-        def filter_fn(p_idol):
-            if idol_ids and not p_idol["idolId"] in idol_ids:
-                return False
-            if rarities and not p_idol["rarity"] in rarities:
-                return False
-            if plans and not p_idol["plan"] in plans:
-                return False
-            if (
-                recommended_effects
-                and not p_idol["recommendedEffect"] in recommended_effects
-            ):
-                return False
-            return True
-
-        return filter(filter_fn, p_idols)
+    def get_filtered(
+        idol_ids=None, rarities=None, plans=None, recommended_effects=None
+    ):
+        if p_idols_by_id is None:
+            load()
+        return p_idols_index.query(
+            idolId=idol_ids,
+            rarity=rarities,
+            plan=plans,
+            recommendedEffect=recommended_effects,
+        )
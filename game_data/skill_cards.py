@@ -1,48 +1,104 @@
-import json
-
+from compiler import compile_condition
+from compiler import compile_cost_vector
+from constants import COST_VECTOR_FIELDS
 from effects import deserialize_effect
 from effects import deserialize_effect_sequence
+from game_data.cache import load_table
+from game_data.index import Index
 
 
-with open("game_data/json/skill_cards.json", "r", encoding="utf-8") as f:
-    skill_cards = json.load(f)
+def parse(skill_cards):
+    for skill_card in skill_cards:
+        skill_card["conditions"] = deserialize_effect(skill_card["conditions"]).get(
+            "conditions", []
+        )
+        skill_card["cost"] = deserialize_effect(skill_card["cost"]).get("actions", [])
+        skill_card["costVector"] = compile_cost_vector(
+            skill_card["cost"], COST_VECTOR_FIELDS
+        )
+        skill_card["effects"] = deserialize_effect_sequence(skill_card["effects"])
+        skill_card["limit"] = skill_card.get("limit", None)
+        skill_card["pIdolId"] = skill_card.get("pIdolId", None)
+    return skill_cards
 
-for skill_card in skill_cards:
-    skill_card["conditions"] = deserialize_effect(skill_card["conditions"]).get(
-        "conditions", []
-    )
-    skill_card["cost"] = deserialize_effect(skill_card["cost"]).get("actions", [])
-    skill_card["effects"] = deserialize_effect_sequence(skill_card["effects"])
-    skill_card["limit"] = skill_card.get("limit", None)
-    skill_card["pIdolId"] = skill_card.get("pIdolId", None)
 
-skill_cards_by_id = {skill_card["id"]: skill_card for skill_card in skill_cards}
+# Set by load() on first access
+skill_cards = None
+skill_cards_by_id = None
+skill_cards_index = None
+cost_vectors = None
+has_cost_vector = None
+
+
+def load():
+    global skill_cards, skill_cards_by_id, skill_cards_index
+    global cost_vectors, has_cost_vector
+
+    # Only needed for the cost vectors, and slow to import
+    import numpy as np
+
+    cards = load_table("skill_cards", parse)
+
+    # Compiled conditions are functions, so they are not cached
+    for skill_card in cards:
+        skill_card["compiledConditions"] = [
+            compile_condition(condition) for condition in skill_card["conditions"]
+        ]
+
+    cards_by_id = {skill_card["id"]: skill_card for skill_card in cards}
+
+    # Cost vectors indexed by skill card id. Rows of cards without a cost
+    # vector are NaN and have has_cost_vector unset.
+    cost_vectors = np.full((max(cards_by_id) + 1, len(COST_VECTOR_FIELDS)), np.nan)
+    has_cost_vector = np.zeros(len(cost_vectors), dtype=bool)
+    for skill_card in cards:
+        if skill_card["costVector"] is not None:
+            cost_vectors[skill_card["id"]] = skill_card["costVector"]
+            has_cost_vector[skill_card["id"]] = True
+
+    skill_cards = cards
+    skill_cards_index = Index(
+        cards, ["rarity", "type", "plan", "unlockPlv", "sourceType", "pIdolId"]
+    )
+    # Set last, since it marks the table as loaded
+    skill_cards_by_id = cards_by_id
 
 
 class SkillCards:
     @staticmethod
     def get_all():
+        if skill_cards_by_id is None:
+            load()
         return skill_cards_by_id
 
     @staticmethod
     def get_by_id(id):
+        if skill_cards_by_id is None:
+            load()
         return skill_cards_by_id[id]
 
     @staticmethod
-    def get_filtered(rarities, types, plans, unlock_plvs, source_types, p_idol_ids):
-        def filter_fn(skill_card):
-            if rarities and not skill_card["rarity"] in rarities:
-                return False
-            if types and not skill_card["type"] in types:
-                return False
-            if plans and not skill_card["plan"] in plans:
-                return False
-            if unlock_plvs and not skill_card["unlockPlv"] in unlock_plvs:
-                return False
-            if source_types and not skill_card["sourceType"] in source_types:
-                return False
-            if p_idol_ids and not skill_card["pIdolId"] in p_idol_ids:
-                return False
-            return True
-
-        return filter(filter_fn, skill_cards)
+    def get_cost_vectors():
+        if skill_cards_by_id is None:
+            load()
+        return cost_vectors, has_cost_vector
+
+    @staticmethod
+    def get_filtered(
+        rarities=None,
+        types=None,
+        plans=None,
+        unlock_plvs=None,
+        source_types=None,
+        p_idol_ids=None,
+    ):
+        if skill_cards_by_id is None:
+            load()
+        return skill_cards_index.query(
+            rarity=rarities,
+            type=types,
+            plan=plans,
+            unlockPlv=unlock_plvs,
+            sourceType=source_types,
+            pIdolId=p_idol_ids,
+        )
@@ -1,32 +1,45 @@
-import json
-
 from effects import deserialize_effect_sequence
+from game_data.cache import load_table
+
+
+def parse(stages):
+    for stage in stages:
+        [vo, da, vi] = [float(criterion) for criterion in stage["criteria"].split(",")]
+        stage["criteria"] = {"vocal": vo, "dance": da, "visual": vi}
+        [voT, daT, viT] = [
+            float(turn_count) for turn_count in stage["turnCounts"].split(",")
+        ]
+        stage["turnCounts"] = {"vocal": voT, "dance": daT, "visual": viT}
+        [voFt, daFt, viFt] = [
+            float(first_turn) for first_turn in stage["firstTurns"].split(",")
+        ]
+        stage["firstTurns"] = {"vocal": voFt, "dance": daFt, "visual": viFt}
+        stage["effects"] = deserialize_effect_sequence(stage["effects"])
+    return stages
+
 
+# Set by load() on first access
+stages = None
+stages_by_id = None
 
-with open("game_data/json/stages.json", "r", encoding="utf-8") as f:
-    stages = json.load(f)
 
-for stage in stages:
-    [vo, da, vi] = [float(criterion) for criterion in stage["criteria"].split(",")]
-    stage["criteria"] = {"vocal": vo, "dance": da, "visual": vi}
-    [voT, daT, viT] = [
-        float(turn_count) for turn_count in stage["turnCounts"].split(",")
-    ]
-    stage["turnCounts"] = {"vocal": voT, "dance": daT, "visual": viT}
-    [voFt, daFt, viFt] = [
-        float(first_turn) for first_turn in stage["firstTurns"].split(",")
-    ]
-    stage["firstTurns"] = {"vocal": voFt, "dance": daFt, "visual": viFt}
-    stage["effects"] = deserialize_effect_sequence(stage["effects"])
+def load():
+    global stages, stages_by_id
 
-stages_by_id = {stage["id"]: stage for stage in stages}
+    stages = load_table("stages", parse)
+    # Set last, since it marks the table as loaded
+    stages_by_id = {stage["id"]: stage for stage in stages}
 
 
 class Stages:
     @staticmethod
     def get_all():
+        if stages_by_id is None:
+            load()
         return stages_by_id
 
     @staticmethod
     def get_by_id(id):
+        if stages_by_id is None:
+            load()
         return stages_by_id[id]
@@ -0,0 +1,204 @@
+from collections.abc import MutableMapping
+
+
+FIELDS = (
+    "started",
+    "turnTypes",
+    "turnType",
+    # General
+    "turnsElapsed",
+    "turnsRemaining",
+    "cardUsesRemaining",
+    "maxStamina",
+    "fixedStamina",
+    "intermediateStamina",
+    "stamina",
+    "fixedGenki",
+    "intermediateGenki",
+    "genki",
+    "cost",
+    "intermediateScore",
+    "score",
+    "clearRatio",
+    # Skill card piles
+    "deckCardIds",
+    "handCardIds",
+    "discardedCardIds",
+    "removedCardIds",
+    "cardsUsed",
+    "turnCardsUsed",
+    # Phase effects
+    "phase",
+    "effects",
+    "effectsByPhase",
+    "expiredEffects",
+    "triggeredEffects",
+    # Buffs and debuffs
+    "goodConditionTurns",
+    "perfectConditionTurns",
+    "concentration",
+    "goodImpressionTurns",
+    "motivation",
+    "halfCostTurns",
+    "doubleCostTurns",
+    "costReduction",
+    "costIncrease",
+    "doubleCardEffectCards",
+    "nullifyGenkiTurns",
+    "nullifyDebuff",
+    # Score buffs
+    "scoreBuffs",
+    # Used card
+    "_usedCardId",
+    "usedCardId",
+    "cardEffects",
+    # Buffs/debuffs protected from decrement when fresh
+    "freshBuffs",
+    # Effect modifiers
+    "concentrationMultiplier",
+    "motivationMultiplier",
+)
+
+FIELD_SET = frozenset(FIELDS)
+
+
+class _Missing:
+    def __repr__(self):
+        return "MISSING"
+
+    def __reduce__(self):
+        return "MISSING"
+
+
+# Value of a field that has not been set yet, e.g. turnType before the
+# first turn. The mapping view treats such fields as absent.
+MISSING = _Missing()
+
+
+class GameState(MutableMapping):
+    # Fields are stored in slots and can be read and written as attributes
+    # (state.stamina) on hot paths, or by key (state["stamina"]) through the
+    # mapping view. Keys that are not known fields, such as flags set by
+    # skill card actions, are kept in a separate dict.
+    #
+    # Copies of a state share their piles, effects and buffs with the state
+    # they were copied from. A container is only copied the first time it
+    # is written through writable(), so states held by callers are never
+    # mutated. Dicts inside the effects and scoreBuffs lists are never
+    # modified in place; they are replaced with updated copies instead.
+    __slots__ = FIELDS + ("_extra", "_owned")
+
+    def __init__(self, *args, **kwargs):
+        for field in FIELDS:
+            object.__setattr__(self, field, MISSING)
+        self._extra = None
+        self._owned = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in FIELD_SET:
+            value = getattr(self, key)
+            if value is MISSING:
+                raise KeyError(key)
+            return value
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in FIELD_SET:
+            if getattr(self, key) is MISSING:
+                raise KeyError(key)
+            setattr(self, key, MISSING)
+        else:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in FIELD_SET:
+            return getattr(self, key) is not MISSING
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for field in FIELDS:
+            if getattr(self, field) is not MISSING:
+                yield field
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"GameState({dict(self)!r})"
+
+    def get(self, key, default=None):
+        if key in FIELD_SET:
+            value = getattr(self, key)
+            return default if value is MISSING else value
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+    def writable(self, key):
+        value = getattr(self, key)
+        if self._owned is None:
+            self._owned = {}
+        if self._owned.get(key) is not value:
+            value = value.copy()
+            setattr(self, key, value)
+            self._owned[key] = value
+        return value
+
+
+# copy() runs for every card used and every effect trigger, so it is built as
+# straight-line attribute copies rather than a loop over FIELDS. Both states
+# give up ownership of their containers, since the containers are now
+# shared, so neither writes to them in place.
+def _build_copy():
+    lines = [
+        "def copy(self):",
+        "    state = new(GameState)",
+        *[f"    state.{field} = self.{field}" for field in FIELDS],
+        "    state._extra = dict(self._extra) if self._extra else None",
+        "    state._owned = None",
+        "    self._owned = None",
+        "    return state",
+    ]
+    namespace = {"GameState": GameState, "new": object.__new__}
+    exec("\n".join(lines), namespace)
+    return namespace["copy"]
+
+
+GameState.copy = _build_copy()
+
+
+# Sets each field of a state to the value in another state, returning
+# (field, previous value) pairs for the fields that were not already the
+# same object. Used by Engine.apply to update a state in place and record
+# what changed.
+def _build_assign():
+    lines = ["def assign(self, other):", "    changed = []"]
+    for field in FIELDS:
+        lines += [
+            f"    value = other.{field}",
+            f"    if value is not self.{field}:",
+            f"        changed.append(({field!r}, self.{field}))",
+            f"        self.{field} = value",
+        ]
+    lines.append("    return changed")
+    namespace = {}
+    exec("\n".join(lines), namespace)
+    return namespace["assign"]
+
+
+GameState.assign = _build_assign()
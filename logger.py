@@ -5,13 +5,22 @@ class Logger:
     def __init__(self, debugging_enabled):
         self.disabled = False
         self.debugging_enabled = debugging_enabled
+        self._update_enabled()
         self.clear()
 
+    # log_enabled and debug_enabled let callers skip building log payloads
+    # that would be thrown away
+    def _update_enabled(self):
+        self.log_enabled = not self.disabled
+        self.debug_enabled = self.debugging_enabled and not self.disabled
+
     def disable(self):
         self.disabled = True
+        self._update_enabled()
 
     def enable(self):
         self.disabled = False
+        self._update_enabled()
 
     def log(self, log_type, data=None):
         if self.disabled:
@@ -40,3 +49,33 @@ class Logger:
     def clear(self):
         self.logs = []
         self.graph_data = {field: [] for field in GRAPHED_FIELDS}
+
+
+class NullLogger:
+    # Logger for headless engines, which never records anything. The engine
+    # checks log_enabled and debug_enabled before building log entries, so
+    # no logging work is done at all.
+    log_enabled = False
+    debug_enabled = False
+
+    def __init__(self):
+        self.clear()
+
+    def disable(self):
+        pass
+
+    def enable(self):
+        pass
+
+    def log(self, log_type, data=None):
+        pass
+
+    def debug(self, *args):
+        pass
+
+    def push_graph_data(self, state):
+        pass
+
+    def clear(self):
+        self.logs = []
+        self.graph_data = {field: [] for field in GRAPHED_FIELDS}
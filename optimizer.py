@@ -0,0 +1,260 @@
+import collections
+import math
+import multiprocessing
+import os
+import random
+
+from idol_config import IdolConfig
+from seeding import get_root_seed_sequence
+from simulator import DEFAULT_BUCKET_SIZE
+from simulator import DEFAULT_CHUNK_SIZE
+from simulator import get_result
+from simulator import merge_summaries
+from simulator import simulate_run
+from simulator import summarize_run
+from stage_config import StageConfig
+
+
+# z for two-sided 95% confidence intervals
+CONFIDENCE_Z = 1.96
+
+# Per-worker configuration, set up once by _init_worker
+worker_stage_config = None
+worker_idol_configs = None
+worker_strategy_class = None
+worker_bucket_size = None
+worker_root_seed_sequence = None
+
+
+def optimize_loadout(
+    stage,
+    params,
+    support_bonus,
+    skill_card_pool,
+    p_item_pool,
+    strategy_class,
+    budget,
+    num_skill_cards=6,
+    num_p_items=3,
+    num_candidates=32,
+    fallback_plan="sense",
+    fallback_idol_id=1,
+    **race_options,
+):
+    # Draws candidate loadouts from pools of skill cards and p-items and
+    # races them with race_loadouts
+    rng = random.Random(race_options.get("seed"))
+    loadouts = generate_loadouts(
+        stage,
+        skill_card_pool,
+        p_item_pool,
+        num_skill_cards,
+        num_p_items,
+        num_candidates,
+        rng,
+        fallback_plan,
+        fallback_idol_id,
+    )
+    return race_loadouts(
+        stage,
+        params,
+        support_bonus,
+        loadouts,
+        strategy_class,
+        budget,
+        fallback_plan=fallback_plan,
+        fallback_idol_id=fallback_idol_id,
+        **race_options,
+    )
+
+
+# Samples up to num_candidates distinct loadouts of num_skill_cards cards and
+# num_p_items p-items. Pools may list a card more than once to allow copies.
+# Loadouts that IdolConfig would dedupe a card from are skipped, since the
+# deduped card's slot is wasted, as are loadouts that dedupe to one already
+# drawn.
+def generate_loadouts(
+    stage,
+    skill_card_pool,
+    p_item_pool,
+    num_skill_cards,
+    num_p_items,
+    num_candidates,
+    rng,
+    fallback_plan,
+    fallback_idol_id,
+    max_attempts=100,
+):
+    loadouts = []
+    seen = set()
+    for _ in range(num_candidates * max_attempts):
+        if len(loadouts) >= num_candidates:
+            break
+        skill_card_ids = sorted(rng.sample(skill_card_pool, num_skill_cards))
+        p_item_ids = sorted(rng.sample(p_item_pool, num_p_items))
+
+        idol_config = IdolConfig(
+            params=[0, 0, 0, 0],
+            support_bonus=0,
+            p_item_ids=p_item_ids,
+            skill_card_id_groups=[skill_card_ids],
+            stage=stage,
+            fallback_plan=fallback_plan,
+            fallback_idol_id=fallback_idol_id,
+        )
+        kept = collections.Counter(idol_config.skill_card_ids)
+        if any(
+            kept[card_id] < count
+            for card_id, count in collections.Counter(skill_card_ids).items()
+        ):
+            continue
+
+        key = (tuple(skill_card_ids), tuple(p_item_ids))
+        if key in seen:
+            continue
+        seen.add(key)
+        loadouts.append({"skillCardIds": skill_card_ids, "pItemIds": p_item_ids})
+    return loadouts
+
+
+def race_loadouts(
+    stage,
+    params,
+    support_bonus,
+    loadouts,
+    strategy_class,
+    budget,
+    eta=2,
+    min_runs=DEFAULT_CHUNK_SIZE,
+    fallback_plan="sense",
+    fallback_idol_id=1,
+    num_workers=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    bucket_size=DEFAULT_BUCKET_SIZE,
+    seed=None,
+):
+    # Ranks loadouts by average score with successive halving. Each round
+    # splits an equal share of budget, a total number of games, between
+    # the surviving loadouts, then keeps the best 1/eta of them by average
+    # score, so weak loadouts are dropped after a few games and the best
+    # get most of the budget. Games played in earlier rounds count towards
+    # later ones. Loadouts play at least min_runs games per round, so small
+    # budgets can be exceeded.
+    #
+    # Every loadout plays the same seeds in the same order as simulate, so
+    # differences between loadouts are not down to luck of the draw, and
+    # a given seed gives identical results for any number of workers.
+    # Games are played without logging, and only scores are sent back from
+    # workers. Returns a leaderboard of all loadouts, best first, with 95%
+    # confidence intervals of their average scores.
+    if not loadouts:
+        raise ValueError("No loadouts to race")
+
+    stage_config = StageConfig(stage)
+    idol_configs = [
+        IdolConfig(
+            params=params,
+            support_bonus=support_bonus,
+            p_item_ids=loadout["pItemIds"],
+            skill_card_id_groups=[loadout["skillCardIds"]],
+            stage=stage,
+            fallback_plan=fallback_plan,
+            fallback_idol_id=fallback_idol_id,
+        )
+        for loadout in loadouts
+    ]
+    root_seed_sequence = get_root_seed_sequence(seed)
+
+    num_rounds = max(math.ceil(math.log(len(loadouts), eta)), 0) + 1
+    summaries = [None] * len(loadouts)
+    last_rounds = [0] * len(loadouts)
+    survivors = list(range(len(loadouts)))
+
+    with multiprocessing.Pool(
+        num_workers or os.cpu_count(),
+        initializer=_init_worker,
+        initargs=(
+            stage_config,
+            idol_configs,
+            strategy_class,
+            bucket_size,
+            root_seed_sequence,
+        ),
+    ) as pool:
+        for round_index in range(num_rounds):
+            new_runs = max(budget // num_rounds // len(survivors), min_runs)
+            chunks = []
+            for i in survivors:
+                start = summaries[i]["count"] if summaries[i] else 0
+                chunks += [
+                    (i, chunk_start, min(chunk_size, start + new_runs - chunk_start))
+                    for chunk_start in range(start, start + new_runs, chunk_size)
+                ]
+            for i, chunk_summary in pool.imap(_simulate_chunk, chunks):
+                summaries[i] = merge_summaries(summaries[i], chunk_summary)
+
+            for i in survivors:
+                last_rounds[i] = round_index
+            survivors = sorted(survivors, key=lambda i: -summaries[i]["mean"])
+            survivors = survivors[: math.ceil(len(survivors) / eta)]
+
+    leaderboard = []
+    for i, loadout in enumerate(loadouts):
+        result = get_result(summaries[i], bucket_size)
+        margin = CONFIDENCE_Z * result["stdev"] / math.sqrt(result["numRuns"])
+        leaderboard.append(
+            {
+                **loadout,
+                "numRuns": result["numRuns"],
+                "averageScore": result["averageScore"],
+                "stdev": result["stdev"],
+                "confidenceInterval": (
+                    result["averageScore"] - margin,
+                    result["averageScore"] + margin,
+                ),
+                "minScore": result["minScore"],
+                "maxScore": result["maxScore"],
+                # Last round the loadout played in
+                "round": last_rounds[i],
+            }
+        )
+    # Loadouts that lasted longer rank above those dropped before them
+    leaderboard.sort(key=lambda e: (-e["round"], -e["averageScore"]))
+
+    return {
+        "leaderboard": leaderboard,
+        "numRuns": sum(summary["count"] for summary in summaries),
+        "numRounds": num_rounds,
+        "seed": root_seed_sequence.entropy,
+    }
+
+
+def _init_worker(stage_config, idol_configs, strategy_class, bucket_size, root):
+    global worker_stage_config, worker_idol_configs, worker_strategy_class
+    global worker_bucket_size, worker_root_seed_sequence
+
+    # Forked workers inherit the parent's random state, so reseed to keep
+    # strategies using the random module from playing identical games
+    random.seed()
+
+    worker_stage_config = stage_config
+    worker_idol_configs = idol_configs
+    worker_strategy_class = strategy_class
+    worker_bucket_size = bucket_size
+    worker_root_seed_sequence = root
+
+
+def _simulate_chunk(chunk):
+    index, start, num_runs = chunk
+    summary = None
+    for run_index in range(start, start + num_runs):
+        run = simulate_run(
+            worker_stage_config,
+            worker_idol_configs[index],
+            worker_strategy_class,
+            worker_root_seed_sequence,
+            run_index,
+            logging=False,
+        )
+        summary = merge_summaries(summary, summarize_run(run, worker_bucket_size))
+    return index, summary
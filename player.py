@@ -15,15 +15,16 @@ class Player:
             scores, selected_card_id = self.strategy.evaluate(state)
             self.engine.logger.enable()
 
-            self.engine.logger.log(
-                "hand",
-                {
-                    "handCardIds": state["handCardIds"],
-                    "scores": scores,
-                    "selectedCardId": selected_card_id,
-                    "state": self._get_hand_state_for_logging(state),
-                },
-            )
+            if self.engine.logger.log_enabled:
+                self.engine.logger.log(
+                    "hand",
+                    {
+                        "handCardIds": state["handCardIds"],
+                        "scores": scores,
+                        "selectedCardId": selected_card_id,
+                        "state": self._get_hand_state_for_logging(state),
+                    },
+                )
 
             if selected_card_id:
                 state = self.engine.use_card(state, selected_card_id)
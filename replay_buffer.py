@@ -0,0 +1,208 @@
+import numpy as np
+
+
+class ReplayBuffer:
+    # Replay memory of transitions from num_envs environments, in
+    # preallocated arrays of capacity transitions. Each call to add stores
+    # one transition per environment, overwriting the oldest once full.
+    #
+    # Observations are stored once. The next observation of a transition is
+    # the observation of the next transition from the same environment, so
+    # it is looked up by index, and a transition can only be sampled once
+    # that next transition has been added. Transitions that end an episode
+    # have no next observation, since targets do not use it; environments
+    # that reset without ending an episode must report it as done.
+    #
+    # With prioritized, transitions are sampled in proportion to
+    # priority ** alpha from a sum tree, new transitions get the highest
+    # priority so far, and sample returns importance sampling weights for
+    # the given beta. Otherwise transitions are sampled uniformly, with
+    # weights of 1.
+    def __init__(
+        self,
+        capacity,
+        observation_shape,
+        num_envs=1,
+        observation_dtype=np.float32,
+        prioritized=False,
+        alpha=0.6,
+        beta=0.4,
+        min_priority=1e-6,
+        seed=None,
+    ):
+        if capacity < 2 * num_envs:
+            raise ValueError("Capacity must hold two transitions per environment")
+        self.capacity = capacity
+        self.num_envs = num_envs
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.beta = beta
+        self.min_priority = min_priority
+        self.rng = np.random.default_rng(seed)
+
+        self.observations = np.zeros(
+            (capacity, *observation_shape), dtype=observation_dtype
+        )
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_indices = np.zeros(capacity, dtype=np.int64)
+        self.dones = np.zeros(capacity, dtype=bool)
+        # Whether each transition is complete and can be sampled
+        self.valid = np.zeros(capacity, dtype=bool)
+        # Last transition added for each environment, if its episode goes on
+        self.last_indices = np.full(num_envs, -1, dtype=np.int64)
+
+        self.position = 0
+        self.size = 0
+
+        if prioritized:
+            self.tree = SumTree(capacity)
+            self.max_priority = 1.0
+
+    def __len__(self):
+        return self.size - int(np.count_nonzero(self.last_indices >= 0))
+
+    # Bytes taken by the buffer, all allocated up front
+    @property
+    def nbytes(self):
+        arrays = [
+            self.observations,
+            self.actions,
+            self.rewards,
+            self.next_indices,
+            self.dones,
+            self.valid,
+        ]
+        if self.prioritized:
+            arrays.append(self.tree.nodes)
+        return sum(array.nbytes for array in arrays)
+
+    # Adds a transition for each environment, given the observation it was
+    # in, the action taken, and the reward and done flag of the step
+    def add(self, observations, actions, rewards, dones):
+        dones = np.asarray(dones, dtype=bool)
+        indices = (self.position + np.arange(self.num_envs)) % self.capacity
+
+        self.observations[indices] = observations
+        self.actions[indices] = actions
+        self.rewards[indices] = rewards
+        self.dones[indices] = dones
+        self.next_indices[indices] = indices
+
+        # Complete the previous transitions of environments that went on
+        previous = self.last_indices[self.last_indices >= 0]
+        self.next_indices[previous] = indices[self.last_indices >= 0]
+        complete = np.concatenate([previous, indices[dones]])
+        pending = indices[~dones]
+        self.valid[complete] = True
+        self.valid[pending] = False
+        if self.prioritized:
+            self.tree.update(
+                np.concatenate([complete, pending]),
+                np.repeat(
+                    [self.max_priority**self.alpha, 0.0], [len(complete), len(pending)]
+                ),
+            )
+
+        self.last_indices = np.where(dones, -1, indices)
+        self.position = (self.position + self.num_envs) % self.capacity
+        self.size = min(self.size + self.num_envs, self.capacity)
+
+    # Returns observations, actions, rewards, next observations, dones,
+    # indices and importance sampling weights of batch_size transitions
+    def sample(self, batch_size):
+        if len(self) == 0:
+            raise ValueError("No complete transitions to sample")
+
+        if self.prioritized:
+            indices = self.tree.sample(batch_size, self.rng)
+            probabilities = self.tree.nodes[self.tree.leaf_start + indices] / (
+                self.tree.total()
+            )
+            weights = (len(self) * probabilities) ** -self.beta
+            weights = (weights / weights.max()).astype(np.float32)
+        else:
+            indices = self.rng.integers(self.size, size=batch_size)
+            # Pending transitions are at most one per environment, so few
+            # draws are redone
+            invalid = ~self.valid[indices]
+            while invalid.any():
+                indices[invalid] = self.rng.integers(
+                    self.size, size=np.count_nonzero(invalid)
+                )
+                invalid = ~self.valid[indices]
+            weights = np.ones(batch_size, dtype=np.float32)
+
+        return (
+            self.observations[indices],
+            self.actions[indices],
+            self.rewards[indices],
+            self.observations[self.next_indices[indices]],
+            self.dones[indices],
+            indices,
+            weights,
+        )
+
+    # Sets the priorities of sampled transitions from their TD errors
+    def update_priorities(self, indices, td_errors):
+        if not self.prioritized:
+            return
+        priorities = np.abs(td_errors) + self.min_priority
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        # Transitions sampled more than once take their first TD error, and
+        # pending transitions stay without priority
+        indices, first = np.unique(indices, return_index=True)
+        priorities = priorities[first]
+        sampled = self.valid[indices]
+        self.tree.update(indices[sampled], priorities[sampled] ** self.alpha)
+
+
+class SumTree:
+    # Binary tree over capacity leaves, where each node holds the sum of the
+    # leaves under it, stored as an array with the root at 1 and the
+    # children of node i at 2i and 2i + 1. Updates and sampling work on
+    # whole batches, one tree level at a time.
+    def __init__(self, capacity):
+        self.leaf_start = 1
+        while self.leaf_start < capacity:
+            self.leaf_start *= 2
+        self.nodes = np.zeros(2 * self.leaf_start)
+
+    def total(self):
+        return self.nodes[1]
+
+    def update(self, indices, priorities):
+        if len(indices) == 0:
+            return
+        nodes = self.leaf_start + np.asarray(indices)
+        self.nodes[nodes] = priorities
+        # Parents shared by several leaves are summed more than once, but
+        # always to the same value
+        nodes = nodes // 2
+        while nodes[0] >= 1:
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+            nodes //= 2
+
+    # Draws one leaf from each of batch_size equal slices of the total, so
+    # samples are spread over the priorities
+    def sample(self, batch_size, rng):
+        total = self.total()
+        targets = (np.arange(batch_size) + rng.random(batch_size)) * (
+            total / batch_size
+        )
+        targets = np.minimum(targets, np.nextafter(total, 0))
+        nodes = np.ones(batch_size, dtype=np.int64)
+        while nodes[0] < self.leaf_start:
+            left = self.nodes[2 * nodes]
+            right = targets >= left
+            targets -= left * right
+            nodes = 2 * nodes + right
+        indices = nodes - self.leaf_start
+
+        # Rounding in the sums can land on a leaf without priority, so those
+        # are drawn again from leaves that have one
+        empty = self.nodes[nodes] <= 0
+        if empty.any():
+            (nonzero,) = np.nonzero(self.nodes[self.leaf_start :] > 0)
+            indices[empty] = rng.choice(nonzero, size=np.count_nonzero(empty))
+        return indices
@@ -0,0 +1,316 @@
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import time
+
+from game_data.cache import JSON_DIR
+from seeding import get_root_seed_sequence
+from simulator import DEFAULT_BUCKET_SIZE
+from simulator import DEFAULT_CHUNK_SIZE
+from simulator import get_result
+from simulator import merge_summaries
+from simulator import replay_runs
+from simulator import simulate_chunks
+
+
+# Bump when the layout of the database or of stored summaries changes
+SCHEMA_VERSION = 2
+
+# Modules whose code decides the outcome of a simulated game, along with the
+# game_data package
+ENGINE_MODULES = [
+    "compiler.py",
+    "constants.py",
+    "effects.py",
+    "engine.py",
+    "game_state.py",
+    "idol_config.py",
+    "logger.py",
+    "player.py",
+    "seeding.py",
+    "simulator.py",
+    "stage_config.py",
+    "transposition.py",
+]
+
+# Run fields kept in stored summaries, which replay_runs plays again for
+# their logs
+SUMMARY_RUN_FIELDS = ["runIndex", "score"]
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+code_version = None
+
+
+# Hash of the engine code, the game data and the code that loads it, so that
+# cached results are not reused after either changes
+def get_code_version():
+    global code_version
+    if code_version is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+        game_data_dir = os.path.join(root, "game_data")
+        paths = [os.path.join(root, module) for module in ENGINE_MODULES]
+        paths += [
+            os.path.join(game_data_dir, name)
+            for name in sorted(os.listdir(game_data_dir))
+            if name.endswith(".py")
+        ]
+        paths += [os.path.join(JSON_DIR, name) for name in sorted(os.listdir(JSON_DIR))]
+        digest = hashlib.sha256()
+        for path in paths:
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        code_version = digest.hexdigest()
+    return code_version
+
+
+# Identifies a strategy by name and the code of the modules of the strategy
+# and its base classes, or by a cache_version class attribute where the
+# strategy sets one
+def get_strategy_version(strategy_class):
+    name = f"{strategy_class.__module__}.{strategy_class.__qualname__}"
+    version = getattr(strategy_class, "cache_version", None)
+    if version is None:
+        modules = []
+        for cls in strategy_class.__mro__:
+            module = inspect.getmodule(cls)
+            if cls is not object and module not in modules:
+                modules.append(module)
+        try:
+            digest = hashlib.sha256()
+            for module in modules:
+                digest.update(inspect.getsource(module).encode())
+            version = digest.hexdigest()
+        except (OSError, TypeError):
+            version = None
+    return [name, version]
+
+
+# Deterministic hash of everything that decides the results of a simulation:
+# the stage and loadout, the strategy, the engine and game data, the seed,
+# and the chunking and histogram buckets that summaries are stored in
+def get_fingerprint(
+    stage_config, idol_config, strategy_class, seed, chunk_size, bucket_size
+):
+    fingerprint = {
+        "schemaVersion": SCHEMA_VERSION,
+        "codeVersion": get_code_version(),
+        "strategy": get_strategy_version(strategy_class),
+        "stage": {
+            "turnCounts": stage_config.turn_counts,
+            "firstTurns": stage_config.first_turns,
+            "criteria": stage_config.criteria,
+            "effects": stage_config.effects,
+        },
+        "idol": {
+            "idolId": idol_config.idol_id,
+            "pIdolId": idol_config.p_idol_id,
+            "plan": idol_config.plan,
+            "recommendedEffect": idol_config.recommended_effect,
+            "params": idol_config.params,
+            "supportBonus": idol_config.support_bonus,
+            "typeMultipliers": idol_config.type_multipliers,
+            "pItemIds": sorted(idol_config.p_item_ids),
+            # Deck order is shuffled, but the starting order decides which
+            # shuffle each seed gives
+            "skillCardIds": idol_config.skill_card_ids,
+        },
+        "seed": seed,
+        "chunkSize": chunk_size,
+        "bucketSize": bucket_size,
+    }
+    return hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class ResultCache:
+    # Stores the summaries of simulated chunks of games in an SQLite
+    # database, so that repeated simulations of a configuration and seed
+    # only play the games that have not been played before. Chunks are
+    # merged in the same order as simulate, so results are identical to an
+    # uncached simulation. When the stored summaries take more than
+    # max_bytes, the least recently used configurations are evicted.
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS configs (
+                fingerprint TEXT PRIMARY KEY,
+                lastUsed REAL NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                fingerprint TEXT NOT NULL,
+                start INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                summary TEXT NOT NULL,
+                PRIMARY KEY (fingerprint, start)
+            );
+            """
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.connection.close()
+
+    # Same as simulator.simulate, except seed is required
+    def simulate(
+        self,
+        stage_config,
+        idol_config,
+        strategy_class,
+        num_runs,
+        seed,
+        num_workers=None,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        bucket_size=DEFAULT_BUCKET_SIZE,
+        log_runs=True,
+    ):
+        if seed is None:
+            raise ValueError("Cached simulations need a seed")
+
+        fingerprint = get_fingerprint(
+            stage_config, idol_config, strategy_class, seed, chunk_size, bucket_size
+        )
+        root_seed_sequence = get_root_seed_sequence(seed)
+
+        chunks = [
+            (start, min(chunk_size, num_runs - start))
+            for start in range(0, num_runs, chunk_size)
+        ]
+        stored = self._get_chunks(fingerprint, chunks)
+        missing = [chunk for chunk in chunks if chunk not in stored]
+        self.hits += len(chunks) - len(missing)
+        self.misses += len(missing)
+
+        new_summaries = simulate_chunks(
+            stage_config,
+            idol_config,
+            strategy_class,
+            missing,
+            root_seed_sequence,
+            num_workers,
+            bucket_size,
+        )
+        summary = None
+        for chunk in chunks:
+            chunk_summary = stored.get(chunk)
+            if chunk_summary is None:
+                chunk_summary = next(new_summaries)
+                self._put_chunk(fingerprint, chunk, chunk_summary)
+            summary = merge_summaries(summary, chunk_summary)
+        new_summaries.close()
+
+        self._touch(fingerprint)
+        self._evict()
+        self.connection.commit()
+
+        result = get_result(summary, bucket_size)
+        if result is not None:
+            result["seed"] = root_seed_sequence.entropy
+            if log_runs:
+                replay_runs(
+                    result,
+                    stage_config,
+                    idol_config,
+                    strategy_class,
+                    root_seed_sequence,
+                )
+        return result
+
+    def get_stats(self):
+        num_configs, size = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM configs"
+        ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "configs": num_configs,
+            "bytes": size,
+            "maxBytes": self.max_bytes,
+            "chunkHits": self.hits,
+            "chunkMisses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0,
+        }
+
+    def _get_chunks(self, fingerprint, chunks):
+        rows = self.connection.execute(
+            "SELECT start, count, summary FROM chunks WHERE fingerprint = ?",
+            (fingerprint,),
+        )
+        wanted = set(chunks)
+        stored = {}
+        for start, count, summary in rows:
+            if (start, count) in wanted:
+                stored[(start, count)] = _decode_summary(summary)
+        return stored
+
+    # Replaces any stored chunk with the same start, e.g. a shorter last
+    # chunk from a smaller simulation
+    def _put_chunk(self, fingerprint, chunk, summary):
+        encoded = _encode_summary(summary)
+        previous = self.connection.execute(
+            "SELECT LENGTH(summary) FROM chunks WHERE fingerprint = ? AND start = ?",
+            (fingerprint, chunk[0]),
+        ).fetchone()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+            (fingerprint, chunk[0], chunk[1], encoded),
+        )
+        size_change = len(encoded) - (previous[0] if previous else 0)
+        self.connection.execute(
+            """
+            INSERT INTO configs VALUES (?, ?, ?)
+            ON CONFLICT (fingerprint) DO UPDATE SET size = size + excluded.size
+            """,
+            (fingerprint, time.time(), size_change),
+        )
+
+    def _touch(self, fingerprint):
+        self.connection.execute(
+            "UPDATE configs SET lastUsed = ? WHERE fingerprint = ?",
+            (time.time(), fingerprint),
+        )
+
+    def _evict(self):
+        (size,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM configs"
+        ).fetchone()
+        if size <= self.max_bytes:
+            return
+        rows = self.connection.execute(
+            "SELECT fingerprint, size FROM configs ORDER BY lastUsed"
+        ).fetchall()
+        for fingerprint, config_size in rows[:-1]:
+            self.connection.execute(
+                "DELETE FROM chunks WHERE fingerprint = ?", (fingerprint,)
+            )
+            self.connection.execute(
+                "DELETE FROM configs WHERE fingerprint = ?", (fingerprint,)
+            )
+            size -= config_size
+            if size <= self.max_bytes:
+                break
+
+
+# Keeps the statistics of a summary and the index and score of its runs,
+# leaving out anything else a run holds, such as logs
+def _encode_summary(summary):
+    summary = dict(summary)
+    for key in ["minRun", "averageRun", "maxRun"]:
+        summary[key] = {field: summary[key][field] for field in SUMMARY_RUN_FIELDS}
+    return json.dumps(summary)
+
+
+def _decode_summary(encoded):
+    summary = json.loads(encoded)
+    # JSON object keys are strings
+    summary["histogram"] = {
+        int(bucket): count for bucket, count in summary["histogram"].items()
+    }
+    return summary
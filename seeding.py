@@ -0,0 +1,29 @@
+import random
+
+import numpy as np
+
+
+# Simulations derive every game's randomness from one root SeedSequence. Game
+# i always gets the i-th child of the root, so results do not depend on how
+# games are split across workers or machines.
+def get_root_seed_sequence(seed=None):
+    return np.random.SeedSequence(seed)
+
+
+# Same as the run_index-th sequence of root.spawn(), without spawning the
+# ones before it
+def get_run_seed_sequence(root, run_index):
+    return np.random.SeedSequence(
+        root.entropy, spawn_key=(*root.spawn_key, run_index), pool_size=root.pool_size
+    )
+
+
+def make_rng(seed_sequence):
+    state = seed_sequence.generate_state(4, np.uint32)
+    return random.Random(int.from_bytes(state.tobytes(), "little"))
+
+
+# Seeds a strategy's randomness for a game, independently of the game's own
+# stream from make_rng(run_seed_sequence)
+def get_strategy_seed_sequence(run_seed_sequence):
+    return get_run_seed_sequence(run_seed_sequence, 0)
@@ -0,0 +1,240 @@
+import math
+import multiprocessing
+import os
+import random
+
+from engine import Engine
+from logger import Logger
+from logger import NullLogger
+from player import Player
+from seeding import get_root_seed_sequence
+from seeding import get_run_seed_sequence
+from seeding import get_strategy_seed_sequence
+from seeding import make_rng
+
+
+DEFAULT_CHUNK_SIZE = 50
+DEFAULT_BUCKET_SIZE = 1000
+
+# Per-worker configuration, set up once by _init_worker
+worker_stage_config = None
+worker_idol_config = None
+worker_strategy_class = None
+worker_bucket_size = None
+worker_root_seed_sequence = None
+
+
+def simulate(
+    stage_config,
+    idol_config,
+    strategy_class,
+    num_runs,
+    num_workers=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    bucket_size=DEFAULT_BUCKET_SIZE,
+    seed=None,
+    log_runs=True,
+):
+    # Plays num_runs games of a loadout across a process pool and reports the
+    # score distribution with the min, average and max runs. Workers send
+    # back a summary per chunk of games rather than every run, so memory use
+    # stays flat as num_runs grows.
+    #
+    # Games are played without logging. With log_runs, the min, average and
+    # max runs are played again from their seeds with logging, for their
+    # logs and graph data; otherwise they only hold their run index and
+    # score.
+    #
+    # Game i is seeded from the i-th child of the root seed, and chunks are
+    # merged in order, so a given seed gives identical results for any
+    # number of workers. Strategies are made with strategy_class(engine, rng),
+    # where rng is a random.Random also seeded from the game's seed, and
+    # should draw from it to stay reproducible.
+    root_seed_sequence = get_root_seed_sequence(seed)
+    chunks = [
+        (start, min(chunk_size, num_runs - start))
+        for start in range(0, num_runs, chunk_size)
+    ]
+
+    summary = None
+    for chunk_summary in simulate_chunks(
+        stage_config,
+        idol_config,
+        strategy_class,
+        chunks,
+        root_seed_sequence,
+        num_workers,
+        bucket_size,
+    ):
+        summary = merge_summaries(summary, chunk_summary)
+
+    result = get_result(summary, bucket_size)
+    if result is not None:
+        result["seed"] = root_seed_sequence.entropy
+        if log_runs:
+            replay_runs(
+                result, stage_config, idol_config, strategy_class, root_seed_sequence
+            )
+    return result
+
+
+# Replaces the min, average and max runs of a result with logged replays of
+# the same games, which play out identically from their seeds
+def replay_runs(result, stage_config, idol_config, strategy_class, root):
+    runs = {}
+    for key in ["minRun", "averageRun", "maxRun"]:
+        run_index = result[key]["runIndex"]
+        if run_index not in runs:
+            runs[run_index] = simulate_run(
+                stage_config, idol_config, strategy_class, root, run_index
+            )
+        result[key] = runs[run_index]
+
+
+# Plays chunks of games, given as (first run index, number of runs), across
+# a process pool and yields their summaries in order
+def simulate_chunks(
+    stage_config,
+    idol_config,
+    strategy_class,
+    chunks,
+    root_seed_sequence,
+    num_workers=None,
+    bucket_size=DEFAULT_BUCKET_SIZE,
+):
+    if not chunks:
+        return
+
+    with multiprocessing.Pool(
+        num_workers or os.cpu_count(),
+        initializer=_init_worker,
+        initargs=(
+            stage_config,
+            idol_config,
+            strategy_class,
+            bucket_size,
+            root_seed_sequence,
+        ),
+    ) as pool:
+        yield from pool.imap(_simulate_chunk, chunks)
+
+
+def _init_worker(stage_config, idol_config, strategy_class, bucket_size, root):
+    global worker_stage_config, worker_idol_config, worker_strategy_class
+    global worker_bucket_size, worker_root_seed_sequence
+
+    # Forked workers inherit the parent's random state, so reseed to keep
+    # strategies using the random module from playing identical games
+    random.seed()
+
+    worker_stage_config = stage_config
+    worker_idol_config = idol_config
+    worker_strategy_class = strategy_class
+    worker_bucket_size = bucket_size
+    worker_root_seed_sequence = root
+
+
+# Plays game run_index of a simulation. Bulk runs should pass logging=False,
+# since building the logs costs more than most games.
+def simulate_run(
+    stage_config, idol_config, strategy_class, root, run_index, logging=True
+):
+    seed_sequence = get_run_seed_sequence(root, run_index)
+    logger = Logger(False) if logging else NullLogger()
+    engine = Engine(stage_config, idol_config, logger, False, make_rng(seed_sequence))
+    strategy = strategy_class(
+        engine, rng=make_rng(get_strategy_seed_sequence(seed_sequence))
+    )
+    run = Player(engine, strategy).play()
+    run["runIndex"] = run_index
+    return run
+
+
+def _simulate_chunk(chunk):
+    start, num_runs = chunk
+    summary = None
+    for run_index in range(start, start + num_runs):
+        run = simulate_run(
+            worker_stage_config,
+            worker_idol_config,
+            worker_strategy_class,
+            worker_root_seed_sequence,
+            run_index,
+            logging=False,
+        )
+        summary = merge_summaries(summary, summarize_run(run, worker_bucket_size))
+    return summary
+
+
+# Summaries only keep the index and score of the min, average and max runs,
+# which replay_runs can play again for their logs
+def summarize_run(run, bucket_size):
+    run = {"runIndex": run["runIndex"], "score": run["score"]}
+    return {
+        "count": 1,
+        "mean": run["score"],
+        "m2": 0,
+        "histogram": {math.floor(run["score"] / bucket_size): 1},
+        "minRun": run,
+        "averageRun": run,
+        "maxRun": run,
+    }
+
+
+# Combines two summaries. Means and squared deviations are merged with Chan's
+# parallel algorithm. The average run is whichever candidate is closer to
+# the combined mean, so it tracks the mean as chunks arrive.
+def merge_summaries(a, b):
+    if a is None:
+        return b
+
+    count = a["count"] + b["count"]
+    delta = b["mean"] - a["mean"]
+    mean = a["mean"] + delta * b["count"] / count
+    m2 = a["m2"] + b["m2"] + delta * delta * a["count"] * b["count"] / count
+
+    histogram = dict(a["histogram"])
+    for bucket, bucket_count in b["histogram"].items():
+        histogram[bucket] = histogram.get(bucket, 0) + bucket_count
+
+    return {
+        "count": count,
+        "mean": mean,
+        "m2": m2,
+        "histogram": histogram,
+        "minRun": min(a["minRun"], b["minRun"], key=lambda r: r["score"]),
+        "averageRun": min(
+            a["averageRun"], b["averageRun"], key=lambda r: abs(r["score"] - mean)
+        ),
+        "maxRun": max(a["maxRun"], b["maxRun"], key=lambda r: r["score"]),
+    }
+
+
+def get_result(summary, bucket_size):
+    if summary is None:
+        return None
+
+    stdev = 0
+    if summary["count"] > 1:
+        stdev = math.sqrt(summary["m2"] / (summary["count"] - 1))
+
+    first_bucket = min(summary["histogram"])
+    last_bucket = max(summary["histogram"])
+
+    return {
+        "numRuns": summary["count"],
+        "averageScore": summary["mean"],
+        "stdev": stdev,
+        "minScore": summary["minRun"]["score"],
+        "maxScore": summary["maxRun"]["score"],
+        # Run counts per bucket of bucket_size, starting at histogramStart
+        "histogramStart": first_bucket * bucket_size,
+        "histogramBucketSize": bucket_size,
+        "histogram": [
+            summary["histogram"].get(bucket, 0)
+            for bucket in range(first_bucket, last_bucket + 1)
+        ],
+        "minRun": summary["minRun"],
+        "averageRun": summary["averageRun"],
+        "maxRun": summary["maxRun"],
+    }
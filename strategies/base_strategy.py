@@ -1,6 +1,13 @@
+import random
+
+
 class BaseStrategy:
-    def __init__(self, engine):
+    # rng is the strategy's own source of randomness, separate from
+    # engine.random so that strategies do not change the game being played.
+    # Simulations pass one seeded from each game's seed.
+    def __init__(self, engine, rng=None):
         self.engine = engine
+        self.random = rng or random.Random()
 
     def evaluate(self, state):
         scores = [self.get_score(state, id) for id in state["handCardIds"]]
@@ -4,11 +4,10 @@ class ManualStrategy:
 
     def evaluate(self, state):
         print(state)
+        usable = self.engine.usable_mask(state)
         print(
             "Actions: ",
-            list(
-                c for c in state["handCardIds"] if self.engine.is_card_usable(state, c)
-            ),
+            list(c for c, u in zip(state["handCardIds"], usable) if u),
         )
         selected_card_id = int(input("Select card: "))
         scores = [1 if c == selected_card_id else 0 for c in state["handCardIds"]]
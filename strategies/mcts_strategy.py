@@ -0,0 +1,252 @@
+import math
+import time
+
+from engine import Engine
+from logger import NullLogger
+from strategies.base_strategy import BaseStrategy
+from transposition import ZobristHasher
+
+
+END_TURN = 0
+
+
+class DecisionNode:
+    # A state where the player chooses a card to use or ends the turn.
+    # children maps actions to ChanceNodes.
+    __slots__ = ("children", "visits", "total")
+
+    def __init__(self):
+        self.children = {}
+        self.visits = 0
+        self.total = 0
+
+
+class ChanceNode:
+    # The result of an action, which depends on draws and turn types.
+    # children maps outcome keys to DecisionNodes.
+    __slots__ = ("children", "visits", "total")
+
+    def __init__(self):
+        self.children = {}
+        self.visits = 0
+        self.total = 0
+
+
+class MCTSStrategy(BaseStrategy):
+    # Monte Carlo tree search over use_card and end_turn. Each iteration
+    # shuffles the deck and the turn types that are not yet known, so draws
+    # and turn types are chance events, then selects with UCT and plays a
+    # random rollout to the end of the stage. The subtree under the chosen
+    # action and the observed outcome is kept for the next decision.
+    #
+    # Searches run on a separate engine with the strategy's own random
+    # stream, so they do not change the game being played.
+    #
+    # With a transposition table, decision nodes are also stored by state
+    # hash, so lines of play that reach the same state share statistics.
+    # A table can be shared by strategies playing the same loadout.
+    def __init__(
+        self,
+        engine,
+        iterations=200,
+        time_budget=None,
+        exploration=1.0,
+        rollout_turns=None,
+        rng=None,
+        transposition_table=None,
+    ):
+        super().__init__(engine, rng)
+        self.iterations = iterations
+        self.time_budget = time_budget
+        self.exploration = exploration
+        self.rollout_turns = rollout_turns
+        self.search_engine = Engine(
+            engine.stage_config, engine.idol_config, NullLogger(), False, self.random
+        )
+        self.transposition_table = transposition_table
+        self.hasher = ZobristHasher() if transposition_table is not None else None
+
+        self.root = None
+        self.root_key = None
+        self.min_value = math.inf
+        self.max_value = -math.inf
+        # Search totals over all decisions
+        self.stats = {"iterations": 0, "nodes": 0, "seconds": 0, "nodesPerSecond": 0}
+
+    def evaluate(self, state):
+        self._set_root(state)
+
+        start = time.perf_counter()
+        num_iterations = 0
+        num_nodes = 0
+
+        # Nothing to search if the turn can only be ended
+        can_only_end_turn = not self.engine.usable_mask(state).any()
+
+        while not can_only_end_turn:
+            if self.time_budget is not None:
+                if time.perf_counter() - start >= self.time_budget:
+                    break
+            elif num_iterations >= self.iterations:
+                break
+            num_nodes += self._run_iteration(state)
+            num_iterations += 1
+
+        if num_iterations:
+            stats = self.stats
+            stats["iterations"] += num_iterations
+            stats["nodes"] += num_nodes
+            stats["seconds"] += time.perf_counter() - start
+            stats["nodesPerSecond"] = stats["nodes"] / stats["seconds"]
+
+        # Pick the most visited action
+        visits = {
+            action: chance.visits for action, chance in self.root.children.items()
+        }
+        selected_action = max(visits, key=visits.get, default=END_TURN)
+        scores = [visits.get(card_id, 0) for card_id in state.handCardIds]
+
+        # Keep the chosen subtree for the next decision
+        self.root = self.root.children.get(selected_action)
+        self.root_key = None
+
+        return scores, selected_action or None
+
+    def _set_root(self, state):
+        key = self._get_outcome_key(state)
+        if isinstance(self.root, ChanceNode) and key in self.root.children:
+            self.root = self.root.children[key]
+        elif not (isinstance(self.root, DecisionNode) and self.root_key == key):
+            self.root = DecisionNode()
+            self.min_value = math.inf
+            self.max_value = -math.inf
+        self.root_key = key
+
+    # Plays one iteration from the root and returns the number of nodes added
+    def _run_iteration(self, state):
+        state = self._determinize(state)
+        state_hash = self.hasher.hash_state(state) if self.hasher else None
+        node = self.root
+        path = [node]
+        num_nodes = 0
+
+        while state.turnsRemaining > 0:
+            actions = self._get_actions(state)
+            untried = [a for a in actions if a not in node.children]
+            if untried:
+                action = self.random.choice(untried)
+                node.children[action] = ChanceNode()
+                num_nodes += 1
+            else:
+                action = self._select(node, actions)
+
+            chance = node.children[action]
+            state = self._apply(state, action)
+            if state_hash is not None:
+                state_hash = self.hasher.update_hash(state_hash, state)
+            key = self._get_outcome_key(state)
+            node = chance.children.get(key)
+            path.append(chance)
+            if node is None:
+                node = self._get_transposition(state_hash)
+                chance.children[key] = node
+                path.append(node)
+                if not node.visits:
+                    num_nodes += 1
+                    break
+                # Values under a transposition may predate this search
+                mean = node.total / node.visits
+                self.min_value = min(self.min_value, mean)
+                self.max_value = max(self.max_value, mean)
+                continue
+            path.append(node)
+
+        value = self._rollout(state)
+        self.min_value = min(self.min_value, value)
+        self.max_value = max(self.max_value, value)
+        for n in path:
+            n.visits += 1
+            n.total += value
+
+        return num_nodes
+
+    # Copies the state with the deck order and the turn types of future turns
+    # shuffled. The last three turn types are fixed by the stage criteria.
+    def _determinize(self, state):
+        state = state.copy()
+
+        deck_card_ids = list(state.deckCardIds)
+        self.random.shuffle(deck_card_ids)
+        state.deckCardIds = deck_card_ids
+
+        turn_types = list(state.turnTypes)
+        first_unknown = int(state.turnsElapsed) + 1
+        last_unknown = len(turn_types) - 3
+        if last_unknown - first_unknown > 1:
+            unknown = turn_types[first_unknown:last_unknown]
+            self.random.shuffle(unknown)
+            turn_types[first_unknown:last_unknown] = unknown
+            state.turnTypes = turn_types
+
+        return state
+
+    def _get_actions(self, state):
+        usable = self.search_engine.usable_mask(state)
+        return [c for c, u in zip(state.handCardIds, usable) if u] + [END_TURN]
+
+    def _apply(self, state, action):
+        if action == END_TURN:
+            return self.search_engine.end_turn(state)
+        return self.search_engine.use_card(state, action)
+
+    # Looks up the decision node for a state hash, adding a new one if the
+    # state has not been seen
+    def _get_transposition(self, state_hash):
+        if state_hash is None:
+            return DecisionNode()
+        node = self.transposition_table.get(state_hash.value)
+        if node is None:
+            node = DecisionNode()
+            self.transposition_table.put(state_hash.value, node)
+        return node
+
+    def _get_outcome_key(self, state):
+        return (
+            state.turnsElapsed,
+            state.cardUsesRemaining,
+            state.turnType,
+            tuple(state.handCardIds),
+        )
+
+    def _select(self, node, actions):
+        value_range = self.max_value - self.min_value or 1
+        log_visits = math.log(node.visits)
+
+        best_action = None
+        best_value = -math.inf
+        for action in actions:
+            chance = node.children[action]
+            mean = (chance.total / chance.visits - self.min_value) / value_range
+            value = mean + self.exploration * math.sqrt(log_visits / chance.visits)
+            if value > best_value:
+                best_action = action
+                best_value = value
+        return best_action
+
+    # Plays random usable cards, ending the turn when none can be used, until
+    # the end of the stage or rollout_turns turns
+    def _rollout(self, state):
+        last_turn = math.inf
+        if self.rollout_turns is not None:
+            last_turn = state.turnsElapsed + self.rollout_turns
+
+        while state.turnsRemaining > 0 and state.turnsElapsed < last_turn:
+            hand_card_ids = state.handCardIds
+            usable = self.search_engine.usable_mask(state)
+            card_ids = [c for c, u in zip(hand_card_ids, usable) if u]
+            if card_ids:
+                state = self.search_engine.use_card(state, self.random.choice(card_ids))
+            else:
+                state = self.search_engine.end_turn(state)
+
+        return state.score
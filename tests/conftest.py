@@ -0,0 +1,53 @@
+import os
+import random
+import sys
+
+import pytest
+
+
+# Modules live at the top level of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+from engine import Engine  # noqa: E402
+from game_data.stages import Stages  # noqa: E402
+from idol_config import IdolConfig  # noqa: E402
+from logger import NullLogger  # noqa: E402
+from stage_config import StageConfig  # noqa: E402
+
+
+# Loadout of the sample GakumasEnv
+STAGE_ID = 26
+LOADOUT = {
+    "params": [1009, 1422, 1474, 47],
+    "support_bonus": 0.023,
+    "p_item_ids": [47, 75, 71],
+    "skill_card_id_groups": [
+        [223, 45, 122, 125, 136, 181],
+        [223, 45, 291, 96, 297, 179],
+    ],
+    "fallback_plan": "logic",
+    "fallback_idol_id": 3,
+}
+
+
+@pytest.fixture(scope="session")
+def configs():
+    stage = Stages.get_by_id(STAGE_ID)
+    return StageConfig(stage), IdolConfig(stage=stage, **LOADOUT)
+
+
+@pytest.fixture
+def make_engine(configs):
+    def make_engine(seed, logger=None):
+        stage_config, idol_config = configs
+        return Engine(
+            stage_config,
+            idol_config,
+            logger or NullLogger(),
+            False,
+            random.Random(seed),
+        )
+
+    return make_engine
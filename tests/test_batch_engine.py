@@ -0,0 +1,139 @@
+import random
+
+import numpy as np
+import pytest
+
+from batch_engine import BatchEngine
+from engine import Engine
+from game_data.stages import Stages
+from idol_config import IdolConfig
+from logger import NullLogger
+from stage_config import StageConfig
+
+
+# Loadouts of both plans over several stages, which play without hitting
+# engine errors for these seeds
+LOADOUTS = [
+    {
+        "stage": 26,
+        "params": [1009, 1422, 1474, 47],
+        "support_bonus": 0.023,
+        "p_item_ids": [47, 75, 71],
+        "skill_card_id_groups": [
+            [223, 45, 122, 125, 136, 181],
+            [223, 45, 291, 96, 297, 179],
+        ],
+        "fallback_plan": "logic",
+        "fallback_idol_id": 3,
+    },
+    {
+        "stage": 15,
+        "params": [1432, 682, 1026, 53],
+        "support_bonus": 0.02,
+        "p_item_ids": [137, 41, 135],
+        "skill_card_id_groups": [
+            [118, 162, 81, 111, 248, 199],
+            [73, 163, 51, 198, 108, 247],
+        ],
+        "fallback_plan": "sense",
+        "fallback_idol_id": 1,
+    },
+    {
+        "stage": 9,
+        "params": [741, 1689, 1349, 54],
+        "support_bonus": 0.02,
+        "p_item_ids": [51, 2, 80],
+        "skill_card_id_groups": [
+            [248, 159, 70, 178, 154, 4],
+            [21, 39, 314, 209, 44, 179],
+        ],
+        "fallback_plan": "logic",
+        "fallback_idol_id": 1,
+    },
+    {
+        "stage": 27,
+        "params": [1716, 1155, 965, 33],
+        "support_bonus": 0.02,
+        "p_item_ids": [64, 85, 109],
+        "skill_card_id_groups": [
+            [192, 92, 126, 93, 11, 175],
+            [156, 91, 181, 258, 298, 242],
+        ],
+        "fallback_plan": "logic",
+        "fallback_idol_id": 1,
+    },
+]
+
+SEEDS = range(8)
+
+
+def get_configs(loadout):
+    stage = Stages.get_by_id(loadout["stage"])
+    idol_config = IdolConfig(
+        params=loadout["params"],
+        support_bonus=loadout["support_bonus"],
+        p_item_ids=loadout["p_item_ids"],
+        skill_card_id_groups=loadout["skill_card_id_groups"],
+        stage=stage,
+        fallback_plan=loadout["fallback_plan"],
+        fallback_idol_id=loadout["fallback_idol_id"],
+    )
+    return StageConfig(stage), idol_config
+
+
+# Picks a usable card, rotating through them by turn with offset, or ends
+# the turn
+def choose(usable_card_ids, turns_elapsed, offset):
+    if not usable_card_ids:
+        return 0
+    return usable_card_ids[(offset + int(turns_elapsed)) % len(usable_card_ids)]
+
+
+def play_scalar(stage_config, idol_config, seed, offset):
+    engine = Engine(stage_config, idol_config, NullLogger(), False, random.Random(seed))
+    state = engine.start_stage(engine.get_initial_state())
+    card_ids = []
+    while state.turnsRemaining > 0:
+        usable = engine.usable_mask(state)
+        usable_card_ids = [c for c, u in zip(state.handCardIds, usable) if u]
+        card_id = choose(usable_card_ids, state.turnsElapsed, offset)
+        card_ids.append(card_id)
+        if card_id:
+            state = engine.use_card(state, card_id)
+        else:
+            state = engine.end_turn(state)
+    return state.score, card_ids
+
+
+def play_batch(stage_config, idol_config, seeds, offset):
+    engine = BatchEngine(stage_config, idol_config)
+    batch = engine.start_stage(engine.get_initial_state(seeds))
+    card_ids = [[] for _ in seeds]
+    while (batch.turnsRemaining > 0).any():
+        hands = [batch.get_hand(game) for game in range(batch.num_games)]
+        usable = {
+            card_id: engine.is_card_usable(batch, card_id)
+            for card_id in set(c for hand in hands for c in hand)
+        }
+        choices = np.zeros(batch.num_games, dtype=np.int64)
+        for game, hand in enumerate(hands):
+            if batch.turnsRemaining[game] <= 0:
+                continue
+            usable_card_ids = [c for c in hand if usable[c][game]]
+            choices[game] = choose(usable_card_ids, batch.turnsElapsed[game], offset)
+            card_ids[game].append(int(choices[game]))
+        engine.step(batch, choices)
+    return batch.score, card_ids
+
+
+@pytest.mark.parametrize("offset", [0, 1])
+@pytest.mark.parametrize("loadout", LOADOUTS, ids=lambda l: f"stage{l['stage']}")
+def test_batch_engine_matches_engine(loadout, offset):
+    stage_config, idol_config = get_configs(loadout)
+    scores, card_ids = play_batch(stage_config, idol_config, SEEDS, offset)
+    for game, seed in enumerate(SEEDS):
+        expected_score, expected_card_ids = play_scalar(
+            stage_config, idol_config, seed, offset
+        )
+        assert card_ids[game] == expected_card_ids
+        assert scores[game] == expected_score
@@ -0,0 +1,45 @@
+import pickle
+import random
+
+
+def snapshot(state):
+    return pickle.dumps(dict(state))
+
+
+# Plays games with apply, checking at every step that undo restores the
+# field values and the position in the random stream, then undoes the whole
+# game and checks each earlier step the same way
+def test_undo_restores_state_and_random_stream(make_engine):
+    num_random_records = 0
+    num_end_turns = 0
+    for seed in range(20):
+        rng = random.Random(seed)
+        engine = make_engine(seed)
+        state = engine.start_stage(engine.get_initial_state())
+        history = []
+        while state.turnsRemaining > 0:
+            usable = engine.usable_mask(state)
+            actions = [c for c, u in zip(state.handCardIds, usable) if u] + [None]
+            action = rng.choice(actions)
+            before = (snapshot(state), engine.random.getstate())
+
+            record = engine.apply(state, action)
+            after = (snapshot(state), engine.random.getstate())
+            engine.undo(state, record)
+            assert (snapshot(state), engine.random.getstate()) == before
+
+            # Applying again from the restored stream gives the same result
+            record = engine.apply(state, action)
+            assert (snapshot(state), engine.random.getstate()) == after
+
+            history.append((before, record))
+            num_random_records += record.random_state is not None
+            num_end_turns += action is None
+
+        while history:
+            before, record = history.pop()
+            engine.undo(state, record)
+            assert (snapshot(state), engine.random.getstate()) == before
+
+    assert num_end_turns
+    assert num_random_records
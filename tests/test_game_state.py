@@ -0,0 +1,53 @@
+import pickle
+import random
+
+from game_state import GameState
+
+
+def snapshot(state):
+    return pickle.dumps(dict(state))
+
+
+def test_writing_parent_after_copy_leaves_copy_unchanged():
+    parent = GameState({"handCardIds": [1, 2], "discardedCardIds": []})
+    parent.writable("discardedCardIds").append(3)
+    child = parent.copy()
+    before = snapshot(child)
+
+    parent.writable("discardedCardIds").extend(parent.handCardIds)
+    parent.writable("handCardIds").clear()
+
+    assert snapshot(child) == before
+    assert parent.discardedCardIds == [3, 1, 2]
+
+
+def test_writing_copy_leaves_parent_unchanged():
+    parent = GameState({"handCardIds": [1, 2]})
+    child = parent.copy()
+    child.writable("handCardIds").append(3)
+
+    assert parent.handCardIds == [1, 2]
+    assert child.handCardIds == [1, 2, 3]
+
+
+# end_turn runs in place, so ending the turn of a state that use_card was
+# called on must not change the state use_card returned
+def test_end_turn_on_parent_leaves_used_card_state_unchanged(make_engine):
+    num_checked = 0
+    for seed in range(20):
+        rng = random.Random(seed)
+        engine = make_engine(seed)
+        state = engine.start_stage(engine.get_initial_state())
+        while state.turnsRemaining > 0:
+            usable = engine.usable_mask(state)
+            card_ids = [c for c, u in zip(state.handCardIds, usable) if u]
+            if not card_ids:
+                state = engine.end_turn(state)
+                continue
+            child = engine.use_card(state, rng.choice(card_ids))
+            before = snapshot(child)
+            engine.end_turn(state)
+            assert snapshot(child) == before
+            num_checked += 1
+            state = child
+    assert num_checked
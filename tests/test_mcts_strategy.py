@@ -0,0 +1,17 @@
+import random
+
+from strategies.mcts_strategy import MCTSStrategy
+
+
+# Searching must leave the game's random stream alone, so games play out
+# the same way whatever the strategy does
+def test_search_does_not_draw_from_engine_random(make_engine):
+    engine = make_engine(0)
+    state = engine.start_stage(engine.get_initial_state())
+    random_state = engine.random.getstate()
+
+    strategy = MCTSStrategy(engine, iterations=20, rng=random.Random(0))
+    strategy.evaluate(state)
+    MCTSStrategy(engine, iterations=20).evaluate(state)
+
+    assert engine.random.getstate() == random_state
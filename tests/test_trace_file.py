@@ -0,0 +1,52 @@
+import os
+import random
+
+from logger import Logger
+from player import Player
+from strategies.mcts_strategy import MCTSStrategy
+from trace_file import TraceLogger
+from trace_file import TraceReader
+from trace_file import TraceWriter
+
+
+def play_games(make_engine, path, seeds):
+    games = []
+    with TraceWriter(path) as writer:
+        for seed in seeds:
+            logger = Logger(False)
+            engine = make_engine(seed, logger)
+            Player(
+                engine, MCTSStrategy(engine, iterations=5, rng=random.Random(seed))
+            ).play()
+            games.append((logger.logs, logger.graph_data))
+
+            trace_logger = TraceLogger(writer)
+            engine = make_engine(seed, trace_logger)
+            Player(
+                engine, MCTSStrategy(engine, iterations=5, rng=random.Random(seed))
+            ).play()
+            trace_logger.flush()
+    return games
+
+
+def check_games(path, games):
+    reader = TraceReader(path)
+    assert len(reader) == len(games)
+    for game, (logs, graph_data) in enumerate(games):
+        assert reader.get_logs(game) == logs
+        assert reader.get_graph_data(game) == graph_data
+
+
+# Appending after a record cut short by a crash drops the partial record, so
+# records written later stay readable
+def test_append_after_truncated_record(make_engine, tmp_path):
+    path = tmp_path / "games.trace"
+    games = play_games(make_engine, path, [0, 1])
+    check_games(path, games)
+
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 24)
+    check_games(path, games[:1])
+
+    games = games[:1] + play_games(make_engine, path, [2])
+    check_games(path, games)
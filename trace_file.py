@@ -0,0 +1,337 @@
+import json
+import struct
+from array import array
+
+import numpy as np
+
+from constants import GRAPHED_FIELDS
+from logger import Logger
+
+
+# A trace file is the magic bytes followed by one record per game. Each record
+# is a uint64 length, then a JSON header and the game's columns as raw arrays,
+# padded to 8 bytes so that the reader can map columns straight out of the
+# file. Records are self-contained, so any game can be read without the ones
+# before it, and a record cut short by a crash is ignored.
+MAGIC = b"GKTRACE\x01"
+ALIGNMENT = 8
+
+# Value kinds of event fields and graph points
+NONE = 0
+BOOL = 1
+INT = 2
+FLOAT = 3
+STRING = 4
+JSON = 5
+
+# Kinds of event data
+DATA_NONE = 0
+DATA_DICT = 1
+DATA_VALUE = 2
+
+COLUMN_TYPECODES = {
+    "eventTypes": "H",
+    "eventDataKinds": "B",
+    "eventFieldEnds": "I",
+    "fieldKeys": "H",
+    "fieldKinds": "B",
+    "fieldValues": "d",
+    "blobs": "B",
+    "blobEnds": "I",
+    "graphKinds": "B",
+    "graphValues": "d",
+}
+
+COLUMN_DTYPES = {
+    name: np.dtype(typecode) for name, typecode in COLUMN_TYPECODES.items()
+}
+
+
+class TraceWriter:
+    # Appends game records to a trace file. Only one writer should append
+    # to a file at a time. A record cut short at the end of the file, e.g.
+    # by a crash, is truncated away on open, so that new records follow the
+    # last complete one.
+    def __init__(self, path):
+        self.file = open(path, "a+b")
+        end = _get_complete_length(self.file, path)
+        if end < len(MAGIC):
+            self.file.truncate(0)
+            self.file.write(MAGIC)
+        else:
+            self.file.truncate(end)
+
+    def write_game(self, logs, graph_data):
+        encoder = TraceEncoder()
+        for log in logs:
+            encoder.add_event(log["logType"], log["data"])
+        num_points = max((len(values) for values in graph_data.values()), default=0)
+        for i in range(0, num_points):
+            encoder.add_graph_point(graph_data[field][i] for field in GRAPHED_FIELDS)
+        self.write_record(encoder)
+
+    def write_record(self, encoder):
+        columns = encoder.columns
+
+        arrays = {}
+        offset = 0
+        for name, values in columns.items():
+            arrays[name] = [len(values), offset]
+            offset += _pad(len(values) * values.itemsize)
+        header = json.dumps(
+            {
+                "strings": encoder.strings,
+                "graphFields": GRAPHED_FIELDS,
+                "arrays": arrays,
+            }
+        ).encode()
+
+        header_length = _pad(8 + len(header)) - 8
+        record_length = 8 + header_length + offset
+        self.file.write(struct.pack("<QQ", record_length, len(header)))
+        self.file.write(header.ljust(header_length, b" "))
+        for values in columns.values():
+            data = values.tobytes()
+            self.file.write(data.ljust(_pad(len(data)), b"\0"))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TraceEncoder:
+    # Encodes one game's events and graph data into columns. Log types,
+    # field names and string values are interned into the record's string
+    # table. Nested values, such as hand card lists, are stored as JSON.
+    def __init__(self):
+        self.strings = []
+        self.string_codes = {}
+        self.columns = {
+            name: array(typecode) for name, typecode in COLUMN_TYPECODES.items()
+        }
+
+    def intern(self, string):
+        code = self.string_codes.get(string)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(string)
+            self.string_codes[string] = code
+        return code
+
+    def add_event(self, log_type, data):
+        columns = self.columns
+        columns["eventTypes"].append(self.intern(log_type))
+        if data is None:
+            columns["eventDataKinds"].append(DATA_NONE)
+        elif isinstance(data, dict):
+            columns["eventDataKinds"].append(DATA_DICT)
+            for key, value in data.items():
+                columns["fieldKeys"].append(self.intern(key))
+                self._add_value(value, columns["fieldKinds"], columns["fieldValues"])
+        else:
+            columns["eventDataKinds"].append(DATA_VALUE)
+            columns["fieldKeys"].append(self.intern(""))
+            self._add_value(data, columns["fieldKinds"], columns["fieldValues"])
+        columns["eventFieldEnds"].append(len(columns["fieldKeys"]))
+
+    def add_graph_point(self, values):
+        for value in values:
+            self._add_value(
+                value, self.columns["graphKinds"], self.columns["graphValues"]
+            )
+
+    def _add_value(self, value, kinds, values):
+        if value is None:
+            kinds.append(NONE)
+            values.append(0)
+        elif isinstance(value, bool):
+            kinds.append(BOOL)
+            values.append(value)
+        elif isinstance(value, int):
+            kinds.append(INT)
+            values.append(value)
+        elif isinstance(value, float):
+            kinds.append(FLOAT)
+            values.append(value)
+        elif isinstance(value, str):
+            kinds.append(STRING)
+            values.append(self.intern(value))
+        else:
+            kinds.append(JSON)
+            values.append(len(self.columns["blobEnds"]))
+            self.columns["blobs"].frombytes(json.dumps(value).encode())
+            self.columns["blobEnds"].append(len(self.columns["blobs"]))
+
+
+class TraceLogger(Logger):
+    # Logger that streams each game to a TraceWriter instead of keeping its
+    # logs in memory. A game is written when the next one starts, since
+    # Engine.start_stage clears the logger, or on flush(). Player.play
+    # returns empty logs and graph data for games logged this way.
+    def __init__(self, writer, debugging_enabled=False):
+        self.writer = writer
+        self.encoder = None
+        super().__init__(debugging_enabled)
+
+    def log(self, log_type, data=None):
+        if self.disabled:
+            return
+
+        if self.encoder is None:
+            self.encoder = TraceEncoder()
+        self.encoder.add_event(log_type, data)
+
+    def push_graph_data(self, state):
+        if self.disabled:
+            return
+
+        if self.encoder is None:
+            self.encoder = TraceEncoder()
+        self.encoder.add_graph_point(state[field] for field in GRAPHED_FIELDS)
+
+    def clear(self):
+        self.flush()
+        super().clear()
+
+    def flush(self):
+        if self.encoder is not None:
+            self.writer.write_record(self.encoder)
+            self.encoder = None
+
+
+class TraceReader:
+    # Memory-maps a trace file. Columns are read-only views into the file,
+    # and logs in the Logger format are only rebuilt for requested games.
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self.data[: len(MAGIC)]) != MAGIC:
+            raise ValueError(f"Not a trace file: {path}")
+
+        self.record_offsets = []
+        offset = len(MAGIC)
+        while offset + 16 <= len(self.data):
+            record_length = int(self.data[offset : offset + 8].view("<u8")[0])
+            if offset + 8 + record_length > len(self.data):
+                break
+            self.record_offsets.append(offset)
+            offset += 8 + record_length
+
+    def __len__(self):
+        return len(self.record_offsets)
+
+    def get_header(self, game):
+        offset = self.record_offsets[game]
+        header_length = int(self.data[offset + 8 : offset + 16].view("<u8")[0])
+        header = json.loads(bytes(self.data[offset + 16 : offset + 16 + header_length]))
+        header["columnsOffset"] = offset + 8 + _pad(8 + header_length)
+        return header
+
+    def get_columns(self, game):
+        header = self.get_header(game)
+        columns = {}
+        for name, (length, offset) in header["arrays"].items():
+            dtype = COLUMN_DTYPES[name]
+            start = header["columnsOffset"] + offset
+            columns[name] = self.data[start : start + length * dtype.itemsize].view(
+                dtype
+            )
+        return columns
+
+    def get_logs(self, game):
+        header = self.get_header(game)
+        strings = header["strings"]
+        columns = self.get_columns(game)
+        decode = _ValueDecoder(strings, columns)
+
+        keys = columns["fieldKeys"].tolist()
+        kinds = columns["fieldKinds"].tolist()
+        values = columns["fieldValues"].tolist()
+
+        logs = []
+        start = 0
+        for log_type, data_kind, end in zip(
+            columns["eventTypes"].tolist(),
+            columns["eventDataKinds"].tolist(),
+            columns["eventFieldEnds"].tolist(),
+        ):
+            if data_kind == DATA_NONE:
+                data = None
+            elif data_kind == DATA_DICT:
+                data = {
+                    strings[keys[i]]: decode(kinds[i], values[i])
+                    for i in range(start, end)
+                }
+            else:
+                data = decode(kinds[start], values[start])
+            logs.append({"logType": strings[log_type], "data": data})
+            start = end
+        return logs
+
+    def get_graph_data(self, game):
+        header = self.get_header(game)
+        fields = header["graphFields"]
+        columns = self.get_columns(game)
+        decode = _ValueDecoder(header["strings"], columns)
+
+        kinds = columns["graphKinds"].tolist()
+        values = columns["graphValues"].tolist()
+
+        graph_data = {field: [] for field in fields}
+        for i in range(0, len(values)):
+            graph_data[fields[i % len(fields)]].append(decode(kinds[i], values[i]))
+        return graph_data
+
+
+class _ValueDecoder:
+    def __init__(self, strings, columns):
+        self.strings = strings
+        self.blobs = columns["blobs"]
+        self.blob_ends = columns["blobEnds"].tolist()
+
+    def __call__(self, kind, value):
+        if kind == NONE:
+            return None
+        if kind == BOOL:
+            return bool(value)
+        if kind == INT:
+            return int(value)
+        if kind == FLOAT:
+            return value
+        if kind == STRING:
+            return self.strings[int(value)]
+        index = int(value)
+        start = self.blob_ends[index - 1] if index else 0
+        return json.loads(bytes(self.blobs[start : self.blob_ends[index]]))
+
+
+# Length of a trace file up to the end of its last complete record, or 0 for
+# an empty file or one cut short within the magic bytes
+def _get_complete_length(file, path):
+    file.seek(0)
+    magic = file.read(len(MAGIC))
+    if magic != MAGIC:
+        if MAGIC.startswith(magic):
+            return 0
+        raise ValueError(f"Not a trace file: {path}")
+
+    file_length = file.seek(0, 2)
+    offset = len(MAGIC)
+    while offset + 16 <= file_length:
+        file.seek(offset)
+        (record_length,) = struct.unpack("<Q", file.read(8))
+        if offset + 8 + record_length > file_length:
+            break
+        offset += 8 + record_length
+    return offset
+
+
+def _pad(length):
+    return -(-length // ALIGNMENT) * ALIGNMENT
@@ -0,0 +1,240 @@
+import hashlib
+import random
+import sys
+from collections import OrderedDict
+
+from game_state import FIELDS
+from game_state import MISSING
+
+
+MASK = (1 << 64) - 1
+
+# Containers hashed as multisets, so card and effect order does not matter
+PILE_FIELDS = ("deckCardIds", "handCardIds", "discardedCardIds", "removedCardIds")
+
+# Fields that do not describe the game position: bookkeeping that the engine
+# resets between actions, and indexes derived from effects
+IGNORED_FIELDS = (
+    "phase",
+    "effectsByPhase",
+    "expiredEffects",
+    "triggeredEffects",
+    "_usedCardId",
+    "usedCardId",
+    "cardEffects",
+)
+
+HASHED_FIELDS = tuple(f for f in FIELDS if f not in IGNORED_FIELDS)
+
+# Hashes of numbers, and of tuples of them, do not depend on PYTHONHASHSEED,
+# so hashes are the same in every process
+NUMBER_TYPES = (int, float, bool)
+
+# Stands in for containers that a state owns, which the engine may still
+# write to in place, e.g. in end_turn, so they never compare as unchanged
+OWNED = object()
+
+# Fixed hashes for values whose builtin hash depends on their address
+NONE_HASH = 0x6A09E667F3BCC908
+MISSING_HASH = 0xBB67AE8584CAA73B
+
+
+class StateHash:
+    # Hash of a state, with the per-field hashes it was summed from and the
+    # values they were computed for. Containers are compared by identity when
+    # updating, which relies on the engine replacing containers rather than
+    # modifying them once they are shared between states. Containers the
+    # state owned are always rehashed.
+    __slots__ = ("value", "components", "extra")
+
+    def __init__(self, value, components, extra):
+        self.value = value
+        self.components = components
+        self.extra = extra
+
+    def __hash__(self):
+        return self.value
+
+    def __eq__(self, other):
+        return isinstance(other, StateHash) and self.value == other.value
+
+
+class ZobristHasher:
+    # Zobrist-style hashing of game states. Every field gets a random key,
+    # and a state's hash is the sum of a keyed hash per field, so changing
+    # one field only needs that field rehashed. Piles, score buffs, fresh
+    # buffs and live effects are hashed as the sum of their items' hashes,
+    # which makes them order independent.
+    def __init__(self, seed=0):
+        rng = random.Random(seed)
+        self.field_keys = {field: rng.getrandbits(64) for field in HASHED_FIELDS}
+        self.extra_key = rng.getrandbits(64)
+        self.string_hashes = {}
+        self.effect_hashes = {}
+
+    def hash_state(self, state):
+        components = {}
+        value = 0
+        for field in HASHED_FIELDS:
+            field_value = getattr(state, field)
+            field_hash = self._hash_field(field, field_value)
+            components[field] = (field_value, field_hash)
+            value += field_hash
+        _mark_owned(components, state)
+        extra = self._hash_extra(state._extra)
+        return StateHash((value + extra) & MASK, components, extra)
+
+    # Hashes state given the hash of a state it was derived from, rehashing
+    # only the fields that changed
+    def update_hash(self, state_hash, state):
+        components = dict(state_hash.components)
+        value = state_hash.value - state_hash.extra
+        for field, (prev_value, prev_hash) in state_hash.components.items():
+            field_value = getattr(state, field)
+            if field_value is prev_value:
+                continue
+            if type(field_value) in NUMBER_TYPES and field_value == prev_value:
+                continue
+            field_hash = self._hash_field(field, field_value)
+            components[field] = (field_value, field_hash)
+            value += field_hash - prev_hash
+        _mark_owned(components, state)
+        extra = self._hash_extra(state._extra)
+        return StateHash((value + extra) & MASK, components, extra)
+
+    def _hash_field(self, field, value):
+        key = self.field_keys[field]
+        if type(value) in NUMBER_TYPES:
+            return hash((key, value)) & MASK
+        if field in PILE_FIELDS:
+            # Card ids are ints
+            return hash((key, sum(hash((key, c)) for c in value))) & MASK
+        if field == "scoreBuffs":
+            return self._hash_multiset(
+                key, [(b["amount"], b["turns"], b["fresh"]) for b in value]
+            )
+        if field == "effects":
+            return self._hash_effects(key, value)
+        if field == "freshBuffs":
+            return self._hash_multiset(key, value)
+        return hash((key, self._hash_value(value))) & MASK
+
+    def _hash_multiset(self, key, items):
+        total = 0
+        for item in items:
+            total += hash((key, self._hash_value(item)))
+        return hash((key, total)) & MASK
+
+    def _hash_effects(self, key, effects):
+        total = 0
+        for effect in effects:
+            if "limit" in effect and effect["limit"] < 1:
+                continue
+            if "ttl" in effect and effect["ttl"] < 0:
+                continue
+            total += self._hash_effect(effect)
+        return hash((key, total)) & MASK
+
+    # Effect dicts are never modified once registered, so their hashes are
+    # cached by identity. The dict is kept alongside its hash so that its id
+    # is not reused while cached.
+    def _hash_effect(self, effect):
+        cached = self.effect_hashes.get(id(effect))
+        if cached is not None and cached[0] is effect:
+            return cached[1]
+        if len(self.effect_hashes) >= 100_000:
+            self.effect_hashes.clear()
+        effect_hash = self._hash_string(repr(effect))
+        self.effect_hashes[id(effect)] = (effect, effect_hash)
+        return effect_hash
+
+    def _hash_extra(self, extra):
+        if not extra:
+            return 0
+        return self._hash_multiset(self.extra_key, extra.items())
+
+    def _hash_value(self, value):
+        if isinstance(value, str):
+            return self._hash_string(value)
+        if isinstance(value, (tuple, list)):
+            return hash(tuple(self._hash_value(item) for item in value))
+        if value is None:
+            return NONE_HASH
+        if value is MISSING:
+            return MISSING_HASH
+        return hash(value)
+
+    def _hash_string(self, string):
+        string_hash = self.string_hashes.get(string)
+        if string_hash is None:
+            digest = hashlib.blake2b(string.encode(), digest_size=8).digest()
+            string_hash = int.from_bytes(digest, "little")
+            self.string_hashes[string] = string_hash
+        return string_hash
+
+
+def _mark_owned(components, state):
+    if not state._owned:
+        return
+    for field, value in state._owned.items():
+        component = components.get(field)
+        if component is not None and component[0] is value:
+            components[field] = (OWNED, component[1])
+
+
+class TranspositionTable:
+    # Bounded map from state hashes to search results, evicting the least
+    # recently used entry when full. Tracks hit rate and an estimate of the
+    # memory held by its entries.
+    def __init__(self, max_entries=100_000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entry_bytes = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.entry_bytes -= sys.getsizeof(self.entries[key])
+            self.entries.move_to_end(key)
+        elif len(self.entries) >= self.max_entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.entry_bytes -= sys.getsizeof(evicted)
+            self.evictions += 1
+        self.entries[key] = value
+        self.entry_bytes += sys.getsizeof(value)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.entry_bytes = 0
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "maxEntries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0,
+            "evictions": self.evictions,
+            # Shallow sizes of the table, keys and values
+            "memoryBytes": sys.getsizeof(self.entries)
+            + len(self.entries) * sys.getsizeof(0)
+            + self.entry_bytes,
+        }
@@ -0,0 +1,211 @@
+import multiprocessing
+import traceback
+
+import numpy as np
+
+from gymnasium.vector import VectorEnv
+
+
+class GakumasVectorEnv(VectorEnv):
+    # Runs one GakumasEnv per worker process, following the
+    # gymnasium.vector API. Actions, observations, rewards, terminated and
+    # truncated flags and legal action masks are passed through
+    # shared-memory arrays, so pipes only carry commands and infos.
+    #
+    # Environments reset themselves when their episodes end, and the
+    # observation and info of the final step are kept in infos under
+    # "final_observation" and "final_info", as in gymnasium's vector envs.
+    # Resetting with an int seed seeds the environments with seed, seed + 1,
+    # ..., and later episodes draw from each environment's own np_random, so
+    # a seed gives the same episodes for any number of processes.
+    #
+    # Legal action masks, from the "action_mask" info of GakumasEnv, are
+    # kept in action_masks and in infos under "action_mask".
+    def __init__(self, env_fns, copy=True, context=None):
+        ctx = multiprocessing.get_context(context)
+        self.pipes = []
+        self.processes = []
+
+        # Spaces are read from a throwaway env rather than from a worker
+        dummy_env = env_fns[0]()
+        observation_space = dummy_env.observation_space
+        action_space = dummy_env.action_space
+        dummy_env.close()
+        super().__init__(len(env_fns), observation_space, action_space)
+        self.copy = copy
+
+        num_envs = self.num_envs
+        obs_size = int(np.prod(observation_space.shape))
+        obs_dtype = np.dtype(observation_space.dtype)
+        buffers = {
+            "actions": ctx.RawArray("b", num_envs * 8),
+            "observations": ctx.RawArray("b", num_envs * obs_size * obs_dtype.itemsize),
+            "rewards": ctx.RawArray("b", num_envs * 8),
+            "terminations": ctx.RawArray("b", num_envs),
+            "truncations": ctx.RawArray("b", num_envs),
+            "actionMasks": ctx.RawArray("b", num_envs * int(action_space.n)),
+        }
+        self.buffers = buffers
+        (
+            self.actions,
+            self.observations,
+            self.rewards,
+            self.terminations,
+            self.truncations,
+            self.action_masks,
+        ) = _get_views(buffers, num_envs, observation_space, action_space)
+
+        for index, env_fn in enumerate(env_fns):
+            parent_pipe, child_pipe = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker,
+                name=f"GakumasVectorEnv-{index}",
+                args=(
+                    index,
+                    env_fn,
+                    child_pipe,
+                    parent_pipe,
+                    buffers,
+                    observation_space,
+                    action_space,
+                ),
+                daemon=True,
+            )
+            process.start()
+            child_pipe.close()
+            self.pipes.append(parent_pipe)
+            self.processes.append(process)
+
+    def reset_async(self, seed=None, options=None):
+        if seed is None or isinstance(seed, int):
+            seeds = [None if seed is None else seed + i for i in range(self.num_envs)]
+        else:
+            seeds = list(seed)
+            if len(seeds) != self.num_envs:
+                raise ValueError(f"Expected {self.num_envs} seeds, got {len(seeds)}")
+        for pipe, env_seed in zip(self.pipes, seeds):
+            pipe.send(("reset", {"seed": env_seed, "options": options}))
+
+    def reset_wait(self, seed=None, options=None):
+        infos = {}
+        for index, info in enumerate(self._receive()):
+            infos = self._add_info(infos, info, index)
+        infos["action_mask"] = self._get_array(self.action_masks)
+        return self._get_array(self.observations), infos
+
+    def step_async(self, actions):
+        self.actions[:] = actions
+        for pipe in self.pipes:
+            pipe.send(("step", None))
+
+    def step_wait(self):
+        infos = {}
+        for index, info in enumerate(self._receive()):
+            infos = self._add_info(infos, info, index)
+        infos["action_mask"] = self._get_array(self.action_masks)
+        return (
+            self._get_array(self.observations),
+            self.rewards.copy(),
+            self.terminations.copy(),
+            self.truncations.copy(),
+            infos,
+        )
+
+    # Calls a method of each environment, or gets an attribute
+    def call(self, name, *args, **kwargs):
+        for pipe in self.pipes:
+            pipe.send(("call", (name, args, kwargs)))
+        return tuple(self._receive())
+
+    def close_extras(self, **kwargs):
+        for pipe, process in zip(self.pipes, self.processes):
+            if process.is_alive():
+                try:
+                    pipe.send(("close", None))
+                    pipe.recv()
+                except (BrokenPipeError, EOFError):
+                    pass
+            pipe.close()
+        for process in self.processes:
+            process.join()
+
+    def _get_array(self, array):
+        return array.copy() if self.copy else array
+
+    def _receive(self):
+        results = [pipe.recv() for pipe in self.pipes]
+        for index, (success, result) in enumerate(results):
+            if not success:
+                raise RuntimeError(f"Environment {index} failed:\n{result}")
+        return [result for _, result in results]
+
+
+def _get_views(buffers, num_envs, observation_space, action_space):
+    return (
+        np.frombuffer(buffers["actions"], dtype=np.int64),
+        np.frombuffer(buffers["observations"], dtype=observation_space.dtype).reshape(
+            (num_envs,) + observation_space.shape
+        ),
+        np.frombuffer(buffers["rewards"], dtype=np.float64),
+        np.frombuffer(buffers["terminations"], dtype=bool),
+        np.frombuffer(buffers["truncations"], dtype=bool),
+        np.frombuffer(buffers["actionMasks"], dtype=bool).reshape(
+            num_envs, int(action_space.n)
+        ),
+    )
+
+
+def _worker(index, env_fn, pipe, parent_pipe, buffers, observation_space, action_space):
+    parent_pipe.close()
+    num_envs = len(buffers["terminations"])
+    (
+        actions,
+        observations,
+        rewards,
+        terminations,
+        truncations,
+        action_masks,
+    ) = _get_views(buffers, num_envs, observation_space, action_space)
+    env = env_fn()
+
+    while True:
+        command, data = pipe.recv()
+        if command == "close":
+            env.close()
+            pipe.send((True, None))
+            break
+
+        # Errors, e.g. from the engine, are sent to the parent and leave the
+        # worker running, so the environment can be reset
+        try:
+            if command == "reset":
+                observation, info = env.reset(**data)
+                result = info
+            elif command == "step":
+                # Action 0 ends the turn
+                observation, reward, terminated, truncated, info = env.step(
+                    int(actions[index])
+                )
+                rewards[index] = reward
+                terminations[index] = terminated
+                truncations[index] = truncated
+                if terminated or truncated:
+                    final_observation, final_info = observation, info
+                    observation, info = env.reset()
+                    info["final_observation"] = final_observation
+                    info["final_info"] = final_info
+                result = info
+            elif command == "call":
+                name, args, kwargs = data
+                result = getattr(env, name)
+                if callable(result):
+                    result = result(*args, **kwargs)
+            else:
+                raise ValueError(f"Unknown command {command}")
+
+            if command != "call":
+                observations[index] = observation
+                action_masks[index] = result.pop("action_mask")
+            pipe.send((True, result))
+        except Exception:
+            pipe.send((False, traceback.format_exc()))